@@ -22,6 +22,12 @@ class ModelMetadata(Base):
     cost = Column(Float, nullable=True)
     latency = Column(Float, nullable=True)
     performance = Column(Float, nullable=True)
+    # Observed full-completion latency (EWMA seconds) from live traffic;
+    # NULL until the model has been sampled. Kept apart from latency, which
+    # is the CSV time to first chunk that scoring and lat_max use.
+    # create_all does not add it to an existing table:
+    #   ALTER TABLE model_metadata ADD COLUMN observed_latency DOUBLE PRECISION;
+    observed_latency = Column(Float, nullable=True)
 
     # Category scores in [0..1]
     math_score = Column(Float, nullable=True)
@@ -35,6 +41,11 @@ class ModelMetadata(Base):
     temperature = Column(Float, nullable=False)
     io_ratio = Column(Float,nullable=False)
 
+    # Provider rate limits for this model; NULL means unlimited
+    max_concurrency = Column(Integer, nullable=True)  # Requests in flight at once
+    rpm_limit = Column(Integer, nullable=True)        # Requests per minute
+    tpm_limit = Column(Integer, nullable=True)        # Tokens per minute
+
 # User model for storing user information
 class User(Base):
     __tablename__ = "users"
@@ -105,6 +116,11 @@ class QueryLog(Base):
     completion_tokens = Column(Integer,nullable=False)      # Completed token count i.e. Input + Output Token count
     total_tokens = Column(Integer,nullable=False)           # Total Token count = Input + Output + Prompt Token count
     latency = Column(Float,nullable=True)                  # Time taken for the model to return the response
+    time_to_first_token = Column(Float, nullable=True)      # Streaming only: time until the first output chunk
+    # Existing databases: ALTER TABLE query_logs ADD COLUMN provider_latency DOUBLE PRECISION;
+    provider_latency = Column(Float, nullable=True)         # The answering provider call alone; NULL for cached or coalesced answers
+    retry_count = Column(Integer, nullable=True)            # Provider retries made by the router for this query
+    retry_wait = Column(Float, nullable=True)               # Seconds spent backing off between those retries
     cost = Column(Float, nullable=False)                    # Actual cost of the total tokens
     cost_preference = Column(Integer,nullable=False)        # User's input cost preference
     latency_preference = Column(Integer,nullable=False)     # User's latency preference
@@ -113,6 +129,60 @@ class QueryLog(Base):
     user = relationship("User", back_populates="query_logs")
 
 
+class ResponseCacheEntry(Base):
+    __tablename__ = "response_cache"
+
+    key = Column(String, primary_key=True)                  # Hash of query, model and sampling parameters
+    model_name = Column(String, nullable=False, index=True)
+    query_output = Column(Text, nullable=False)
+    completion_tokens = Column(Integer, nullable=False)
+    total_tokens = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+
+
+class BatchJob(Base):
+    __tablename__ = "batch_jobs"
+
+    id = Column(String, primary_key=True)                   # Random hex id returned to the client
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    status = Column(String, nullable=False, default="pending")  # pending, running, completed
+    total_items = Column(Integer, nullable=False)
+    completed_items = Column(Integer, nullable=False, default=0)
+    failed_items = Column(Integer, nullable=False, default=0)
+    total_cost = Column(Float, nullable=False, default=0.0)
+    created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    completed_at = Column(DateTime(timezone=True), nullable=True)
+
+    items = relationship("BatchJobItem", back_populates="job", order_by="BatchJobItem.item_index")
+
+
+class BatchJobItem(Base):
+    __tablename__ = "batch_job_items"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(String, ForeignKey("batch_jobs.id"), nullable=False, index=True)
+    item_index = Column(Integer, nullable=False)            # Position in the submitted list
+    user_query = Column(Text, nullable=False)
+    user_input = Column(Text, nullable=False)               # JSON of the item's preferences and sampling parameters
+    candidates = Column(Text, nullable=False)               # JSON list of routed model names, best first
+    model_name = Column(String, nullable=False, index=True) # Model the item is queued for
+    provider_name = Column(String, nullable=False)
+    # queued -> submitted (in a provider batch) -> completed / failed
+    status = Column(String, nullable=False, default="queued", index=True)
+    provider_batch_id = Column(String, nullable=True, index=True)
+    # Existing databases: ALTER TABLE batch_job_items ADD COLUMN claimed_at TIMESTAMP WITH TIME ZONE;
+    claimed_at = Column(DateTime(timezone=True), nullable=True)  # When a worker claimed the item for sending
+    query_output = Column(Text, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    total_tokens = Column(Integer, nullable=True)
+    cost = Column(Float, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    completed_at = Column(DateTime(timezone=True), nullable=True)
+
+    job = relationship("BatchJob", back_populates="items")
+
+
 class Email(Base):
     __tablename__ = "emails"
 
@@ -0,0 +1,34 @@
+# app/db/wallets.py
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from app.db.models import Wallet
+
+
+def debit_wallet(db: Session, user_id: int, amount: float, allow_overdraft: bool = False):
+    """
+    Take amount off a user's wallet in a single conditional
+    UPDATE ... SET balance = balance - :amount WHERE balance >= :amount
+    RETURNING balance, so concurrent debits never read-modify-write over
+    each other and the row is locked only for the statement (until the
+    caller's commit on databases with row locks).
+
+    Returns the new balance, or None when the wallet does not exist or,
+    unless allow_overdraft, its balance does not cover amount. A negative
+    amount credits the wallet. The caller commits; Wallet objects already
+    loaded in the session are not refreshed.
+    """
+    statement = update(Wallet).where(Wallet.user_id == user_id)
+    if not allow_overdraft:
+        statement = statement.where(Wallet.balance >= amount)
+    statement = statement.values(balance=Wallet.balance - amount).returning(Wallet.balance)
+    return db.execute(statement, execution_options={"synchronize_session": False}).scalar_one_or_none()
+
+
+def credit_wallet(db: Session, user_id: int, amount: float):
+    """
+    Add amount to a user's wallet in one UPDATE. Returns the new balance,
+    or None when the user has no wallet. The caller commits.
+    """
+    return debit_wallet(db, user_id, -amount, allow_overdraft=True)
@@ -1,24 +1,81 @@
 import httpx
-import json
+import orjson
 import os
 from dotenv import load_dotenv
 from fastapi import HTTPException
+from app.llm.registry import LLM_MOCK_BASE_URL, PROVIDER_MAX_OUTPUT_TOKENS, provider_error, register_provider
 
 # Load environment variables
 load_dotenv("otterflow-backend/.env")
 
 # Bearer token for authorization
 authorization_bearer_token = "Bearer " + str(os.getenv("AI_API_KEY"))
-print(authorization_bearer_token)
+
+AIML_URL = f"{LLM_MOCK_BASE_URL or 'https://api.aimlapi.com'}/chat/completions"
+# Connection pool shared by every AIML request for the application lifetime
+AIML_MAX_CONNECTIONS = int(os.getenv("AIML_MAX_CONNECTIONS", 100))
+AIML_MAX_KEEPALIVE = int(os.getenv("AIML_MAX_KEEPALIVE", 20))
+AIML_KEEPALIVE_EXPIRY = float(os.getenv("AIML_KEEPALIVE_EXPIRY", 30))
+AIML_CONNECT_TIMEOUT = float(os.getenv("AIML_CONNECT_TIMEOUT", 5))
+AIML_READ_TIMEOUT = float(os.getenv("AIML_READ_TIMEOUT", 60))
+# HTTP/2 needs the h2 package (httpx[http2])
+AIML_HTTP2 = os.getenv("AIML_HTTP2", "true").lower() == "true"
+AIML_MAX_TOKENS = PROVIDER_MAX_OUTPUT_TOKENS["Opensource"]
+
+_client = None
+
+
+def open_aiml_client() -> httpx.AsyncClient:
+    """
+    Create the shared AIML client. Called from the FastAPI lifespan; the
+    adapters also create it lazily when used outside the app.
+    """
+    global _client
+    if _client is None:
+        try:
+            import h2  # noqa: F401
+            http2 = AIML_HTTP2
+        except ImportError:
+            http2 = False
+        _client = httpx.AsyncClient(
+            http2=http2,
+            headers={
+                "Authorization": authorization_bearer_token,
+                "Content-Type": "application/json",
+            },
+            limits=httpx.Limits(
+                max_connections=AIML_MAX_CONNECTIONS,
+                max_keepalive_connections=AIML_MAX_KEEPALIVE,
+                keepalive_expiry=AIML_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(AIML_READ_TIMEOUT, connect=AIML_CONNECT_TIMEOUT),
+        )
+    return _client
+
+
+def request_timeout(kwargs: dict):
+    """
+    The client's timeouts, shortened to kwargs["timeout"] when the call has
+    less time left than that.
+    """
+    timeout = kwargs.get("timeout")
+    if not timeout:
+        return httpx.USE_CLIENT_DEFAULT
+    return httpx.Timeout(min(timeout, AIML_READ_TIMEOUT), connect=min(timeout, AIML_CONNECT_TIMEOUT))
+
+
+async def close_aiml_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
 async def handle_aiml_query_async(user_query: str, model_name: str, **kwargs):
     """
     Handle AIML API query asynchronously with user-provided parameters.
+    kwargs["timeout"] (seconds) bounds the call.
     """
-    url = "https://api.aimlapi.com/chat/completions"
-    headers = {
-        "Authorization": authorization_bearer_token,
-        "Content-Type": "application/json",
-    }
     payload = {
         "model": model_name,
         "messages": [
@@ -27,26 +84,91 @@ async def handle_aiml_query_async(user_query: str, model_name: str, **kwargs):
                 "content": user_query,
             },
         ],
-        "max_tokens": 512,
+        "max_tokens": AIML_MAX_TOKENS,
+        "temperature": kwargs.get("temperature", 0.5),
+        "top_p": kwargs.get("top_p", 1.0),
         "stream": False,
     }
 
-    # Using httpx to make async requests
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(url, headers=headers, json=payload)
-            response.raise_for_status()  # Raise for HTTP errors
-
-            # Return the JSON response from the API
-            print("aiml")
-            print(response.json())
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=response.status_code, detail=f"HTTP error occurred: {e}")
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=500, detail=f"Request error occurred: {e}")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error occurred: {str(e)}")
+    client = open_aiml_client()
+    try:
+        response = await client.post(AIML_URL, content=orjson.dumps(payload), timeout=request_timeout(kwargs))
+        response.raise_for_status()  # Raise for HTTP errors
+        # Parse the body once
+        return orjson.loads(response.content)
+    except httpx.HTTPStatusError as e:
+        raise provider_error("HTTP error occurred", e)
+    except httpx.RequestError as e:
+        raise provider_error("Request error occurred", e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error occurred: {str(e)}")
+
+
+async def stream_aiml_query_async(user_query: str, model_name: str, **kwargs):
+    """
+    Stream an AIML API chat completion over server-sent events. Yields
+    {"delta": text} events and a final {"usage": {...}} event when the
+    API includes usage in a chunk.
+    """
+    payload = {
+        "model": model_name,
+        "messages": [
+            {
+                "role": "user",
+                "content": user_query,
+            },
+        ],
+        "max_tokens": AIML_MAX_TOKENS,
+        "temperature": kwargs.get("temperature", 0.5),
+        "top_p": kwargs.get("top_p", 1.0),
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }
+
+    client = open_aiml_client()
+    try:
+        async with client.stream("POST", AIML_URL, content=orjson.dumps(payload), timeout=request_timeout(kwargs)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = orjson.loads(data)
+                choices = chunk.get("choices") or []
+                if choices and (choices[0].get("delta") or {}).get("content"):
+                    yield {"delta": choices[0]["delta"]["content"]}
+                if chunk.get("usage"):
+                    yield {"usage": {
+                        "completion_tokens": int(chunk["usage"]["completion_tokens"]),
+                        "total_tokens": int(chunk["usage"]["total_tokens"]),
+                    }}
+    except httpx.HTTPStatusError as e:
+        raise provider_error("HTTP error occurred", e)
+    except httpx.RequestError as e:
+        raise provider_error("Request error occurred", e)
+
+
+def parse_aiml_response(response: dict):
+    """
+    (output text, input tokens, output tokens, finish reason) from the JSON body.
+    """
+    choice = response["choices"][0]
+    usage = response["usage"]
+    output_tokens = usage["completion_tokens"]
+    input_tokens = usage.get("prompt_tokens", usage["total_tokens"] - output_tokens)
+    return choice["message"]["content"], input_tokens, output_tokens, choice.get("finish_reason")
+
+
+register_provider(
+    "Opensource",
+    query=handle_aiml_query_async,
+    parse=parse_aiml_response,
+    stream=stream_aiml_query_async,
+)
+
+
 '''
 # Example function call (to be run in an async context)
 async def main():
@@ -1,27 +1,94 @@
 import cohere
+import math
 import os
 from fastapi import HTTPException
+from app.llm.registry import LLM_MOCK_BASE_URL, provider_error, register_provider
 from dotenv import load_dotenv
 load_dotenv("../../../.env") 
 # Load the COHERE_API_KEY from environment variables
 api_key = os.getenv("CO_API_KEY")
 
 
-co = cohere.AsyncClientV2(api_key=api_key)
+if LLM_MOCK_BASE_URL:
+    co = cohere.AsyncClientV2(api_key=api_key or "mock", base_url=LLM_MOCK_BASE_URL)
+else:
+    co = cohere.AsyncClientV2(api_key=api_key)
+
+def request_options(kwargs: dict):
+    timeout = kwargs.get("timeout")
+    return {"timeout_in_seconds": math.ceil(timeout)} if timeout else None
+
+def sampling_options(kwargs: dict) -> dict:
+    """
+    temperature, and top_p as Cohere's p when given (the API accepts
+    0.01-0.99, so the value is clamped into that range).
+    """
+    options = {"temperature": kwargs.get("temperature", 0.5)}
+    if kwargs.get("top_p") is not None:
+        options["p"] = min(max(kwargs["top_p"], 0.01), 0.99)
+    return options
 
 async def handle_cohere_query_async(user_query: str, model_name: str, **kwargs):
     """
     Handle Cohere queries asynchronously with user-provided parameters.
+    kwargs["timeout"] (seconds) bounds the call.
     """
     try:
         # Call the Cohere chat API (similar to OpenAI's chat completion)
         response = await co.chat(
             model=model_name,
             messages=[cohere.UserChatMessageV2(content=user_query)],
-            temperature=kwargs.get("temperature", 0.5)
+            request_options=request_options(kwargs),
+            **sampling_options(kwargs)
         )
-        print("Cohere")
-        print(response)
         return response
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Cohere Query Error: {str(e)}")
+        raise provider_error("Cohere Query Error", e)
+
+
+async def stream_cohere_query_async(user_query: str, model_name: str, **kwargs):
+    """
+    Stream a Cohere chat. Yields {"delta": text} for content-delta events
+    and a final {"usage": {...}} event from message-end.
+    """
+    try:
+        stream = co.chat_stream(
+            model=model_name,
+            messages=[cohere.UserChatMessageV2(content=user_query)],
+            request_options=request_options(kwargs),
+            **sampling_options(kwargs)
+        )
+        async for event in stream:
+            if event.type == "content-delta":
+                yield {"delta": event.delta.message.content.text}
+            elif event.type == "message-end" and event.delta.usage:
+                tokens = event.delta.usage.tokens
+                yield {"usage": {
+                    "completion_tokens": int(tokens.output_tokens),
+                    "total_tokens": int(tokens.input_tokens + tokens.output_tokens),
+                }}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise provider_error("Cohere Query Error", e)
+
+
+def parse_cohere_response(response):
+    """
+    (output text, input tokens, output tokens, finish reason) from a v2 chat response.
+    """
+    tokens = response.usage.tokens
+    return (
+        response.message.content[0].text,
+        tokens.input_tokens,
+        tokens.output_tokens,
+        response.finish_reason,
+    )
+
+
+register_provider(
+    "Cohere",
+    query=handle_cohere_query_async,
+    parse=parse_cohere_response,
+    stream=stream_cohere_query_async,
+)
@@ -1,41 +1,116 @@
 import os
-import asyncio
+from functools import lru_cache
 import google.generativeai as genai
 from fastapi import HTTPException
+from app.llm.registry import LLM_MOCK_BASE_URL, provider_error, register_provider
 from dotenv import load_dotenv
 load_dotenv("otterflow-backend/.env") 
 
 # Configure the API key
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+if LLM_MOCK_BASE_URL:
+    # The mock server only speaks the REST transport
+    genai.configure(
+        api_key=os.getenv('GEMINI_API_KEY', "mock"),
+        transport="rest",
+        client_options={"api_endpoint": LLM_MOCK_BASE_URL},
+    )
+else:
+    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+
+
+@lru_cache(maxsize=None)
+def get_google_model(model_name: str) -> genai.GenerativeModel:
+    """
+    One GenerativeModel per model name, reused across requests.
+    """
+    return genai.GenerativeModel(model_name)
+
+
+def request_options(kwargs: dict):
+    timeout = kwargs.get("timeout")
+    return {"timeout": timeout} if timeout else None
+
 
 async def handle_google_query_async(user_query: str, model_name: str, **kwargs):
     """
     Handle Google Gemini queries asynchronously with user-provided parameters.
+    kwargs["timeout"] (seconds) bounds the call.
     """
     try:
-        # Select the model (assuming the model name matches what you provided)
-        model = genai.GenerativeModel(model_name)
+        model = get_google_model(model_name)
 
         # Extract additional parameters like temperature, top_p, etc.
         temperature = kwargs.get("temperature", 0.5)
         top_p = kwargs.get("top_p", 1.0)
 
-        # Run the model generation in a separate thread (to avoid blocking the event loop)
-        response = await asyncio.to_thread(
-            model.generate_content,
+        # Native async call, no worker thread involved
+        return await model.generate_content_async(
             user_query,
             generation_config=genai.types.GenerationConfig(
                 temperature=temperature,
                 top_p=top_p
-            )
+            ),
+            request_options=request_options(kwargs)
         )
 
-        # Return the generated content
-        return response
+    except Exception as e:
+        raise provider_error("Google Query Error", e)
+
 
+async def stream_google_query_async(user_query: str, model_name: str, **kwargs):
+    """
+    Stream a Gemini completion. Yields {"delta": text} events and a final
+    {"usage": {...}} event from the last chunk's usage metadata.
+    """
+    try:
+        model = get_google_model(model_name)
+        response = await model.generate_content_async(
+            user_query,
+            generation_config=genai.types.GenerationConfig(
+                temperature=kwargs.get("temperature", 0.5),
+                top_p=kwargs.get("top_p", 1.0)
+            ),
+            stream=True,
+            request_options=request_options(kwargs)
+        )
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Google Query Error: {str(e)}")
-    
+        raise provider_error("Google Query Error", e)
+
+    usage = None
+    async for chunk in response:
+        parts = chunk.candidates[0].content.parts if chunk.candidates else []
+        text = "".join(part.text for part in parts)
+        if text:
+            yield {"delta": text}
+        usage = getattr(chunk, "usage_metadata", None) or usage
+    if usage:
+        yield {"usage": {
+            "completion_tokens": int(usage.candidates_token_count),
+            "total_tokens": int(usage.total_token_count),
+        }}
+
+
+def parse_google_response(response):
+    """
+    (output text, input tokens, output tokens, finish reason) from a Gemini response.
+    """
+    candidate = response.candidates[0]
+    usage = response.usage_metadata
+    return (
+        candidate.content.parts[0].text,
+        usage.prompt_token_count,
+        usage.candidates_token_count,
+        getattr(candidate.finish_reason, "name", candidate.finish_reason),
+    )
+
+
+register_provider(
+    "Google",
+    query=handle_google_query_async,
+    parse=parse_google_response,
+    stream=stream_google_query_async,
+)
+
 
 '''
 # Main function to call the handle_google_query_async function
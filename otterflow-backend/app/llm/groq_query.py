@@ -1,36 +1,84 @@
 import os
-import asyncio
-from groq import Groq
+from groq import AsyncGroq, NOT_GIVEN
 from fastapi import HTTPException
+from app.llm.registry import LLM_MOCK_BASE_URL, provider_error, register_provider
 from dotenv import load_dotenv
 load_dotenv() 
-# Initialize the Groq client
-client = Groq(
-    api_key=os.environ.get("GROQ_API_KEY"),
+# Initialize the async Groq client, shared by all requests. Retries are
+# left to the router's retry policy (app/machine_learning/retry.py).
+async_client = AsyncGroq(
+    api_key=os.environ.get("GROQ_API_KEY", "mock" if LLM_MOCK_BASE_URL else None),
+    base_url=LLM_MOCK_BASE_URL,
+    max_retries=0,
 )
 
 async def handle_groq_query_async(user_query: str, model_name: str, **kwargs):
     """
     Handle a query to Groq asynchronously with user-provided parameters.
+    kwargs["timeout"] (seconds) bounds the call.
     """
     try:
         # Extract additional parameters like temperature and top_p
         temperature = kwargs.get("temperature", 0.5)
         top_p = kwargs.get("top_p", 1.0)
 
-        # Run the Groq completion in a separate thread to simulate async behavior
-        response = await asyncio.to_thread(
-            client.chat.completions.create,
+        return await async_client.chat.completions.create(
             messages=[{"role": "user", "content": user_query}],
             model=model_name,
             temperature=temperature,
-            top_p=top_p
+            top_p=top_p,
+            timeout=kwargs.get("timeout") or NOT_GIVEN
         )
-        
-        print("groq")
-        print(response)
-        # Return the generated content from the response
-        return response
 
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Groq Query Error: {str(e)}")
+        raise provider_error("Groq Query Error", e)
+
+
+async def stream_groq_query_async(user_query: str, model_name: str, **kwargs):
+    """
+    Stream a Groq chat completion. Yields {"delta": text} events and a
+    final {"usage": {...}} event taken from the last chunk's x_groq usage.
+    """
+    try:
+        stream = await async_client.chat.completions.create(
+            messages=[{"role": "user", "content": user_query}],
+            model=model_name,
+            temperature=kwargs.get("temperature", 0.5),
+            top_p=kwargs.get("top_p", 1.0),
+            stream=True,
+            timeout=kwargs.get("timeout") or NOT_GIVEN,
+        )
+    except Exception as e:
+        raise provider_error("Groq Query Error", e)
+
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield {"delta": chunk.choices[0].delta.content}
+        x_groq = getattr(chunk, "x_groq", None)
+        usage = getattr(x_groq, "usage", None) if x_groq else None
+        if usage:
+            yield {"usage": {
+                "completion_tokens": int(usage.completion_tokens),
+                "total_tokens": int(usage.total_tokens),
+            }}
+
+
+def parse_groq_response(response):
+    """
+    (output text, input tokens, output tokens, finish reason) from a chat completion.
+    """
+    choice = response.choices[0]
+    return (
+        choice.message.content,
+        response.usage.prompt_tokens,
+        response.usage.completion_tokens,
+        choice.finish_reason,
+    )
+
+
+register_provider(
+    "Groq",
+    query=handle_groq_query_async,
+    parse=parse_groq_response,
+    stream=stream_groq_query_async,
+)
@@ -1,15 +1,24 @@
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, NOT_GIVEN
+from openai.types.chat import ChatCompletion
 import asyncio
+import orjson
 from fastapi import HTTPException
+from app.llm.registry import LLM_MOCK_BASE_URL, provider_error, register_provider
 import os
 from dotenv import load_dotenv
 load_dotenv() 
-# Initialize the AsyncOpenAI client
-client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"),)
+# Initialize the AsyncOpenAI client. Retries are left to the router's
+# retry policy (app/machine_learning/retry.py).
+client = AsyncOpenAI(
+    api_key=os.environ.get("OPENAI_API_KEY", "mock" if LLM_MOCK_BASE_URL else None),
+    base_url=f"{LLM_MOCK_BASE_URL}/v1" if LLM_MOCK_BASE_URL else None,
+    max_retries=0,
+)
 
 async def handle_openai_query_async(user_query: str, model_name: str, **kwargs):
     """
     Handle OpenAI queries asynchronously with user-provided parameters.
+    kwargs["timeout"] (seconds) bounds the call.
     """
     try:
         response = await client.chat.completions.create(
@@ -18,9 +27,125 @@ async def handle_openai_query_async(user_query: str, model_name: str, **kwargs):
             stream=False,
             temperature=kwargs.get("temperature", 0.5),
             top_p=kwargs.get("top_p", 1.0),
+            timeout=kwargs.get("timeout") or NOT_GIVEN,
         )
-        print(response)
         return response
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"OpenAI Query Error: {str(e)}")
+        raise provider_error("OpenAI Query Error", e)
 
+
+
+async def stream_openai_query_async(user_query: str, model_name: str, **kwargs):
+    """
+    Stream an OpenAI chat completion. Yields {"delta": text} events and a
+    final {"usage": {...}} event when the API reports token usage.
+    """
+    try:
+        stream = await client.chat.completions.create(
+            model=model_name,
+            messages=[{"role": "user", "content": user_query}],
+            stream=True,
+            stream_options={"include_usage": True},
+            temperature=kwargs.get("temperature", 0.5),
+            top_p=kwargs.get("top_p", 1.0),
+            timeout=kwargs.get("timeout") or NOT_GIVEN,
+        )
+    except Exception as e:
+        raise provider_error("OpenAI Query Error", e)
+
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield {"delta": chunk.choices[0].delta.content}
+        if chunk.usage:
+            yield {"usage": {
+                "completion_tokens": int(chunk.usage.completion_tokens),
+                "total_tokens": int(chunk.usage.total_tokens),
+            }}
+
+
+def parse_openai_response(response):
+    """
+    (output text, input tokens, output tokens, finish reason) from a chat completion.
+    """
+    choice = response.choices[0]
+    return (
+        choice.message.content,
+        response.usage.prompt_tokens,
+        response.usage.completion_tokens,
+        choice.finish_reason,
+    )
+
+
+# Batch API statuses after which the output and error files are final
+OPENAI_BATCH_DONE = {"completed", "failed", "expired", "cancelled"}
+
+
+async def submit_openai_batch(model_name: str, requests: list) -> str:
+    """
+    Upload the requests as a JSONL file and start a Batch API job over it.
+    Returns the OpenAI batch id.
+    """
+    lines = [
+        orjson.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model_name,
+                "messages": [{"role": "user", "content": user_query}],
+                "temperature": kwargs.get("temperature", 0.5),
+                "top_p": kwargs.get("top_p", 1.0),
+            },
+        })
+        for custom_id, user_query, kwargs in requests
+    ]
+    try:
+        batch_file = await client.files.create(file=("batch.jsonl", b"\n".join(lines)), purpose="batch")
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+    except Exception as e:
+        raise provider_error("OpenAI Batch Error", e)
+    return batch.id
+
+
+async def poll_openai_batch(batch_id: str):
+    """
+    None while the batch runs; then {custom_id: (ChatCompletion, None)} for
+    answered requests and {custom_id: (None, error)} for failed ones.
+    """
+    try:
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status not in OPENAI_BATCH_DONE:
+            return None
+
+        outcome = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await client.files.content(file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                record = orjson.loads(line)
+                response = record.get("response") or {}
+                if record.get("error") or response.get("status_code") != 200:
+                    error = record.get("error") or response.get("body", {}).get("error") or "request failed"
+                    outcome[record["custom_id"]] = (None, f"OpenAI Batch Error: {error}")
+                else:
+                    outcome[record["custom_id"]] = (ChatCompletion.model_validate(response["body"]), None)
+    except Exception as e:
+        raise provider_error("OpenAI Batch Error", e)
+    return outcome
+
+
+register_provider(
+    "OpenAI",
+    query=handle_openai_query_async,
+    parse=parse_openai_response,
+    stream=stream_openai_query_async,
+    submit_batch=submit_openai_batch,
+    poll_batch=poll_openai_batch,
+)
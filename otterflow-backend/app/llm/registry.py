@@ -0,0 +1,246 @@
+# app/llm/registry.py
+
+import asyncio
+import importlib
+import os
+import time
+from dataclasses import dataclass
+
+from fastapi import HTTPException
+
+# Send every provider call to the local mock server (mock_llm.py) instead
+LLM_MOCK_BASE_URL = os.getenv("LLM_MOCK_BASE_URL")
+
+# Keep each provider's raw SDK response on the result (memory heavy; for debugging only)
+LLM_DEBUG_RAW_RESPONSES = os.getenv("LLM_DEBUG_RAW_RESPONSES", "false").lower() == "true"
+
+# Adapter module for each ModelMetadata license. A module is imported (and
+# its SDK loaded) the first time a model with that license is called; on
+# import it registers itself with register_provider.
+PROVIDER_MODULES = {
+    "OpenAI": "app.llm.openai_query",
+    "Groq": "app.llm.groq_query",
+    "Opensource": "app.llm.aimlapi_query",
+    "Google": "app.llm.google_query",
+    "Cohere": "app.llm.cohere_query",
+}
+
+# Licenses whose adapter can submit work through the provider's batch API
+# (deferred, but cheaper). Declared here rather than read off the adapters
+# so routing can prefer them without importing any SDK.
+BATCH_CAPABLE_LICENSES = set(filter(None, os.getenv("BATCH_CAPABLE_LICENSES", "OpenAI").split(",")))
+# Most completion tokens each license's adapter requests (its max_tokens),
+# which bounds the funds reserved for a query; unlisted licenses send no limit
+PROVIDER_MAX_OUTPUT_TOKENS = {"Opensource": 512}
+# Price of a batch API request relative to an interactive one
+BATCH_PRICE_FACTOR = float(os.getenv("BATCH_PRICE_FACTOR", 0.5))
+
+
+@dataclass(slots=True)
+class ProviderResult:
+    """
+    One model answer, normalized across providers.
+
+    completion_tokens and total_tokens mirror the QueryLog columns. latency
+    is the provider call time in seconds (0 for cached answers). semantic
+    marks a cached answer stored for a similar, not identical, query.
+    coalesced marks a copy handed to a request that joined an identical
+    in-flight call.
+    retries and retry_wait count the retries the router made for the query
+    and the seconds it spent backing off between them.
+    """
+    model_name: str
+    license_type: str
+    query_output: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+    latency: float = 0.0
+    finish_reason: str = None
+    cached: bool = False
+    semantic: bool = False
+    coalesced: bool = False
+    retries: int = 0
+    retry_wait: float = 0.0
+    raw_response: object = None
+
+    @property
+    def completion_tokens(self) -> int:
+        return self.output_tokens
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+
+@dataclass(slots=True)
+class ProviderAdapter:
+    """
+    query(user_query, model_name, **kwargs) awaits the provider's raw
+    response; parse(raw) turns it into (output text, input tokens, output
+    tokens, finish reason); stream is the async generator used by the
+    streaming endpoint.
+
+    Providers with a batch API also set submit_batch(model_name, requests),
+    which uploads [(custom_id, user_query, kwargs), ...] and returns the
+    provider's batch id, and poll_batch(batch_id), which returns None while
+    the batch runs and then {custom_id: (raw response, error)}.
+    """
+    license_type: str
+    query: object
+    parse: object
+    stream: object = None
+    submit_batch: object = None
+    poll_batch: object = None
+
+
+_adapters = {}
+
+
+def register_provider(license_type: str, query, parse, stream=None, module: str = None,
+                      submit_batch=None, poll_batch=None):
+    """
+    Make an adapter available for a license. Adapter modules call this at
+    import time; passing module also lets other licenses be loaded lazily.
+    """
+    _adapters[license_type] = ProviderAdapter(license_type, query, parse, stream, submit_batch, poll_batch)
+    if module is not None:
+        PROVIDER_MODULES[license_type] = module
+
+
+def get_provider(license_type: str):
+    """
+    The adapter for a license, importing its module on first use, or None
+    when no adapter is known.
+    """
+    adapter = _adapters.get(license_type)
+    if adapter is None and license_type in PROVIDER_MODULES:
+        importlib.import_module(PROVIDER_MODULES[license_type])
+        adapter = _adapters.get(license_type)
+    return adapter
+
+
+def provider_error(label: str, error: Exception) -> HTTPException:
+    """
+    Wrap an SDK or transport error in an HTTPException that keeps the
+    provider's HTTP status and Retry-After header, so the router can tell
+    rate limits and bad requests from transient failures. Errors without a
+    status become 504 for timeouts and 502 otherwise.
+    """
+    if isinstance(error, HTTPException):
+        return error
+    response = getattr(error, "response", None)
+    # OpenAI/Groq/Cohere errors carry status_code, httpx errors a response,
+    # google.api_core errors an integer code
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None) or getattr(error, "code", None)
+    if not isinstance(status, int) or not 400 <= status < 600:
+        # SDK timeout classes share no base class, only the name
+        timed_out = isinstance(error, TimeoutError) or "Timeout" in type(error).__name__
+        status = 504 if timed_out else 502
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None) or {}
+    retry_after = headers.get("retry-after") or headers.get("Retry-After") if hasattr(headers, "get") else None
+    return HTTPException(
+        status_code=status,
+        detail=f"{label}: {error}",
+        headers={"Retry-After": str(retry_after)} if retry_after else None,
+    )
+
+
+def max_output_tokens(license_type: str):
+    return PROVIDER_MAX_OUTPUT_TOKENS.get(license_type)
+
+
+def batch_capable(license_type: str) -> bool:
+    return license_type in BATCH_CAPABLE_LICENSES
+
+
+async def call_provider(user_query: str, chosen_model: dict, timeout: float = None, **kwargs) -> ProviderResult:
+    """
+    Send the query through the adapter registered for the model's license
+    and return the normalized result.
+
+    timeout (seconds) is handed to the adapter, which passes it to its SDK
+    as the per-call timeout, and is also enforced here in case a client
+    does not honour it; either way an expired call raises a 504.
+    """
+    license_type = chosen_model.get("license", "Unknown")
+    model_name = chosen_model.get("model_name")
+    adapter = get_provider(license_type)
+    if adapter is None:
+        raise HTTPException(status_code=500, detail=f"No adapter registered for provider {license_type}")
+
+    start_time = time.perf_counter()
+    try:
+        if timeout is None:
+            raw_response = await adapter.query(user_query, model_name, **kwargs)
+        else:
+            try:
+                raw_response = await asyncio.wait_for(
+                    adapter.query(user_query, model_name, timeout=timeout, **kwargs), timeout
+                )
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=504, detail=f"{license_type} call timed out after {timeout:.2f}s")
+        latency = time.perf_counter() - start_time
+        query_output, input_tokens, output_tokens, finish_reason = adapter.parse(raw_response)
+    except Exception as e:
+        print(f"{license_type} query error: {e}")
+        raise
+
+    return ProviderResult(
+        model_name=model_name,
+        license_type=license_type,
+        query_output=query_output,
+        input_tokens=int(input_tokens),
+        output_tokens=int(output_tokens),
+        latency=latency,
+        finish_reason=finish_reason,
+        raw_response=raw_response if LLM_DEBUG_RAW_RESPONSES else None,
+    )
+
+
+def _batch_adapter(license_type: str) -> ProviderAdapter:
+    adapter = get_provider(license_type)
+    if adapter is None or adapter.submit_batch is None or adapter.poll_batch is None:
+        raise HTTPException(status_code=500, detail=f"No batch adapter registered for provider {license_type}")
+    return adapter
+
+
+async def submit_provider_batch(license_type: str, model_name: str, requests: list) -> str:
+    """
+    Submit [(custom_id, user_query, kwargs), ...] for one model as a single
+    provider batch and return the provider's batch id.
+    """
+    adapter = _batch_adapter(license_type)
+    return await adapter.submit_batch(model_name, requests)
+
+
+async def poll_provider_batch(license_type: str, model_name: str, batch_id: str):
+    """
+    None while the provider batch is still running. Once it has finished,
+    {custom_id: ProviderResult, or an error string for requests that failed}.
+    Requests missing from the map were not processed by the provider.
+    """
+    adapter = _batch_adapter(license_type)
+    outcome = await adapter.poll_batch(batch_id)
+    if outcome is None:
+        return None
+
+    results = {}
+    for custom_id, (raw_response, error) in outcome.items():
+        if error is not None:
+            results[custom_id] = error
+            continue
+        try:
+            query_output, input_tokens, output_tokens, finish_reason = adapter.parse(raw_response)
+        except Exception as e:
+            results[custom_id] = f"Unreadable batch response: {e}"
+            continue
+        results[custom_id] = ProviderResult(
+            model_name=model_name,
+            license_type=license_type,
+            query_output=query_output,
+            input_tokens=int(input_tokens),
+            output_tokens=int(output_tokens),
+            finish_reason=finish_reason,
+            raw_response=raw_response if LLM_DEBUG_RAW_RESPONSES else None,
+        )
+    return results
@@ -0,0 +1,289 @@
+# app/machine_learning/catalog.py
+
+import threading
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.db.models import ModelMetadata
+from app.llm.registry import BATCH_PRICE_FACTOR, batch_capable
+
+
+class ModelCatalog:
+    """
+    Immutable, column-oriented snapshot of the ModelMetadata table.
+
+    Every numeric column is held as a NumPy float array (row i of each array
+    describes the same model), so routing can filter, normalize and score the
+    whole catalog with array operations instead of a Python loop over ORM rows.
+    A snapshot is never mutated after construction; refreshes build a new one
+    and swap the module-level reference.
+    """
+
+    def __init__(self, models: list):
+        self.model_name = np.array([m.model_name for m in models], dtype=object)
+        self.license = np.array([m.license for m in models], dtype=object)
+
+        self.cost = _float_column(models, "cost")
+        self.performance = _float_column(models, "performance")
+        self.latency = _float_column(models, "latency")
+        # Full-completion latency seen in live traffic, NaN until sampled;
+        # only used for timing (deadlines, hedging, queueing), never scored
+        self.observed_latency = _float_column(models, "observed_latency", default=np.nan)
+
+        self.math_score = _float_column(models, "math_score")
+        self.coding_score = _float_column(models, "coding_score")
+        self.gk_score = _float_column(models, "gk_score")
+
+        self.input_cost_raw = _float_column(models, "input_cost_raw")
+        self.output_cost_raw = _float_column(models, "output_cost_raw")
+        self.io_ratio = _float_column(models, "io_ratio", default=3.0)
+        # Rate limits stay plain Python values (None = unlimited); they are
+        # only read when building candidates
+        self.limits = [(m.max_concurrency, m.rpm_limit, m.tpm_limit) for m in models]
+        # Models reachable through a provider batch API, and the normalized
+        # cost deferred jobs see for them
+        self.batch_capable = np.fromiter((batch_capable(l) for l in self.license), dtype=bool, count=len(models))
+        self.batch_cost = np.where(self.batch_capable, self.cost * BATCH_PRICE_FACTOR, self.cost)
+
+        self.index_by_name = {name: i for i, name in enumerate(self.model_name)}
+
+        # Domain scores scaled to [0, 1] across the catalog, columns in the
+        # classifier's (math, coding, general knowledge) order
+        domains = np.column_stack([self.math_score, self.coding_score, self.gk_score])
+        if len(self):
+            lo, hi = domains.min(axis=0), domains.max(axis=0)
+            domains = np.where(hi > lo, (domains - lo) / np.where(hi > lo, hi - lo, 1.0), 0.0)
+        self.domain_norm = domains
+
+        # Per-axis sort orders and ranks: constraint filters become binary
+        # searches over the sorted values instead of scans over every model.
+        self.cost_order, self.cost_rank = _sort_order(self.cost)
+        self.perf_order, self.perf_rank = _sort_order(self.performance)
+        self.lat_order, self.lat_rank = _sort_order(self.latency)
+
+        # Pareto layers over cost, latency and performance: layer 0 is the
+        # skyline, layer 1 the skyline of what remains, and so on. Under any
+        # scoring that is monotone in these three axes, the top k models
+        # always lie within the first k layers. Routing adds terms that are
+        # not (the domain blend, the predicted cost), so it widens the pool
+        # layer by layer until the best score any deeper model could reach,
+        # from the per-layer ideal points below, falls under the k-th best.
+        objectives = np.column_stack([self.cost, self.latency, -self.performance])
+        self.layer = _pareto_layers(objectives)
+        self.layer_order, self.layer_offsets = _layer_index(self.layer)
+        self.layer_ideal = self._ideal_points(self.cost, self.layer_order, self.layer_offsets)
+        # The same layering at batch prices, for deferred jobs. cost_max is
+        # still checked against the interactive price, so that stays an axis:
+        # a model dominating one that meets the constraints must meet them too.
+        if self.batch_capable.any():
+            self.batch_layer = _pareto_layers(np.column_stack([self.batch_cost, objectives]))
+        else:
+            self.batch_layer = self.layer
+        self.batch_layer_order, self.batch_layer_offsets = _layer_index(self.batch_layer)
+        self.batch_layer_ideal = self._ideal_points(self.batch_cost, self.batch_layer_order, self.batch_layer_offsets)
+
+    def __len__(self):
+        return len(self.model_name)
+
+    def layer_count(self, batch: bool = False) -> int:
+        return len(self.batch_layer_offsets if batch else self.layer_offsets) - 1
+
+    def layer_candidates(self, depth: int, batch: bool = False) -> np.ndarray:
+        """
+        Indices of the models in the first `depth` Pareto layers, in catalog
+        order. With batch, the layers are taken at batch prices.
+        """
+        order, offsets = (
+            (self.batch_layer_order, self.batch_layer_offsets) if batch
+            else (self.layer_order, self.layer_offsets)
+        )
+        stop = offsets[min(depth, len(offsets) - 1)]
+        return np.sort(order[:stop])
+
+    def layer_suffix(self, values: np.ndarray, reduce, empty: float, batch: bool = False) -> np.ndarray:
+        """
+        Entry L is reduce (np.minimum or np.maximum) of `values`, one row per
+        model, over the models in layer L and every layer after it; the entry
+        past the last layer is `empty`.
+        """
+        order, offsets = (
+            (self.batch_layer_order, self.batch_layer_offsets) if batch
+            else (self.layer_order, self.layer_offsets)
+        )
+        return _layer_suffix(values, order, offsets, reduce, empty)
+
+    def _ideal_points(self, cost: np.ndarray, order: np.ndarray, offsets: np.ndarray):
+        # (lowest cost, highest performance, lowest latency, highest domain
+        # scores) over each layer and the layers after it
+        return (
+            _layer_suffix(cost, order, offsets, np.minimum, np.inf),
+            _layer_suffix(self.performance, order, offsets, np.maximum, -np.inf),
+            _layer_suffix(self.latency, order, offsets, np.minimum, np.inf),
+            _layer_suffix(self.domain_norm, order, offsets, np.maximum, 0.0),
+        )
+
+    def constraint_mask(self, indices: np.ndarray, cost_max=None, perf_min=None, lat_max=None) -> np.ndarray:
+        """
+        Boolean mask over `indices` of the models that satisfy the user's
+        constraints, using the per-axis ranks and a binary search per bound.
+        """
+        cost_stop, perf_start, lat_stop = self._bounds(cost_max, perf_min, lat_max)
+        return (
+            (self.cost_rank[indices] < cost_stop)
+            & (self.perf_rank[indices] >= perf_start)
+            & (self.lat_rank[indices] < lat_stop)
+        )
+
+    def worst_in_range(self, cost_max=None, perf_min=None, lat_max=None):
+        """
+        Return (max cost, min performance, max latency) over every model that
+        satisfies the constraints, or None when no model does.
+
+        The best value on each axis always sits on the skyline, but the worst
+        does not; walk each sorted axis inward from its constraint bound and
+        stop at the first model that also passes the other two bounds.
+        """
+        cost_stop, perf_start, lat_stop = self._bounds(cost_max, perf_min, lat_max)
+
+        def passes(idx):
+            return (
+                (self.cost_rank[idx] < cost_stop)
+                & (self.perf_rank[idx] >= perf_start)
+                & (self.lat_rank[idx] < lat_stop)
+            )
+
+        worst_cost = _first_passing(self.cost_order[:cost_stop][::-1], passes)
+        if worst_cost is None:
+            return None
+        worst_perf = _first_passing(self.perf_order[perf_start:], passes)
+        worst_lat = _first_passing(self.lat_order[:lat_stop][::-1], passes)
+        return self.cost[worst_cost], self.performance[worst_perf], self.latency[worst_lat]
+
+    def _bounds(self, cost_max, perf_min, lat_max):
+        n = len(self)
+        cost_stop = n if cost_max is None else np.searchsorted(self.cost[self.cost_order], cost_max, side="right")
+        perf_start = 0 if perf_min is None else np.searchsorted(self.performance[self.perf_order], perf_min, side="left")
+        lat_stop = n if lat_max is None else np.searchsorted(self.latency[self.lat_order], lat_max, side="right")
+        return cost_stop, perf_start, lat_stop
+
+    def candidate(self, i: int, final_score: float) -> dict:
+        """
+        Build the candidate dict consumed by route_with_fallback and the billing code.
+        """
+        return {
+            "model_name": self.model_name[i],
+            "license": self.license[i],
+            "final_score": float(final_score),
+            "cost": float(self.cost[i]),
+            "performance": float(self.performance[i]),
+            "latency": float(self.latency[i]),
+            "observed_latency": None if np.isnan(self.observed_latency[i]) else float(self.observed_latency[i]),
+            "math_score": float(self.math_score[i]),
+            "coding_score": float(self.coding_score[i]),
+            "gk_score": float(self.gk_score[i]),
+            "input_cost_raw": float(self.input_cost_raw[i]),
+            "output_cost_raw": float(self.output_cost_raw[i]),
+            "io_ratio": float(self.io_ratio[i]),
+            "max_concurrency": self.limits[i][0],
+            "rpm_limit": self.limits[i][1],
+            "tpm_limit": self.limits[i][2],
+            "batch_capable": bool(self.batch_capable[i]),
+        }
+
+
+def _float_column(models: list, attr: str, default: float = 0.0) -> np.ndarray:
+    values = (getattr(m, attr) for m in models)
+    return np.fromiter(
+        (default if v is None else float(v) for v in values),
+        dtype=np.float64,
+        count=len(models),
+    )
+
+
+def _sort_order(values: np.ndarray):
+    order = np.argsort(values, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return order, rank
+
+
+def _first_passing(ordered: np.ndarray, passes, block: int = 64):
+    """
+    Return the first index in `ordered` accepted by `passes`, checking it a
+    block at a time so the common case touches only a handful of models.
+    """
+    for start in range(0, len(ordered), block):
+        chunk = ordered[start:start + block]
+        hits = np.flatnonzero(passes(chunk))
+        if hits.size:
+            return chunk[hits[0]]
+    return None
+
+
+def _layer_index(layer: np.ndarray):
+    """
+    Models ordered by layer, and the offset in that order where each layer starts.
+    """
+    order = np.argsort(layer, kind="stable")
+    offsets = np.searchsorted(layer[order], np.arange(layer.max(initial=-1) + 2))
+    return order, offsets
+
+
+def _layer_suffix(values: np.ndarray, order: np.ndarray, offsets: np.ndarray, reduce, empty: float) -> np.ndarray:
+    suffix = reduce.accumulate(values[order][::-1], axis=0)[::-1]
+    pad = np.full((1,) + values.shape[1:], empty)
+    return np.concatenate([suffix, pad])[offsets]
+
+
+def _pareto_layers(objectives: np.ndarray, block: int = 512) -> np.ndarray:
+    """
+    Assign every row its non-dominated sorting layer (all columns minimized).
+    Row j dominates row i when it is no worse on every column and strictly
+    better on at least one.
+    """
+    n = len(objectives)
+    dominated_by = np.zeros((n, n), dtype=bool)
+    for start in range(0, n, block):
+        rows = objectives[start:start + block, None, :]
+        no_worse = (objectives[None, :, :] <= rows).all(axis=2)
+        better = (objectives[None, :, :] < rows).any(axis=2)
+        dominated_by[start:start + block] = no_worse & better
+
+    layer = np.full(n, -1, dtype=np.int64)
+    remaining = dominated_by.sum(axis=1)
+    current = np.flatnonzero(remaining == 0)
+    depth = 0
+    while current.size:
+        layer[current] = depth
+        remaining -= dominated_by[:, current].sum(axis=1)
+        current = np.flatnonzero((remaining == 0) & (layer < 0))
+        depth += 1
+    return layer
+
+
+_catalog = None
+_catalog_lock = threading.RLock()
+
+
+def refresh_catalog(db: Session) -> ModelCatalog:
+    """
+    Rebuild the catalog snapshot from the database and publish it atomically.
+    Call this after any commit that changes ModelMetadata.
+    """
+    global _catalog
+    with _catalog_lock:
+        catalog = ModelCatalog(db.query(ModelMetadata).all())
+        _catalog = catalog
+    print(f"Model catalog refreshed with {len(catalog)} models.")
+    return catalog
+
+
+def get_catalog(db: Session) -> ModelCatalog:
+    """
+    Return the current snapshot, building it on first use.
+    """
+    catalog = _catalog
+    if catalog is None:
+        with _catalog_lock:
+            catalog = _catalog if _catalog is not None else refresh_catalog(db)
+    return catalog
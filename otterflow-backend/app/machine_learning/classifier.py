@@ -0,0 +1,146 @@
+# app/machine_learning/classifier.py
+
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+
+# Categories the router understands; 'other' carries no domain signal
+CATEGORIES = ["math", "coding", "general knowledge", "other"]
+
+DOMAIN_SEED_PATH = os.getenv(
+    "DOMAIN_SEED_PATH", "./app/machine_learning/model_info/domain_seed.csv"
+)
+DOMAIN_CACHE_SIZE = int(os.getenv("DOMAIN_CACHE_SIZE", 4096))
+
+# Confident keyword/regex signals that skip the model entirely
+_CODING_PATTERN = re.compile(
+    r"```|\bdef \w+\(|\bclass \w+|\bimport \w+|#include|console\.log|\bfunction\s*\w*\(|=>"
+    r"|\bselect\b.+\bfrom\b|\b(python|javascript|typescript|java|c\+\+|rust|golang|sql|regex|bash"
+    r"|traceback|stack trace|compile error|segfault)\b",
+    re.IGNORECASE,
+)
+_MATH_PATTERN = re.compile(
+    r"\\frac|\\int|\\sum|\b(integral|integrate|derivative|differentiate|equation|theorem"
+    r"|polynomial|eigenvalues?|factorial|logarithm)\b|\d+\s*[\+\-\*/\^=]\s*\d+",
+    re.IGNORECASE,
+)
+_FAST_PATH_CONFIDENCE = 0.85
+
+# Must match the vectorizer's own tokenization so compiled inference agrees
+_TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+
+class DomainClassifier:
+    """
+    TF-IDF + logistic regression over word unigrams and bigrams.
+
+    scikit-learn fits the model; inference is compiled down to the
+    vocabulary, idf weights and coefficient matrix so classifying one
+    query is a dict lookup per token and a small dot product, well under
+    a millisecond.
+    """
+
+    def __init__(self, queries, labels):
+        vectorizer = TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True)
+        features = vectorizer.fit_transform(queries)
+        model = LogisticRegression(C=10, max_iter=1000).fit(features, labels)
+
+        order = [list(model.classes_).index(c) for c in CATEGORIES]
+        self.vocabulary = vectorizer.vocabulary_
+        self.idf = vectorizer.idf_
+        self.coef = model.coef_.T[:, order].copy()
+        self.intercept = model.intercept_[order].copy()
+
+    def predict(self, query: str) -> np.ndarray:
+        """
+        Probabilities in CATEGORIES order.
+        """
+        words = _TOKEN_PATTERN.findall(query.lower())
+        counts = {}
+        for gram in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            j = self.vocabulary.get(gram)
+            if j is not None:
+                counts[j] = counts.get(j, 0) + 1
+
+        logits = self.intercept.copy()
+        if counts:
+            idx = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            tf = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+            weights = (1.0 + np.log(tf)) * self.idf[idx]
+            weights /= np.linalg.norm(weights)
+            logits += weights @ self.coef[idx]
+
+        exp = np.exp(logits - logits.max())
+        return exp / exp.sum()
+
+
+_classifier = None
+_classifier_lock = threading.Lock()
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def load_domain_classifier(seed_path: str = DOMAIN_SEED_PATH) -> DomainClassifier:
+    """
+    Fit the classifier from the labelled seed CSV (columns: query, label).
+    Called once at startup; classify_query loads it lazily otherwise.
+    """
+    global _classifier
+    df = pd.read_csv(seed_path)
+    classifier = DomainClassifier(df["query"].astype(str), df["label"].astype(str))
+    with _classifier_lock:
+        _classifier = classifier
+    with _cache_lock:
+        _cache.clear()
+    print(f"Domain classifier loaded from {len(df)} seed queries.")
+    return classifier
+
+
+def _fast_path(query: str):
+    coding = _CODING_PATTERN.search(query) is not None
+    math = _MATH_PATTERN.search(query) is not None
+    if coding == math:
+        return None
+    probs = np.full(len(CATEGORIES), (1.0 - _FAST_PATH_CONFIDENCE) / (len(CATEGORIES) - 1))
+    probs[CATEGORIES.index("coding" if coding else "math")] = _FAST_PATH_CONFIDENCE
+    return probs
+
+
+def classify_query(user_query: str, memoize: bool = True) -> np.ndarray:
+    """
+    Domain probabilities for a query, in CATEGORIES order.
+
+    Results are memoized in an LRU keyed by a hash of the normalized query;
+    unambiguous keyword/regex matches skip the model. memoize=False leaves
+    the LRU alone, for bulk work over logged queries.
+    """
+    normalized = " ".join(user_query.lower().split())
+    if not memoize:
+        probs = _fast_path(normalized)
+        return probs if probs is not None else (_classifier or load_domain_classifier()).predict(normalized)
+
+    key = hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+    with _cache_lock:
+        probs = _cache.get(key)
+        if probs is not None:
+            _cache.move_to_end(key)
+            return probs
+
+    probs = _fast_path(normalized)
+    if probs is None:
+        classifier = _classifier or load_domain_classifier()
+        probs = classifier.predict(normalized)
+    probs.setflags(write=False)  # shared through the cache
+
+    with _cache_lock:
+        _cache[key] = probs
+        if len(_cache) > DOMAIN_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return probs
@@ -0,0 +1,98 @@
+# app/machine_learning/cost_estimator.py
+
+import os
+
+import numpy as np
+
+from app.llm.registry import max_output_tokens
+from app.utility.utility import cost_per_query
+from app.machine_learning.classifier import classify_query
+from app.machine_learning.length_model import predict_output_tokens
+from app.machine_learning.tokenizer_registry import count_tokens_batch
+
+# Margin added on top of the provider price of every query
+QUERY_COST_MARGIN = float(os.getenv("QUERY_COST_MARGIN", 1.15))
+# Output/input ratio for models without one, used until the output-length
+# model is trained
+DEFAULT_IO_RATIO = 3.0
+# Multiple of the io_ratio output estimate reserved before dispatch while
+# the output-length model is untrained (afterwards its upper quantile is)
+COST_RESERVE_FACTOR = float(os.getenv("COST_RESERVE_FACTOR", 3.0))
+
+
+def query_cost(candidate: dict, input_tokens: float, output_tokens: float) -> float:
+    """
+    What a query costs the user on a candidate model, margin included.
+    """
+    base_cost = cost_per_query(
+        candidate.get("input_cost_raw", 0.0), candidate.get("output_cost_raw", 0.0),
+        input_tokens, output_tokens
+    )
+    return base_cost * QUERY_COST_MARGIN
+
+
+def estimate_output_tokens(candidate: dict, input_tokens: int, domains: np.ndarray = None,
+                           upper: bool = False) -> float:
+    """
+    Expected completion length on a candidate: the output-length model's
+    prediction (see length_model.py) for a query with these classify_query
+    probabilities, or input tokens times the model's io_ratio while that
+    model is untrained.
+
+    With upper, a length to reserve for instead: the model's
+    LENGTH_MODEL_RESERVE_QUANTILE, or COST_RESERVE_FACTOR times the io_ratio
+    estimate. Either way it is capped at the most tokens the candidate's
+    adapter asks for.
+    """
+    estimate = None
+    if domains is not None:
+        predicted = predict_output_tokens([candidate["model_name"]], [input_tokens], domains[None, :], upper)
+        if predicted is not None:
+            estimate = float(predicted[0, 0])
+    if estimate is None:
+        estimate = input_tokens * (candidate.get("io_ratio") or DEFAULT_IO_RATIO)
+        if upper:
+            estimate *= COST_RESERVE_FACTOR
+    cap = max_output_tokens(candidate.get("license"))
+    return estimate if cap is None else min(estimate, cap)
+
+
+async def estimate_costs(items: list) -> list:
+    """
+    Pre-flight cost estimates for a list of (user_query, candidates) pairs,
+    without calling any model. Input tokens are counted with each
+    candidate's tokenizer, all in one count_tokens_batch call. Returns, per
+    item, a list of {"model_name", "provider", "input_tokens",
+    "output_tokens", "cost", "max_output_tokens", "max_cost"} in candidate
+    order: the expected length and cost, and the upper bound reserved.
+    """
+    pairs = [(candidate, user_query) for user_query, candidates in items for candidate in candidates]
+    counts = iter(await count_tokens_batch(pairs))
+
+    estimates = []
+    for user_query, candidates in items:
+        domains = classify_query(user_query) if candidates else None
+        item_estimates = []
+        for candidate in candidates:
+            input_tokens = next(counts)
+            output_tokens = estimate_output_tokens(candidate, input_tokens, domains)
+            max_tokens = estimate_output_tokens(candidate, input_tokens, domains, upper=True)
+            item_estimates.append({
+                "model_name": candidate["model_name"],
+                "provider": candidate.get("license"),
+                "input_tokens": input_tokens,
+                "output_tokens": round(output_tokens),
+                "cost": query_cost(candidate, input_tokens, output_tokens),
+                "max_output_tokens": round(max_tokens),
+                "max_cost": query_cost(candidate, input_tokens, max_tokens),
+            })
+        estimates.append(item_estimates)
+    return estimates
+
+
+def reservation_amount(estimates: list) -> float:
+    """
+    Funds to hold for one query: the largest max_cost among the candidates,
+    since fallback may land on any of them.
+    """
+    return max((e["max_cost"] for e in estimates), default=0.0)
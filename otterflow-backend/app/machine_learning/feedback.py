@@ -5,6 +5,7 @@ from sklearn.preprocessing import MinMaxScaler
 from app.db.models import ModelMetadata, QueryLog
 from app.db.database import SessionLocal
 from sqlalchemy.orm import Session
+from app.machine_learning.catalog import refresh_catalog
 
 def recompute_model_io_ratio(db: Session):
     """
@@ -31,4 +32,5 @@ def recompute_model_io_ratio(db: Session):
     for model in all_models:
         # Use computed ratio or default to 1.0 if no data
         model.io_ratio = ratios.get(model.model_name, 3.0)
-    db.commit()
\ No newline at end of file
+    db.commit()
+    refresh_catalog(db)
\ No newline at end of file
@@ -0,0 +1,146 @@
+# app/machine_learning/health.py
+
+import os
+import threading
+import time
+from collections import deque
+
+# A circuit opens when at least CIRCUIT_ERROR_RATE of the last CIRCUIT_WINDOW
+# calls failed (once CIRCUIT_MIN_CALLS have been seen), stays open for
+# CIRCUIT_COOLDOWN_SECONDS, then lets a single probe call through
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", 20))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", 5))
+CIRCUIT_ERROR_RATE = float(os.getenv("CIRCUIT_ERROR_RATE", 0.5))
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv("CIRCUIT_COOLDOWN_SECONDS", 30))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Closed/open/half-open breaker driven by the error rate over a window of
+    recent calls. Timeouts count as failures and are tallied separately.
+    """
+
+    def __init__(self):
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=CIRCUIT_WINDOW)  # True = success
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.failures = 0
+        self.timeouts = 0
+        self.last_error = None
+
+    def allow(self) -> bool:
+        if self.state == OPEN and time.monotonic() - self.opened_at >= CIRCUIT_COOLDOWN_SECONDS:
+            self.state = HALF_OPEN
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.probe_in_flight = False
+        if self.state == HALF_OPEN:
+            self.state = CLOSED
+            self.outcomes.clear()
+        self.outcomes.append(True)
+
+    def record_failure(self, error: str, timeout: bool = False):
+        self.probe_in_flight = False
+        self.failures += 1
+        self.timeouts += int(timeout)
+        self.last_error = error
+        self.outcomes.append(False)
+        if self.state == HALF_OPEN or self._error_rate_exceeded():
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        self.probe_in_flight = False
+
+    def _error_rate_exceeded(self) -> bool:
+        if len(self.outcomes) < CIRCUIT_MIN_CALLS:
+            return False
+        return self.outcomes.count(False) / len(self.outcomes) >= CIRCUIT_ERROR_RATE
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "recent_calls": len(self.outcomes),
+            "recent_error_rate": (self.outcomes.count(False) / len(self.outcomes)) if self.outcomes else 0.0,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "last_error": self.last_error,
+            "retry_in": (
+                max(0.0, CIRCUIT_COOLDOWN_SECONDS - (time.monotonic() - self.opened_at))
+                if self.state == OPEN else None
+            ),
+        }
+
+
+# One breaker per provider (the ModelMetadata license) and one per model
+_provider_breakers = {}
+_model_breakers = {}
+_registry_lock = threading.Lock()
+
+
+def _breakers_for(candidate: dict):
+    license_type = candidate.get("license", "Unknown")
+    model_name = candidate.get("model_name")
+    provider = _provider_breakers.get(license_type)
+    if provider is None:
+        provider = _provider_breakers[license_type] = CircuitBreaker()
+    model = _model_breakers.get(model_name)
+    if model is None:
+        model = _model_breakers[model_name] = CircuitBreaker()
+    return provider, model
+
+
+def circuit_allows(candidate: dict) -> bool:
+    """
+    Whether a call to this candidate may go out now. Must be followed by
+    exactly one record_* call for the candidate when it returns True.
+    """
+    with _registry_lock:
+        provider, model = _breakers_for(candidate)
+        if not provider.allow():
+            return False
+        if not model.allow():
+            # Give back a provider probe slot we just took
+            provider.release_probe()
+            return False
+        return True
+
+
+def record_call_success(candidate: dict):
+    with _registry_lock:
+        for breaker in _breakers_for(candidate):
+            breaker.record_success()
+
+
+def record_call_failure(candidate: dict, error: Exception, timeout: bool = False):
+    with _registry_lock:
+        for breaker in _breakers_for(candidate):
+            breaker.record_failure(str(error)[:200], timeout=timeout)
+
+
+def record_call_cancelled(candidate: dict):
+    """
+    A call was abandoned (e.g. a losing hedge): no verdict on health.
+    """
+    with _registry_lock:
+        for breaker in _breakers_for(candidate):
+            breaker.release_probe()
+
+
+def health_snapshot() -> dict:
+    with _registry_lock:
+        return {
+            "providers": {name: b.snapshot() for name, b in _provider_breakers.items()},
+            "models": {name: b.snapshot() for name, b in _model_breakers.items()},
+        }
@@ -107,3 +107,7 @@ def ingest_csv_to_db(csv_file: str, db: Session):
 
     db.commit()
     print("CSV ingestion completed.")
+
+    # Publish the new rows to the in-memory routing catalog
+    from app.machine_learning.catalog import refresh_catalog
+    refresh_catalog(db)
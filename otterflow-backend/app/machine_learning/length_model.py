@@ -0,0 +1,160 @@
+# app/machine_learning/length_model.py
+
+import os
+import time
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.db.models import QueryLog
+from app.machine_learning.classifier import CATEGORIES, classify_query
+from app.machine_learning.limits import LIMIT_CHARS_PER_TOKEN
+
+# Most recent QueryLog rows the output-length model is fitted on
+LENGTH_MODEL_MAX_ROWS = int(os.getenv("LENGTH_MODEL_MAX_ROWS", 20000))
+# Logged queries needed before predictions replace the static io_ratio
+LENGTH_MODEL_MIN_ROWS = int(os.getenv("LENGTH_MODEL_MIN_ROWS", 200))
+# Ridge penalty on the per-model terms; higher values pull models with
+# little history toward the shared fit
+LENGTH_MODEL_RIDGE = float(os.getenv("LENGTH_MODEL_RIDGE", 10.0))
+# How often the model is refitted from QueryLog
+LENGTH_MODEL_RETRAIN_SECONDS = int(os.getenv("LENGTH_MODEL_RETRAIN_SECONDS", 3600))
+# Quantile of the output length reserved on the wallet before dispatch
+LENGTH_MODEL_RESERVE_QUANTILE = float(os.getenv("LENGTH_MODEL_RESERVE_QUANTILE", 0.95))
+
+
+class LengthModel:
+    """
+    Predicts a query's output tokens on each model from its input tokens,
+    its domain probabilities (classify_query) and the model.
+
+    A log-linear ridge regression:
+
+      log(1 + out) = a + b * log(1 + in) + c . domain + a_m + b_m * log(1 + in)
+
+    where a_m and b_m are per-model offsets, penalized so models with few
+    logged queries stay close to the shared fit and models never seen get
+    exactly that. Predictions are rescaled by the mean exponentiated
+    residual (Duan's smearing) to estimate the mean rather than the median
+    length; upper predictions add the LENGTH_MODEL_RESERVE_QUANTILE
+    residual instead. Inference is a few vector operations.
+    """
+
+    def __init__(self, model_names: list, input_tokens: np.ndarray, domains: np.ndarray,
+                 output_tokens: np.ndarray):
+        self.model_index = {name: j for j, name in enumerate(sorted(set(model_names)))}
+        models = np.array([self.model_index[name] for name in model_names])
+        n, m, d = len(model_names), len(self.model_index), domains.shape[1]
+        log_in = np.log1p(input_tokens)
+        y = np.log1p(output_tokens)
+
+        # Columns: intercept, slope, domain weights, per-model intercepts, per-model slopes
+        x = np.zeros((n, 2 + d + 2 * m))
+        x[:, 0] = 1.0
+        x[:, 1] = log_in
+        x[:, 2:2 + d] = domains
+        x[np.arange(n), 2 + d + models] = 1.0
+        x[np.arange(n), 2 + d + m + models] = log_in
+
+        # Domain probabilities sum to one, so they get a light penalty to
+        # stay identifiable next to the intercept
+        penalty = np.concatenate([[0.0, 0.0], np.full(d, 1e-3), np.full(2 * m, LENGTH_MODEL_RIDGE)])
+        coef = np.linalg.solve(x.T @ x + np.diag(penalty), x.T @ y)
+
+        self.intercept, self.slope = coef[0], coef[1]
+        self.domain_coef = coef[2:2 + d]
+        self.model_intercept = coef[2 + d:2 + d + m]
+        self.model_slope = coef[2 + d + m:]
+        residuals = y - x @ coef
+        self.smearing = float(np.mean(np.exp(residuals)))
+        self.upper_residual = float(np.quantile(residuals, LENGTH_MODEL_RESERVE_QUANTILE))
+
+        predicted = np.expm1(x @ coef) * self.smearing
+        self.rows = n
+        self.mean_abs_error = float(np.mean(np.abs(predicted - output_tokens)))
+        self.trained_at = time.time()
+
+    def predict(self, model_names, input_tokens: np.ndarray, domains: np.ndarray, upper: bool = False) -> np.ndarray:
+        """
+        Expected output tokens for N queries on P models: an (N, P) matrix
+        from (N,) input token counts and (N, len(CATEGORIES)) domain
+        probabilities. With upper, the LENGTH_MODEL_RESERVE_QUANTILE of the
+        output length instead of its mean.
+        """
+        idx = np.array([self.model_index.get(name, -1) for name in model_names])
+        known = idx >= 0
+        model_intercept = np.where(known, self.model_intercept[idx], 0.0)
+        model_slope = np.where(known, self.model_slope[idx], 0.0)
+
+        log_in = np.log1p(np.asarray(input_tokens, dtype=np.float64))[:, None]
+        shared = self.intercept + domains @ self.domain_coef
+        log_out = shared[:, None] + (self.slope + model_slope) * log_in + model_intercept
+        if upper:
+            return np.maximum(np.expm1(log_out + self.upper_residual), 1.0)
+        return np.maximum(np.expm1(log_out) * self.smearing, 1.0)
+
+
+_model = None
+
+
+def estimate_input_tokens(user_query: str) -> float:
+    """
+    Rough input tokens for routing, before any tokenizer has run.
+    """
+    return max(1.0, len(user_query) / LIMIT_CHARS_PER_TOKEN)
+
+
+def predict_output_tokens(model_names, input_tokens, domains: np.ndarray, upper: bool = False):
+    """
+    (N, P) expected output tokens (with upper, their
+    LENGTH_MODEL_RESERVE_QUANTILE) for N queries, given their input tokens
+    and classify_query probabilities, on P models. None until enough
+    queries have been logged to train the model; callers fall back to the
+    models' io_ratio.
+    """
+    model = _model
+    if model is None:
+        return None
+    return model.predict(model_names, input_tokens, domains, upper)
+
+
+def train_length_model(db: Session):
+    """
+    Refit the model from the most recent LENGTH_MODEL_MAX_ROWS logged
+    queries and publish it. Keeps the previous model when there are fewer
+    than LENGTH_MODEL_MIN_ROWS usable rows. Run from the scheduler.
+    """
+    global _model
+    rows = db.query(
+        QueryLog.query_input, QueryLog.model_name, QueryLog.total_tokens, QueryLog.completion_tokens
+    ).filter(
+        QueryLog.completion_tokens > 0, QueryLog.total_tokens > QueryLog.completion_tokens
+    ).order_by(QueryLog.id.desc()).limit(LENGTH_MODEL_MAX_ROWS).all()
+    if len(rows) < LENGTH_MODEL_MIN_ROWS:
+        print(f"Output-length model not trained: {len(rows)} of {LENGTH_MODEL_MIN_ROWS} logged queries")
+        return _model
+
+    output_tokens = np.array([r.completion_tokens for r in rows], dtype=np.float64)
+    input_tokens = np.array([r.total_tokens for r in rows], dtype=np.float64) - output_tokens
+    # Classify without churning the request-path LRU
+    domains = np.stack([classify_query(r.query_input, memoize=False) for r in rows])
+    model = LengthModel([r.model_name for r in rows], input_tokens, domains, output_tokens)
+    _model = model
+    print(f"Output-length model trained on {model.rows} queries, MAE {model.mean_abs_error:.1f} tokens")
+    return model
+
+
+def length_model_stats() -> dict:
+    model = _model
+    if model is None:
+        return {"trained": False}
+    return {
+        "trained": True,
+        "rows": model.rows,
+        "models": len(model.model_index),
+        "mean_abs_error": model.mean_abs_error,
+        "reserve_quantile": LENGTH_MODEL_RESERVE_QUANTILE,
+        "reserve_factor": float(np.exp(model.upper_residual)),
+        "trained_at": model.trained_at,
+        "domains": dict(zip(CATEGORIES, model.domain_coef.tolist())),
+    }
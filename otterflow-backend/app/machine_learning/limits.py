@@ -0,0 +1,236 @@
+# app/machine_learning/limits.py
+
+import asyncio
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+
+from app.machine_learning.telemetry import completion_latency
+
+# Limits shared by every model of a provider, keyed by license, e.g.
+# PROVIDER_LIMITS='{"Groq": {"max_concurrency": 20, "rpm_limit": 30, "tpm_limit": 6000}}'.
+# Per-model limits live on ModelMetadata (max_concurrency, rpm_limit, tpm_limit).
+PROVIDER_LIMITS = json.loads(os.getenv("PROVIDER_LIMITS", "{}"))
+# Calls allowed to wait on one limiter before further calls are turned away
+LIMIT_MAX_QUEUE = int(os.getenv("LIMIT_MAX_QUEUE", 64))
+# Rough characters per token for the tokens-per-minute reservation
+LIMIT_CHARS_PER_TOKEN = 4
+
+
+class RateLimitExceeded(HTTPException):
+    """
+    Raised locally when a limiter's queue is full. Not a provider failure,
+    so circuits ignore it and the router moves on to the next candidate.
+    """
+
+    def __init__(self, detail: str):
+        super().__init__(status_code=429, detail=detail)
+
+
+class TokenBucket:
+    """
+    Continuous-refill bucket holding up to one minute's allowance.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Seconds until `amount` can be taken (requests larger than the bucket
+        only wait for a full bucket).
+        """
+        self._refill()
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    def settle(self, extra: float):
+        """
+        Charge (or refund, when negative) the difference between the
+        reservation and what the call actually used.
+        """
+        self._refill()
+        self.level = min(self.capacity, self.level - extra)
+
+
+class Limiter:
+    """
+    Concurrency semaphore plus request and token buckets for one provider or
+    model. Everything runs on the event loop thread, so checking a bucket
+    and taking from it happen without an await in between and need no lock.
+    """
+
+    def __init__(self, max_concurrency=None, rpm_limit=None, tpm_limit=None):
+        self.config = (max_concurrency, rpm_limit, tpm_limit)
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self.requests = TokenBucket(rpm_limit) if rpm_limit else None
+        self.tokens = TokenBucket(tpm_limit) if tpm_limit else None
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def _bucket_wait(self, tokens: float, queued: int = 0) -> float:
+        wait = 0.0
+        if self.requests:
+            wait = self.requests.wait_time(1 + queued)
+        if self.tokens:
+            wait = max(wait, self.tokens.wait_time(tokens * (1 + queued)))
+        return wait
+
+    def expected_wait(self, tokens: float, service_time: float) -> float:
+        """
+        Estimated queueing delay for a new call: rounds of service ahead of
+        it on the semaphore, or the bucket refill time, whichever is longer.
+        """
+        wait = self._bucket_wait(tokens, self.waiting)
+        if self.semaphore and self.in_flight + self.waiting >= self.max_concurrency:
+            rounds = (self.in_flight + self.waiting) // self.max_concurrency
+            wait = max(wait, rounds * service_time)
+        return wait
+
+    async def acquire(self, tokens: float):
+        if self.waiting >= LIMIT_MAX_QUEUE:
+            self.rejected += 1
+            raise RateLimitExceeded("Rate limiter queue is full")
+        self.waiting += 1
+        try:
+            if self.semaphore:
+                await self.semaphore.acquire()
+            try:
+                while True:
+                    wait = self._bucket_wait(tokens)
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+            except BaseException:
+                if self.semaphore:
+                    self.semaphore.release()
+                raise
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(tokens)
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    def release(self, reserved_tokens: float, used_tokens=None):
+        self.in_flight -= 1
+        if self.semaphore:
+            self.semaphore.release()
+        if self.tokens and used_tokens is not None:
+            self.tokens.settle(used_tokens - reserved_tokens)
+
+    def snapshot(self) -> dict:
+        return {
+            "max_concurrency": self.config[0],
+            "rpm_limit": self.config[1],
+            "tpm_limit": self.config[2],
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "requests_available": self.requests.level if self.requests else None,
+            "tokens_available": self.tokens.level if self.tokens else None,
+        }
+
+
+_provider_limiters = {}
+_model_limiters = {}
+
+
+def _limiter(registry: dict, key: str, config: tuple):
+    if not any(config):
+        return None
+    limiter = registry.get(key)
+    if limiter is None or limiter.config != config:
+        # New or reconfigured (e.g. edited in the admin UI); calls holding the
+        # old limiter release into it and it is dropped once they finish
+        limiter = registry[key] = Limiter(*config)
+    return limiter
+
+
+def _limiters_for(candidate: dict) -> list:
+    provider = PROVIDER_LIMITS.get(candidate.get("license"), {})
+    limiters = [
+        _limiter(_provider_limiters, candidate.get("license"), (
+            provider.get("max_concurrency"), provider.get("rpm_limit"), provider.get("tpm_limit")
+        )),
+        _limiter(_model_limiters, candidate.get("model_name"), (
+            candidate.get("max_concurrency"), candidate.get("rpm_limit"), candidate.get("tpm_limit")
+        )),
+    ]
+    return [limiter for limiter in limiters if limiter is not None]
+
+
+def estimate_tokens(candidate: dict, user_query: str) -> float:
+    """
+    Input plus expected output tokens, reserved against tokens-per-minute
+    before the call and settled against real usage afterwards.
+    """
+    input_tokens = max(1.0, len(user_query) / LIMIT_CHARS_PER_TOKEN)
+    return input_tokens * (1.0 + candidate.get("io_ratio", 3.0))
+
+
+def expected_wait(candidate: dict, user_query: str) -> float:
+    """
+    Seconds a call to this candidate would queue before it is sent.
+    """
+    limiters = _limiters_for(candidate)
+    if not limiters:
+        return 0.0
+    service_time = completion_latency(candidate) or candidate.get("latency") or 0.0
+    tokens = estimate_tokens(candidate, user_query)
+    return max(limiter.expected_wait(tokens, service_time) for limiter in limiters)
+
+
+class Reservation:
+    """
+    Handed to the caller of rate_limited; set used_tokens once the provider
+    reports usage so the token bucket is corrected.
+    """
+    __slots__ = ("tokens", "used_tokens")
+
+    def __init__(self, tokens: float):
+        self.tokens = tokens
+        self.used_tokens = None
+
+
+@asynccontextmanager
+async def rate_limited(candidate: dict, user_query: str):
+    """
+    Hold a slot on the candidate's provider and model limiters for the
+    duration of one provider call, queueing until concurrency and rate
+    limits allow it.
+    """
+    reservation = Reservation(estimate_tokens(candidate, user_query))
+    acquired = []
+    try:
+        for limiter in _limiters_for(candidate):
+            await limiter.acquire(reservation.tokens)
+            acquired.append(limiter)
+        yield reservation
+    finally:
+        for limiter in acquired:
+            limiter.release(reservation.tokens, reservation.used_tokens)
+
+
+def limits_snapshot() -> dict:
+    return {
+        "providers": {name: limiter.snapshot() for name, limiter in list(_provider_limiters.items())},
+        "models": {name: limiter.snapshot() for name, limiter in list(_model_limiters.items())},
+    }
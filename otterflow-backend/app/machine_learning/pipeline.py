@@ -1,85 +1,51 @@
 # app/machine_learning/pipeline.py
 
-import openai
-from openai import OpenAI
 import os
 import json
+import time
+import asyncio
+import dataclasses
+from contextlib import AsyncExitStack
 from fastapi import HTTPException
 from sqlalchemy.orm import Session
+import numpy as np
 
 # Import your DB model
 from app.db.models import ModelMetadata
-#Import llm function calls
-from app.llm.openai_query import handle_openai_query_async
-from app.llm.groq_query import handle_groq_query_async
-from app.llm.google_query import handle_google_query_async
-from app.llm.aimlapi_query import handle_aiml_query_async
-from app.llm.cohere_query import handle_cohere_query_async
-#####################################################
-# 1. Zero-shot classification                       #
-#####################################################
-'''
-def classify_query_zero_shot(user_query: str):
-    """
-    Perform a multi-label classification of user_query into 4 categories:
-      [ 'math', 'coding', 'general knowledge', 'other' ]
-
-    Return a dict with probabilities for each category, e.g.:
-      {"math": 0.3, "coding": 0.5, "general knowledge": 0.2, "other": 0.0}
-
-    - If the call fails, or we can't parse JSON, fallback to
-      {"math": 0.0, "coding": 0.0, "general knowledge": 0.0, "other": 1.0}.
-    - Categories may partially overlap; the sum of probabilities can be
-      <= 1, > 1, or = 1.
-    """
-    categories = ["math", "coding", "general knowledge", "other"]
-
-    prompt = f"""
-    You are a multi-label classifier. For the user query below, 
-    assign a probability (0.0 to 1.0) to each of these categories:
-    {categories}.
-
-    The sum of probabilities can be any number, because multiple
-    categories can overlap. Return valid JSON with these four keys.
-
-    Query: \"\"\"{user_query}\"\"\"
-    """
-
-    # Fallback distribution if there's any exception
-    fallback = {"math": 0.0, "coding": 0.0, "general knowledge": 0.0, "other": 0.5}
-
-    try:
-        # Create an OpenAI client. You might instead set openai.api_key directly.
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-        # Use the chat completion endpoint
-        response = openai.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.5,
-        )
-
-        # Parse the JSON returned in the message
-        content = response.choices[0].message.content.strip()
-        classification = json.loads(content)
-
-        # Ensure all 4 categories exist
-        for cat in categories:
-            if cat not in classification:
-                classification[cat] = 0.0
-
-        print(f"classification: {classification}")
-        return classification
-
-    except Exception as e:
-        print(f"[classify_query_zero_shot] Exception: {e}")
-        return fallback
-'''
-
-
+from app.machine_learning.catalog import get_catalog
+from app.machine_learning.telemetry import record_latency, completion_latency
+from app.machine_learning.classifier import classify_query
+from app.machine_learning.length_model import estimate_input_tokens, predict_output_tokens
+from app.machine_learning.semantic_cache import embed, semantic_cacheable, semantic_lookup, semantic_store
+from app.machine_learning.response_cache import cache_key, cached_response, is_deterministic, store_response
+from app.machine_learning.singleflight import SINGLEFLIGHT_ENABLED, in_flight, singleflight
+from app.machine_learning.limits import RateLimitExceeded, expected_wait, rate_limited
+from app.machine_learning.retry import (
+    RATE_LIMITED, DeadlineExceeded, RequestRejected, RetryBudget, classify_error, is_request_error,
+    is_request_specific_error, retry_delay
+)
+from app.machine_learning.health import (
+    circuit_allows, record_call_success, record_call_failure, record_call_cancelled
+)
+from app.llm.registry import BATCH_PRICE_FACTOR, ProviderResult, call_provider, get_provider
+
+# How far a confident domain classification can shift the performance term
+# away from the overall quality score toward the matching domain score
+DOMAIN_WEIGHT = float(os.getenv("DOMAIN_WEIGHT", 0.5))
+
+# Hedged requests: fire the next candidate when the current one is slower
+# than its observed HEDGE_PERCENTILE latency, sending at most HEDGE_MAX_EXTRA
+# additional requests per query
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))
+HEDGE_MAX_EXTRA = int(os.getenv("HEDGE_MAX_EXTRA", 1))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", 0.25))
+# Hedge delay for a model without LATENCY_MIN_SAMPLES live completions yet:
+# long enough that a hedge only rescues a stuck call
+HEDGE_UNSAMPLED_DELAY = float(os.getenv("HEDGE_UNSAMPLED_DELAY", 10.0))
 
 #####################################################
-# 2. Predict Model from DB                          #
+# 1. Predict Model from DB                          #
 #####################################################
 def predict_model_from_db(
     db: Session,
@@ -88,222 +54,662 @@ def predict_model_from_db(
     alpha: float = 0.33,  # cost priority
     beta: float = 0.33,   # performance priority
     gamma: float = 0.34,  # latency priority
-    top_k: int = 3
+    top_k: int = 3,
+    prefer_batch: bool = False
 ):
     """
-    1) Zero-shot classification to find domain relevance (math, coding, gk).
+    Scores run over the in-memory catalog snapshot (see catalog.py), so no
+    database round-trip happens here once the snapshot exists.
+
+    1) Local classification to find domain relevance (math, coding, gk).
     2) Filter models by user constraints (cost, performance, latency).
     3) Score each model with a multi-criteria function:
        domain_blend * base_perf + (1 - domain_blend) * domain_score => final_perf
-       cost_score = 1 - normed_cost
+       cost_score = 1 - normed_cost, where cost is the query's predicted
+       price once the output-length model is trained (see predict_models_batch)
        lat_score  = 1 - normed_latency
        perf_score = normed_final_perf
        final_score = alpha*cost_score + beta*perf_score + gamma*lat_score
-    4) Sort descending, pick top_k.
+    4) Pick top_k with argpartition, then sort only those descending.
+
+    prefer_batch routes a deferred job: batch-capable models are scored at
+    their batch price (see predict_models_batch).
     """
 
-    from app.db.models import ModelMetadata
-    from fastapi import HTTPException
+    weights = [[alpha, beta, gamma]]
+    user_queries = [user_query] if user_query else None
+    return predict_models_batch(
+        db, [user_input], weights, top_k=top_k, user_queries=user_queries, prefer_batch=prefer_batch
+    )[0]
 
-    # Retrieve all models from DB
-    all_models = db.query(ModelMetadata).all()
-    if not all_models:
-        raise HTTPException(status_code=404, detail="No models found in DB.")
 
-    # Extract constraints from user_input
-    cost_max = user_input.get("cost_max", None)
-    perf_min = user_input.get("perf_min", None)
-    lat_max = user_input.get("lat_max", None)
+def predict_models_batch(db: Session, user_inputs: list, weights, top_k: int = 3, user_queries: list = None,
+                         prefer_batch: bool = False):
+    """
+    Score N queries against the catalog at once.
+
+    `weights` is an (N, 3) array of (alpha, beta, gamma) rows, one per entry
+    of `user_inputs`. The constraint masks and normalized axis scores form
+    (N, P) matrices over the Pareto candidate pool, the weighted sum is a
+    single einsum, and top_k is an argpartition along each row. Returns one
+    candidate list per query, empty when nothing meets its constraints.
+
+    With prefer_batch (deferred jobs), the pool and the cost axis use batch
+    prices for batch-capable models, which moves them up the ranking.
+    cost_max is still checked against the interactive price.
+
+    When user_queries are given and the output-length model (length_model.py)
+    is trained, the cost axis is each query's predicted price on each model
+    (input tokens plus predicted output tokens at the model's raw prices),
+    an (N, P) matrix, instead of the catalog's static normalized cost.
+
+    Only part of the catalog is scored: the first top_k Pareto layers (see
+    catalog.py), widened a layer at a time until, for every query, the k-th
+    best score in the pool is at least the best score any model in a deeper
+    layer could reach (its layers' ideal point, with the domain term at its
+    highest). The result is the same as scoring every model. The predicted
+    cost is computed for every model, since its normalization bounds range
+    over all of them.
+    """
+    catalog = get_catalog(db)
+    if len(catalog) == 0:
+        raise HTTPException(status_code=404, detail="No models found in DB.")
 
-    # Filter models based on constraints
-    filtered = []
-    for m in all_models:
-        if cost_max is not None and m.cost > cost_max:
-            continue
-        if perf_min is not None and m.performance < perf_min:
-            continue
-        if lat_max is not None and m.latency > lat_max:
-            continue
-        filtered.append(m)
+    weights = np.asarray(weights, dtype=np.float64).reshape(-1, 3)
+    n = len(user_inputs)
+    all_models = np.arange(len(catalog))
+
+    # Per query: the constraints, and the worst value on each axis over
+    # every model that meets them (the upper normalization bounds)
+    constraints = []
+    worst = np.zeros((n, 3))
+    for row, user_input in enumerate(user_inputs):
+        bounds = (
+            user_input.get("cost_max", None),
+            user_input.get("perf_min", None),
+            user_input.get("lat_max", None),
+        )
+        worst_values = catalog.worst_in_range(*bounds)
+        # None marks a query no model can serve
+        constraints.append(None if worst_values is None else bounds)
+        if worst_values is not None:
+            worst[row] = worst_values
+
+    cost_all = catalog.batch_cost if prefer_batch else catalog.cost
+    ideal_cost, ideal_perf, ideal_lat, ideal_domain = (
+        catalog.batch_layer_ideal if prefer_batch else catalog.layer_ideal
+    )
+    relevance = None
+    domain_blend = np.ones((n, 1))
+    best_predicted = None
+    if user_queries is not None:
+        domains = np.stack([classify_query(q) for q in user_queries])
+        # final_perf = domain_blend * base_perf + (1 - domain_blend) * domain_score,
+        # where domain_score weighs the model's domain scores by the query's
+        # math/coding/gk probabilities
+        relevance = domains[:, :3]
+        mass = relevance.sum(axis=1)
+        relevance = relevance / np.where(mass > 0, mass, 1.0)[:, None]
+        domain_blend = (1.0 - DOMAIN_WEIGHT * np.clip(mass, 0.0, 1.0))[:, None]
+        predicted_cost = _predicted_query_cost(catalog, all_models, user_queries, domains, prefer_batch)
+        if predicted_cost is not None:
+            # Normalize over every model that meets each query's constraints
+            passing = np.zeros((n, len(catalog)), dtype=bool)
+            for row, bounds in enumerate(constraints):
+                if bounds is not None:
+                    passing[row] = catalog.constraint_mask(all_models, *bounds)
+            cost_all = predicted_cost
+            worst[:, 0] = np.where(passing, cost_all, -np.inf).max(axis=1, initial=0.0)
+            best_predicted = np.where(passing, cost_all, np.inf).min(axis=1, initial=np.inf)
+            ideal_cost = catalog.layer_suffix(
+                np.where(passing, cost_all, np.inf).T, np.minimum, np.inf, batch=prefer_batch
+            ).T
+
+    def score(pool):
+        """
+        (mask, final_scores, best_cost, best_perf, best_lat) over the pool:
+        (N, P) matrices, and the best value per query on each axis.
+        """
+        cost = cost_all[..., pool]
+        perf = catalog.performance[pool]
+        lat = catalog.latency[pool]
+        mask = np.zeros((n, pool.size), dtype=bool)
+        for row, bounds in enumerate(constraints):
+            if bounds is not None:
+                mask[row] = catalog.constraint_mask(pool, *bounds)
+
+        # The best value on each static axis lies on the skyline, which is
+        # always in the pool, so the lower bounds are exact. Rows with no
+        # valid model get an empty range.
+        valid = mask.any(axis=1)
+        best_cost = np.where(valid, np.where(mask, cost, np.inf).min(axis=1, initial=np.inf), 0.0)
+        if best_predicted is not None:
+            best_cost = np.where(valid, best_predicted, 0.0)
+        best_perf = np.where(valid, np.where(mask, perf, -np.inf).max(axis=1, initial=-np.inf), 0.0)
+        best_lat = np.where(valid, np.where(mask, lat, np.inf).min(axis=1, initial=np.inf), 0.0)
+
+        # We want lower cost and latency, so higher scores when these are low;
+        # higher performance scores higher
+        perf_score = _min_max_normalize(perf, worst[:, 1], best_perf)
+        if relevance is not None:
+            # An (N, 3) x (3, P) product
+            domain_score = relevance @ catalog.domain_norm[pool].T
+            perf_score = domain_blend * perf_score + (1.0 - domain_blend) * domain_score
+
+        axis_scores = np.stack([
+            1.0 - _min_max_normalize(cost, best_cost, worst[:, 0]),
+            perf_score,
+            1.0 - _min_max_normalize(lat, best_lat, worst[:, 2]),
+        ])
+
+        # Combine scores using each query's weights: (N, 3) x (3, N, P) -> (N, P)
+        final_scores = np.einsum("nk,knp->np", weights, axis_scores)
+        final_scores[~mask] = -np.inf
+        return mask, final_scores, best_cost, best_perf, best_lat
+
+    layers = catalog.layer_count(batch=prefer_batch)
+    depth = min(top_k, layers)
+    while True:
+        pool = catalog.layer_candidates(depth, batch=prefer_batch)
+        mask, final_scores, best_cost, best_perf, best_lat = score(pool)
+        if depth >= layers:
+            break
+        # The highest score a model in layer L or deeper could reach, per
+        # query and L: every term at the ideal point of those layers, each
+        # normalized term clipped to [0, 1] like a real model's
+        terms = (
+            (weights[:, :1], 1.0 - np.clip(_min_max_normalize(ideal_cost, best_cost, worst[:, 0]), 0.0, 1.0)),
+            (weights[:, 1:2] * domain_blend, np.clip(_min_max_normalize(ideal_perf, worst[:, 1], best_perf), 0.0, 1.0)),
+            (weights[:, 2:], 1.0 - np.clip(_min_max_normalize(ideal_lat, best_lat, worst[:, 2]), 0.0, 1.0)),
+        )
+        if relevance is not None:
+            terms += ((weights[:, 1:2] * (1.0 - domain_blend), relevance @ ideal_domain.T),)
+        reachable = sum(np.maximum(weight * term, 0.0) for weight, term in terms)
+        # k-th best score in the pool; -inf while fewer than top_k models qualify
+        kth = (
+            np.partition(final_scores, -top_k, axis=1)[:, -top_k] if pool.size >= top_k
+            else np.full(n, -np.inf)
+        )
+        settled = reachable[:, depth:layers] <= kth[:, None]
+        settled[[bounds is None for bounds in constraints]] = True
+        needed = np.where(settled.any(axis=1), settled.argmax(axis=1) + depth, layers).max(initial=depth)
+        if needed <= depth:
+            break
+        depth = needed
 
-    if not filtered:
-        return []
+    results = []
+    k = min(top_k, pool.size)
+    top_rows = np.argpartition(-final_scores, k - 1, axis=1)[:, :k] if k else np.zeros((n, 0), dtype=int)
+    for row in range(n):
+        # Select top_k without sorting the whole row, then order just those
+        top = np.sort(top_rows[row][mask[row, top_rows[row]]])
+        top = top[np.argsort(-final_scores[row, top], kind="stable")]
+        results.append([catalog.candidate(pool[i], final_scores[row, i]) for i in top])
+    return results
+
+
+def _predicted_query_cost(catalog, pool: np.ndarray, user_queries: list, domains: np.ndarray,
+                          prefer_batch: bool = False):
+    """
+    (N, P) predicted price of each query on each pool model, or None while
+    the output-length model is untrained.
+    """
+    input_tokens = np.array([estimate_input_tokens(q) for q in user_queries])
+    output_tokens = predict_output_tokens(catalog.model_name[pool], input_tokens, domains)
+    if output_tokens is None:
+        return None
+    price = np.where(catalog.batch_capable[pool], BATCH_PRICE_FACTOR, 1.0) if prefer_batch else 1.0
+    input_price = catalog.input_cost_raw[pool] * price
+    output_price = catalog.output_cost_raw[pool] * price
+    return (input_tokens[:, None] * input_price + output_tokens * output_price) / 1_000_000
 
-    # Compute min/max among filtered models for normalization
-    min_cost = min(m.cost for m in filtered)
-    max_cost = max(m.cost for m in filtered) or 1.0
-    min_perf = min(m.performance for m in filtered)
-    max_perf = max(m.performance for m in filtered) or 1.0
-    min_lat  = min(m.latency for m in filtered)
-    max_lat  = max(m.latency for m in filtered) or 1.0
 
-    results = []
-    for m in filtered:
-        # Normalize cost, performance, and latency scores
-        cost_norm = (m.cost - min_cost) / (max_cost - min_cost) if max_cost - min_cost != 0 else 0.0
-        # Directly use model performance since classification is removed
-        perf_norm = (m.performance - min_perf) / (max_perf - min_perf) if max_perf - min_perf != 0 else 0.0
-        lat_norm = (m.latency - min_lat) / (max_lat - min_lat) if max_lat - min_lat != 0 else 0.0
-
-        # We want lower cost and latency, so higher scores when these are low
-        cost_score = 1 - cost_norm
-        lat_score = 1 - lat_norm
-        # We want higher performance, so higher score when performance is high
-        perf_score = perf_norm
-
-        # Combine scores using user-defined weights
-        final_score = alpha * cost_score + beta * perf_score + gamma * lat_score
-
-        results.append({
-            "model_name": m.model_name,
-            "license": m.license,
-            "final_score": final_score,
-            "cost": m.cost,
-            "performance": m.performance,
-            "latency": m.latency,
-            "math_score": m.math_score,
-            "coding_score": m.coding_score,
-            "gk_score": m.gk_score,
-            "input_cost_raw": m.input_cost_raw,      # Added field
-            "output_cost_raw": m.output_cost_raw
-        })
-    print("results before sorting")
-    print(results[:top_k])
-    # Sort results by final_score in descending order
-    results.sort(key=lambda x: x["final_score"], reverse=True)
-    print("**********New results***********")
-    print(results[:top_k])
-    return results[:top_k]
+def _min_max_normalize(values: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """
+    Scale a (P,) column, or an (N, P) matrix of per-query values, into
+    [0, 1] once per query given (N,) range bounds, giving an (N, P) matrix;
+    an empty range normalizes to all zeros.
+    """
+    lo = lo[:, None]
+    span = hi[:, None] - lo
+    safe_span = np.where(span == 0, 1.0, span)
+    values = values if values.ndim == 2 else values[None, :]
+    return np.where(span == 0, 0.0, (values - lo) / safe_span)
 
 
 #####################################################
-# 3. Sending Query & Fallback Logic                 #
+# 2. Sending Query & Fallback Logic                 #
 #####################################################
-async def send_query_to_model(user_query: str, chosen_model: dict, **kwargs):
+async def send_query_to_model(user_query: str, chosen_model: dict, use_cache: bool = True, deadline: float = None, **kwargs):
     """
-    Asynchronously route the query to the correct handler based on the model's license.
+    Send the query to the chosen model through the provider registry,
+    answering deterministic (temperature 0) requests from the exact-match
+    response cache when the same query, model and sampling parameters were
+    seen before. Provider calls wait for the model's rate limiters (see
+    limits.py). Returns a ProviderResult; cached answers have cached=True.
+
+    With a deadline (a time.monotonic() value), the provider call gets
+    whatever time is left after queueing as its timeout.
     """
-    license_type = chosen_model.get("license", "Unknown")
     model_name = chosen_model.get("model_name")
+    if use_cache:
+        entry = await cached_response(user_query, model_name, **kwargs)
+        if entry is not None:
+            print(f"Response cache hit for model {model_name}")
+            return cached_result(chosen_model, entry)
+
+    async with rate_limited(chosen_model, user_query) as reservation:
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise DeadlineExceeded()
+        response = await call_provider(user_query, chosen_model, timeout=timeout, **kwargs)
+        reservation.used_tokens = response.total_tokens
+    if use_cache:
+        store_response(user_query, model_name, response, **kwargs)
+    return response
+
+
+def cached_result(candidate: dict, entry: dict, semantic: bool = False) -> ProviderResult:
+    """
+    A ProviderResult for an answer served from one of the response caches:
+    the exact-match cache, or with semantic the semantic cache.
+    """
+    return ProviderResult(
+        model_name=candidate["model_name"],
+        license_type=candidate.get("license", "Unknown"),
+        query_output=entry["query_output"],
+        input_tokens=entry["total_tokens"] - entry["completion_tokens"],
+        output_tokens=entry["completion_tokens"],
+        cached=True,
+        semantic=semantic,
+    )
+
+
+async def _send_and_record(user_query: str, candidate: dict, **kwargs):
+    """
+    Send one query, feed its provider latency (excluding any rate-limit
+    queueing) into the live telemetry and its outcome into the
+    provider/model circuit breakers.
+
+    A deterministic request identical to one already in flight (same query,
+    model and sampling parameters) awaits that call instead of making its
+    own, and gets the answer with coalesced=True; only the shared call is
+    recorded.
+    """
+    if not SINGLEFLIGHT_ENABLED or not is_deterministic(kwargs):
+        return await _call_and_record(user_query, candidate, **kwargs)
+
+    key = (
+        cache_key(user_query, candidate.get("model_name"), kwargs.get("temperature"),
+                  kwargs.get("top_p"), kwargs.get("max_tokens")),
+        kwargs.get("use_cache", True),
+    )
+    joined = in_flight(key)
+    try:
+        response = await singleflight(key, _call_and_record, user_query, candidate, **kwargs)
+    finally:
+        if joined:
+            # Give back this request's circuit slot; the shared call reports
+            record_call_cancelled(candidate)
+    return dataclasses.replace(response, coalesced=True) if joined else response
 
-    if license_type == "OpenAI":
-        try:
-            raw_response = await handle_openai_query_async(user_query, model_name, **kwargs)
-            print(type)
-            query_output = raw_response.choices[0].message.content
-            completion_tokens = int(raw_response.usage.completion_tokens)
-            total_tokens = int(raw_response.usage.total_tokens)
-
-            return {
-                "model_name": model_name,
-                "license_type": license_type,
-                "user_query": user_query,
-                "query_output": query_output,
-                "completion_tokens": completion_tokens,
-                "total_tokens": total_tokens,
-                "raw_response": raw_response
-            }
-        except Exception as e:
-            print(f"OpenAI query error: {e}")
-            raise
 
-    elif license_type == "Groq":
-        
-        try:
-            raw_response = await handle_groq_query_async(user_query, model_name, **kwargs)
-            query_output = raw_response.choices[0].message.content
-            completion_tokens = int(raw_response.usage.completion_tokens)
-            total_tokens = int(raw_response.usage.total_tokens)
-
-            return {
-                "model_name": model_name,
-                "license_type": license_type,
-                "user_query": user_query,
-                "query_output": query_output,
-                "completion_tokens": completion_tokens,
-                "total_tokens": total_tokens,
-                "raw_response": raw_response
-            }
-        except Exception as e:
-            print(f"OpenAI query error: {e}")
+async def _call_and_record(user_query: str, candidate: dict, **kwargs):
+    try:
+        response = await send_query_to_model(user_query, candidate, **kwargs)
+    except (asyncio.CancelledError, RateLimitExceeded, DeadlineExceeded):
+        record_call_cancelled(candidate)
+        raise
+    except Exception as e:
+        deadline = kwargs.get("deadline")
+        if deadline is not None and time.monotonic() >= deadline:
+            # Cut short by the query's deadline, not necessarily slow
+            record_call_cancelled(candidate)
             raise
-
-    elif license_type == "Opensource":
+        if is_request_specific_error(e) or classify_error(e) == RATE_LIMITED:
+            # Refused for this request or model, or flow control, rather
+            # than ill health
+            record_call_cancelled(candidate)
+            raise
+        timeout = isinstance(e, asyncio.TimeoutError) or getattr(e, "status_code", None) in (408, 504)
+        record_call_failure(candidate, e, timeout=timeout)
+        raise
+    if response.cached:
+        # No provider call happened, so nothing to learn about its health
+        record_call_cancelled(candidate)
+        return response
+    record_latency(candidate["model_name"], response.latency)
+    record_call_success(candidate)
+    return response
+
+
+async def _attempt(user_query: str, candidate: dict, budget: RetryBudget, **kwargs):
+    """
+    _send_and_record under the retry policy (see retry.py): transient
+    errors and provider rate limits are retried on the same candidate after
+    a jittered backoff, or the provider's Retry-After, while the candidate's
+    circuit stays closed and the wait fits in the query's budget. The first
+    try must already have passed circuit_allows. Every provider call is
+    timed out at the budget's deadline.
+    """
+    retry = 0
+    while True:
         try:
-            raw_response = await handle_aiml_query_async(user_query, model_name, **kwargs)
-            # Access the fields correctly as a dictionary
-            query_output = raw_response["choices"][0]["message"]["content"]
-            completion_tokens = raw_response["usage"]["completion_tokens"]
-            total_tokens = raw_response["usage"]["total_tokens"]
-
-            return {
-                "model_name": model_name,
-                "license_type": license_type,
-                "user_query": user_query,
-                "query_output": query_output,
-                "completion_tokens": int(completion_tokens),
-                "total_tokens": int(total_tokens),
-                "raw_response": raw_response
-            }
+            return await _send_and_record(user_query, candidate, deadline=budget.deadline, **kwargs)
         except Exception as e:
-            print(f"Opensource query error: {e}")
-            raise
+            delay = retry_delay(e, retry, budget)
+            if delay is None:
+                raise
+            error = e
+        print(f"Retrying {candidate['model_name']} in {delay:.2f}s after: {error}")
+        await budget.wait(delay)
+        retry += 1
+        if not circuit_allows(candidate):
+            raise error
 
 
-    elif license_type == "Google":
-        try:
-            raw_response = await handle_google_query_async(user_query, model_name, **kwargs)
-            query_output = raw_response._result.candidates[0].content.parts[0].text
-            completion_tokens = int(raw_response._result.usage_metadata.candidates_token_count)
-            total_tokens = int(raw_response._result.usage_metadata.total_token_count)
-            return {
-                "model_name": model_name,
-                "license_type": license_type,
-                "user_query": user_query,
-                "query_output": query_output,
-                "completion_tokens": completion_tokens,
-                "total_tokens": total_tokens,
-                "raw_response": raw_response
-            }
-        except Exception as e:
-            print(f"Google query error: {e}")
-            raise
+def _with_retry_stats(result: ProviderResult, budget: RetryBudget) -> ProviderResult:
+    return dataclasses.replace(result, retries=budget.retries, retry_wait=budget.waited)
+
+
+def hedge_delay(candidate: dict) -> float:
+    """
+    How long to wait on a candidate before firing the next one in parallel:
+    the HEDGE_PERCENTILE of its live completion times, or
+    HEDGE_UNSAMPLED_DELAY until enough have been observed. The catalog
+    latency is time to first chunk, which nearly every full completion
+    exceeds, so it would hedge almost every call.
+    """
+    observed = completion_latency(candidate, HEDGE_PERCENTILE, persisted=False)
+    delay = observed if observed is not None else HEDGE_UNSAMPLED_DELAY
+    return max(HEDGE_MIN_DELAY, delay)
 
-    elif license_type == "Cohere":
-        try:
-            raw_response = await handle_cohere_query_async(user_query, model_name, **kwargs)
-            query_output = raw_response["message"]["context"][0]["text"]
-            completion_tokens = int(raw_response["usage"]["tokens"]["output_tokens"])
-            total_tokens = int(raw_response["usage"]["tokens"]["input_tokens"]) + completion_tokens
-            return {
-                "model_name": model_name,
-                "license_type": license_type,
-                "user_query": user_query,
-                "query_output": query_output,
-                "completion_tokens": completion_tokens,
-                "total_tokens": total_tokens,
-                "raw_response": raw_response
-            }
-        except Exception as e:
-            print(f"Cohere query error: {e}")
-            raise
 
+def expected_latency(candidate: dict) -> float:
+    """
+    The candidate's observed median latency, or the catalog latency before
+    any calls have been observed.
+    """
+    observed = completion_latency(candidate)
+    return observed if observed is not None else candidate.get("latency") or 0.0
 
 
+def over_budget(user_query: str, candidate: dict, budget: RetryBudget) -> bool:
+    """
+    Whether queueing on the candidate's rate limiters plus its usual
+    latency would run past the query's deadline.
+    """
+    wait = expected_wait(candidate, user_query)
+    return wait > 0 and wait + expected_latency(candidate) > budget.remaining()
+
+
+def ensure_time_for(candidates: list, budget: RetryBudget):
+    """
+    Fail fast with DeadlineExceeded when the time left before the deadline
+    cannot fit even the fastest of the remaining candidates.
+    """
+    remaining = budget.remaining()
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    fastest = min((expected_latency(c) for c in candidates), default=0.0)
+    if fastest > remaining:
+        raise DeadlineExceeded(
+            f"{remaining:.2f}s left before the deadline, but the fastest "
+            f"remaining model usually takes {fastest:.2f}s."
+        )
+
 
-async def route_with_fallback(user_query: str, candidates: list, max_attempts=3, **kwargs):
+async def route_with_fallback(user_query: str, candidates: list, max_attempts=3, hedge: bool = None, max_hedges: int = None, latency_budget: float = None, budget: RetryBudget = None, **kwargs):
     """
     Asynchronously try multiple candidate models in descending order of score.
+
+    Each candidate is tried under the retry policy (see _attempt), and all
+    attempts share one RetryBudget whose deadline comes from latency_budget
+    (the request's deadline, seconds) or REQUEST_DEADLINE_SECONDS. Each provider
+    call is timed out at that deadline, so fallbacks only get the time left,
+    and routing stops with DeadlineExceeded once the time left cannot fit
+    the fastest remaining candidate. Other 4xx responses (e.g. a prompt
+    over one model's context window) move on to the next candidate without
+    retrying; only a refusal of the prompt itself (a content-policy
+    rejection) stops routing with RequestRejected. The result carries the
+    retries made and the time spent backing off.
+
+    With hedging (HEDGE_REQUESTS, or hedge=True), a candidate that has not
+    answered within its hedge_delay gets the next candidate fired alongside
+    it, up to max_hedges extra requests. The first successful response wins
+    and the others are cancelled, so only the winner is returned for billing
+    and logging.
+
+    Candidates whose provider or model circuit is open are skipped without
+    being tried, as are candidates whose rate-limit queue would push the
+    call past the deadline.
     """
+    budget = RetryBudget(latency_budget) if budget is None else budget
+    hedge = HEDGE_REQUESTS if hedge is None else hedge
+    if hedge:
+        max_hedges = HEDGE_MAX_EXTRA if max_hedges is None else max_hedges
+        return await _route_hedged(user_query, candidates, max_hedges, budget, **kwargs)
+
     attempts = 0
-    for candidate in candidates:
+    for position, candidate in enumerate(candidates):
+        ensure_time_for(candidates[position:], budget)
+        if over_budget(user_query, candidate, budget):
+            print(f"Skipping {candidate['model_name']}: rate-limit queue exceeds latency budget")
+            continue
+        if not circuit_allows(candidate):
+            print(f"Skipping {candidate['model_name']}: circuit open")
+            continue
         attempts += 1
         try:
-            response = await send_query_to_model(user_query, candidate, **kwargs)
-            return response
+            return _with_retry_stats(await _attempt(user_query, candidate, budget, **kwargs), budget)
         except Exception as e:
+            if is_request_error(e):
+                raise RequestRejected(e)
             print(f"Attempt {attempts} failed for model {candidate}:")
             print(e)
             continue
 
+    if attempts and budget.expired():
+        raise DeadlineExceeded()
+    if attempts == 0:
+        raise HTTPException(status_code=503, detail="All candidate providers are currently unavailable.")
+    raise HTTPException(status_code=500, detail="All candidate models failed during fallback.")
+
+
+async def route_with_semantic_cache(user_query: str, candidates: list, temperature=None, use_cache: bool = True,
+                                    user_id: int = None, top_p=None, **kwargs):
+    """
+    route_with_fallback behind the semantic response cache. A stored answer
+    to a similar query from the same user for one of the candidates (same
+    model, temperature 0, same top_p) is returned with cached=True instead
+    of calling a provider; fresh provider answers are stored for next time.
+    use_cache=False also bypasses the exact-match response cache in
+    send_query_to_model. The query is embedded once, for both the lookup
+    and the store.
+    """
+    vector = None
+    if use_cache and semantic_cacheable(temperature, user_id):
+        vector = await embed(user_query)
+    if vector is not None:
+        hit = semantic_lookup(vector, candidates, temperature, user_id, top_p)
+        if hit is not None:
+            candidate, entry = hit
+            print(f"Semantic cache hit for model {candidate['model_name']}")
+            return cached_result(candidate, entry, semantic=True)
+
+    if temperature is not None:
+        kwargs["temperature"] = temperature
+    if top_p is not None:
+        kwargs["top_p"] = top_p
+    result = await route_with_fallback(user_query, candidates, use_cache=use_cache, **kwargs)
+
+    if vector is not None and not result.cached and result.query_output:
+        candidate = next((c for c in candidates if c["model_name"] == result.model_name), None)
+        if candidate is not None:
+            semantic_store(vector, candidate, result, temperature, user_id, top_p)
+    return result
+
+
+async def _route_hedged(user_query: str, candidates: list, max_hedges: int, budget: RetryBudget, **kwargs):
+    ensure_time_for(candidates, budget)
+    remaining = [c for c in candidates if not over_budget(user_query, c, budget)]
+    in_flight = {}  # task -> candidate
+    hedges_sent = 0
+    attempts = 0
+    next_hedge_at = None
+
+    def launch():
+        nonlocal next_hedge_at, attempts
+        while remaining and not circuit_allows(remaining[0]):
+            print(f"Skipping {remaining.pop(0)['model_name']}: circuit open")
+        if not remaining:
+            return
+        candidate = remaining.pop(0)
+        attempts += 1
+        print(f"Dispatching {candidate['model_name']} ({len(in_flight)} already in flight)")
+        task = asyncio.create_task(_attempt(user_query, candidate, budget, **kwargs))
+        in_flight[task] = candidate
+        next_hedge_at = time.perf_counter() + hedge_delay(candidate)
+
+    try:
+        launch()
+        while in_flight:
+            can_hedge = bool(remaining) and hedges_sent < max_hedges
+            timeout = max(0.0, next_hedge_at - time.perf_counter()) if can_hedge else None
+            # Never wait past the deadline
+            timeout = budget.remaining() if timeout is None else min(timeout, budget.remaining())
+            done, _ = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                if budget.expired():
+                    raise DeadlineExceeded()
+                ensure_time_for(remaining, budget)
+                # The current candidate is slower than its hedge delay
+                hedges_sent += 1
+                launch()
+                continue
+
+            for task in done:
+                candidate = in_flight.pop(task)
+                try:
+                    return _with_retry_stats(task.result(), budget)
+                except Exception as e:
+                    if is_request_error(e):
+                        raise RequestRejected(e)
+                    print(f"Hedged attempt failed for model {candidate}:")
+                    print(e)
+
+            # Plain fallback once nothing is left in flight
+            if not in_flight and remaining:
+                ensure_time_for(remaining, budget)
+                launch()
+    finally:
+        for task in in_flight:
+            task.cancel()
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+    if attempts and budget.expired():
+        raise DeadlineExceeded()
+    if attempts == 0:
+        raise HTTPException(status_code=503, detail="All candidate providers are currently unavailable.")
+    raise HTTPException(status_code=500, detail="All candidate models failed during fallback.")
+
+
+#####################################################
+# 3. Streaming                                      #
+#####################################################
+async def route_stream_with_fallback(user_query: str, candidates: list, latency_budget: float = None, **kwargs):
+    """
+    Stream from the first candidate that starts producing output.
+
+    Yields (candidate, event) pairs, where event is {"delta": text} or
+    {"usage": {...}}. A candidate that fails before its first event falls
+    through to the next one, as in route_with_fallback; once output has
+    been relayed a failure propagates, since the client already has text.
+    The candidate's rate-limit slot is held until the stream ends.
+
+    The deadline (latency_budget, or REQUEST_DEADLINE_SECONDS) bounds the
+    wait for each candidate's first event; the adapters get the time left
+    as their timeout.
+    """
+    budget = RetryBudget(latency_budget)
+    attempts = 0
+    for position, candidate in enumerate(candidates):
+        adapter = get_provider(candidate.get("license"))
+        if adapter is None or adapter.stream is None:
+            continue
+        ensure_time_for(candidates[position:], budget)
+        if over_budget(user_query, candidate, budget):
+            print(f"Skipping {candidate['model_name']}: rate-limit queue exceeds latency budget")
+            continue
+        if not circuit_allows(candidate):
+            print(f"Skipping {candidate['model_name']}: circuit open")
+            continue
+
+        limits = AsyncExitStack()
+        try:
+            reservation = await limits.enter_async_context(rate_limited(candidate, user_query))
+        except BaseException as e:
+            record_call_cancelled(candidate)
+            if not isinstance(e, RateLimitExceeded):
+                raise
+            print(f"Skipping {candidate['model_name']}: {e.detail}")
+            continue
+
+        attempts += 1
+        start_time = time.perf_counter()
+        stream = adapter.stream(user_query, candidate["model_name"], timeout=budget.remaining(), **kwargs)
+        try:
+            first_event = await asyncio.wait_for(stream.__anext__(), max(budget.remaining(), 0.0))
+        except StopAsyncIteration:
+            record_call_failure(candidate, Exception("Empty stream"))
+            await limits.aclose()
+            continue
+        except asyncio.CancelledError:
+            record_call_cancelled(candidate)
+            await stream.aclose()
+            await limits.aclose()
+            raise
+        except asyncio.TimeoutError:
+            print(f"Stream attempt {attempts} for model {candidate['model_name']} hit the deadline")
+            record_call_cancelled(candidate)
+            await stream.aclose()
+            await limits.aclose()
+            continue
+        except Exception as e:
+            print(f"Stream attempt {attempts} failed for model {candidate}:")
+            print(e)
+            record_call_failure(candidate, e)
+            await stream.aclose()
+            await limits.aclose()
+            continue
+
+        try:
+            yield candidate, first_event
+            async for event in stream:
+                if "usage" in event:
+                    reservation.used_tokens = event["usage"]["total_tokens"]
+                yield candidate, event
+        except (asyncio.CancelledError, GeneratorExit):
+            # The client went away; no verdict on the provider
+            record_call_cancelled(candidate)
+            raise
+        except Exception as e:
+            record_call_failure(candidate, e)
+            raise
+        finally:
+            await stream.aclose()
+            await limits.aclose()
+
+        record_latency(candidate["model_name"], time.perf_counter() - start_time)
+        record_call_success(candidate)
+        return
+
+    if attempts and budget.expired():
+        raise DeadlineExceeded()
+    if attempts == 0:
+        raise HTTPException(status_code=503, detail="All candidate providers are currently unavailable.")
     raise HTTPException(status_code=500, detail="All candidate models failed during fallback.")
@@ -0,0 +1,213 @@
+# app/machine_learning/response_cache.py
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from app.db.database import SessionLocal
+from app.db.models import ResponseCacheEntry
+from app.utility.executors import get_executor, run_blocking
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+# Entries kept in the in-process LRU tier
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 5000))
+# Also keep entries in the response_cache table so they survive restarts
+RESPONSE_CACHE_PERSIST = os.getenv("RESPONSE_CACHE_PERSIST", "false").lower() == "true"
+# Persisted entries older than this are ignored (0 keeps them forever)
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+# Fraction of the normal price charged for an exact-match cache hit
+RESPONSE_CACHE_PRICE_FACTOR = float(os.getenv("RESPONSE_CACHE_PRICE_FACTOR", 0.1))
+
+
+def cache_key(user_query: str, model_name: str, temperature, top_p, max_tokens) -> str:
+    """
+    Hash of the whitespace-normalized query, the model and the sampling
+    parameters that change the answer.
+    """
+    normalized = " ".join(user_query.split())
+    payload = json.dumps([normalized, model_name, temperature, top_p, max_tokens])
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=20).hexdigest()
+
+
+def is_deterministic(kwargs: dict) -> bool:
+    """
+    Only temperature-0 requests are cached. Requests without an explicit
+    temperature use the adapter default, which samples.
+    """
+    temperature = kwargs.get("temperature")
+    return temperature is not None and float(temperature) == 0.0
+
+
+class ResponseCache:
+    """
+    Exact-match answers: a bounded in-memory LRU in front of an optional
+    database tier. Database reads and writes run on the response_cache
+    executor so the event loop never blocks on them.
+    """
+
+    def __init__(self, max_entries: int, persist: bool):
+        self.max_entries = max_entries
+        self.persist = persist
+        self.entries = OrderedDict()  # key -> (model_name, entry), most recent last
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    async def get(self, key: str):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return item[1]
+
+        if self.persist:
+            row = await run_blocking("response_cache", _load_entry, key)
+            if row is not None:
+                model_name, entry = row
+                with self.lock:
+                    self.persistent_hits += 1
+                self._remember(key, model_name, entry)
+                return entry
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, model_name: str, entry: dict):
+        self._remember(key, model_name, entry)
+        if self.persist:
+            # Fire and forget: the caller already has its answer
+            get_executor("response_cache").submit(_save_entry, key, model_name, entry)
+
+    def _remember(self, key: str, model_name: str, entry: dict):
+        with self.lock:
+            self.entries[key] = (model_name, entry)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def purge_model(self, model_name: str) -> dict:
+        with self.lock:
+            stale = [key for key, (name, _) in self.entries.items() if name == model_name]
+            for key in stale:
+                del self.entries[key]
+        return {
+            "memory": len(stale),
+            "persistent": _delete_model_entries(model_name) if self.persist else 0,
+        }
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.persistent_hits + self.misses
+            return {
+                "enabled": True,
+                "persistent": self.persist,
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "persistent_hits": self.persistent_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.persistent_hits) / lookups if lookups else 0.0,
+            }
+
+
+def _load_entry(key: str):
+    db = SessionLocal()
+    try:
+        row = db.query(ResponseCacheEntry).filter(ResponseCacheEntry.key == key).first()
+        if row is None:
+            return None
+        if RESPONSE_CACHE_TTL_SECONDS and row.created_at is not None:
+            created_at = row.created_at.replace(tzinfo=None)
+            if datetime.utcnow() - created_at > timedelta(seconds=RESPONSE_CACHE_TTL_SECONDS):
+                return None
+        return row.model_name, {
+            "query_output": row.query_output,
+            "completion_tokens": row.completion_tokens,
+            "total_tokens": row.total_tokens,
+        }
+    except Exception as e:
+        print(f"Response cache read failed: {e}")
+        return None
+    finally:
+        db.close()
+
+
+def _save_entry(key: str, model_name: str, entry: dict):
+    db = SessionLocal()
+    try:
+        db.merge(ResponseCacheEntry(
+            key=key,
+            model_name=model_name,
+            query_output=entry["query_output"],
+            completion_tokens=entry["completion_tokens"],
+            total_tokens=entry["total_tokens"],
+            created_at=datetime.utcnow(),
+        ))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"Response cache write failed: {e}")
+    finally:
+        db.close()
+
+
+def _delete_model_entries(model_name: str) -> int:
+    db = SessionLocal()
+    try:
+        removed = (
+            db.query(ResponseCacheEntry)
+            .filter(ResponseCacheEntry.model_name == model_name)
+            .delete(synchronize_session=False)
+        )
+        db.commit()
+        return removed
+    finally:
+        db.close()
+
+
+_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_PERSIST) if RESPONSE_CACHE_ENABLED else None
+
+
+async def cached_response(user_query: str, model_name: str, **kwargs):
+    """
+    The stored answer for this exact deterministic request, or None.
+    """
+    if _cache is None or not is_deterministic(kwargs):
+        return None
+    key = cache_key(user_query, model_name, kwargs.get("temperature"), kwargs.get("top_p"), kwargs.get("max_tokens"))
+    return await _cache.get(key)
+
+
+def store_response(user_query: str, model_name: str, result: dict, **kwargs):
+    """
+    Remember a deterministic provider answer.
+    """
+    if _cache is None or not is_deterministic(kwargs) or not result.query_output:
+        return
+    key = cache_key(user_query, model_name, kwargs.get("temperature"), kwargs.get("top_p"), kwargs.get("max_tokens"))
+    _cache.put(key, model_name, {
+        "query_output": result.query_output,
+        "completion_tokens": result.completion_tokens,
+        "total_tokens": result.total_tokens,
+    })
+
+
+def purge_response_cache(model_name: str) -> dict:
+    """
+    Drop every cached answer for a model from both tiers; returns how many
+    entries each tier removed.
+    """
+    if _cache is None:
+        return {"memory": 0, "persistent": 0}
+    return _cache.purge_model(model_name)
+
+
+def response_cache_stats() -> dict:
+    if _cache is None:
+        return {"enabled": False}
+    return _cache.stats()
@@ -0,0 +1,174 @@
+# app/machine_learning/retry.py
+
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from fastapi import HTTPException
+
+from app.machine_learning.limits import RateLimitExceeded
+
+# Retries of one candidate before the router falls back to the next
+RETRY_MAX_RETRIES = int(os.getenv("RETRY_MAX_RETRIES", 2))
+# Full-jitter exponential backoff: the n-th retry waits a random time in
+# [0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**n)] seconds
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 0.25))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 4.0))
+# Time allowed for all attempts of one query, across every candidate, when
+# the request sets no deadline
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", 60))
+
+RETRYABLE = "retryable"
+RATE_LIMITED = "rate_limited"
+PERMANENT = "permanent"
+
+# Permanent 4xx about the model or account (credentials, billing, unknown
+# model) rather than the request: not retried, and counted against the
+# candidate's circuit; the next candidate may still succeed
+MODEL_SPECIFIC_4XX = {401, 402, 403, 404}
+# Transient 4xx statuses
+RETRYABLE_CLIENT_ERRORS = {408, 409, 425}
+# Error detail fragments that identify a refusal of the prompt itself
+# (content policy), which every candidate would repeat. Other 4xx are often
+# model-specific (context window, unsupported parameters) and only end that
+# candidate's turn.
+REQUEST_ERROR_MARKERS = (
+    "content_policy_violation",
+    "content_filter",
+    "content management policy",
+    "responsible_ai_policy_violation",
+    "safety settings",
+)
+
+
+class DeadlineExceeded(HTTPException):
+    """
+    The query's time budget ran out, or is too short for any candidate
+    left, before a model answered.
+    """
+
+    def __init__(self, detail: str = "The request deadline passed before a model answered."):
+        super().__init__(status_code=504, detail=detail)
+
+
+class RequestRejected(HTTPException):
+    """
+    A provider refused the prompt itself (a content-policy rejection).
+    Every candidate would refuse it too, so routing stops.
+    """
+
+    def __init__(self, error: HTTPException):
+        super().__init__(status_code=error.status_code, detail=f"The model rejected the request: {error.detail}")
+
+
+class RetryBudget:
+    """
+    Shared by every attempt made for one query: the deadline (a
+    time.monotonic() value, from the request's deadline or
+    REQUEST_DEADLINE_SECONDS), plus the retries made and seconds spent
+    backing off (recorded on the QueryLog).
+    """
+    __slots__ = ("deadline", "retries", "waited")
+
+    def __init__(self, seconds: float = None):
+        self.deadline = time.monotonic() + (REQUEST_DEADLINE_SECONDS if seconds is None else float(seconds))
+        self.retries = 0
+        self.waited = 0.0
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    async def wait(self, delay: float):
+        self.retries += 1
+        start_time = time.monotonic()
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.waited += time.monotonic() - start_time
+
+
+def classify_error(error: Exception) -> str:
+    """
+    RATE_LIMITED for provider 429s, PERMANENT for other 4xx statuses (except
+    RETRYABLE_CLIENT_ERRORS), RETRYABLE for 5xx, timeouts and errors that
+    carry no status. Adapters raise HTTPExceptions with the provider's
+    status (see registry.provider_error).
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        return RETRYABLE
+    status = getattr(error, "status_code", None)
+    if status == 429:
+        return RATE_LIMITED
+    if isinstance(status, int) and 400 <= status < 500 and status not in RETRYABLE_CLIENT_ERRORS:
+        return PERMANENT
+    return RETRYABLE
+
+
+def is_request_specific_error(error: Exception) -> bool:
+    """
+    Whether the error is permanent for this request on this candidate but
+    says nothing about the provider's health: a 4xx outside
+    MODEL_SPECIFIC_4XX, e.g. a context window too small for the prompt or
+    a parameter the model does not accept. The router moves on to the
+    next candidate without retrying or counting it against the circuit.
+    """
+    return classify_error(error) == PERMANENT and error.status_code not in MODEL_SPECIFIC_4XX
+
+
+def is_request_error(error: Exception) -> bool:
+    """
+    Whether the error condemns the request on every candidate: only
+    prompt-level refusals recognized by REQUEST_ERROR_MARKERS.
+    """
+    if not is_request_specific_error(error):
+        return False
+    detail = str(getattr(error, "detail", "")).lower()
+    return any(marker in detail for marker in REQUEST_ERROR_MARKERS)
+
+
+def retry_after(error: Exception):
+    """
+    Seconds the provider asked us to wait (its Retry-After header, in
+    seconds or as an HTTP date), or None.
+    """
+    headers = getattr(error, "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(error: Exception, retry: int, budget: RetryBudget):
+    """
+    Seconds to wait before retrying the same candidate after `error` (the
+    retry-th retry, from 0), or None when it should not be retried: the
+    error is permanent, a local rate-limit queue is full, the candidate is
+    out of retries, or the wait would not fit in the budget.
+
+    A Retry-After hint is honoured as a minimum, with a little jitter so
+    callers that were limited together do not return together.
+    """
+    if isinstance(error, RateLimitExceeded) or classify_error(error) == PERMANENT:
+        return None
+    if retry >= RETRY_MAX_RETRIES:
+        return None
+    delay = random.uniform(0.0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** retry))
+    hint = retry_after(error)
+    if hint is not None:
+        delay = hint + random.uniform(0.0, min(RETRY_BASE_DELAY, hint * 0.1 + 0.01))
+    if delay >= budget.remaining():
+        return None
+    return delay
@@ -0,0 +1,231 @@
+# app/machine_learning/semantic_cache.py
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+
+try:
+    import faiss
+except ImportError:  # faiss-cpu is optional at runtime; without it the cache is off
+    faiss = None
+
+from app.machine_learning.response_cache import is_deterministic
+
+# Off by default: a hit answers a different, if similar, question with a
+# stored answer. Opt in only where that is acceptable.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+# How queries are embedded for the similarity search:
+#   openai:<model> - OpenAI embeddings, so paraphrases land close together
+#                    (one embeddings call per cacheable query)
+#   hashing        - local hashed word n-grams: no network, but lexical, so
+#                    only near-verbatim queries are reused
+SEMANTIC_CACHE_EMBEDDER = os.getenv("SEMANTIC_CACHE_EMBEDDER", "openai:text-embedding-3-small")
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", 1024))
+# Seconds an embeddings call may take; past that the query skips the cache
+SEMANTIC_CACHE_EMBED_TIMEOUT = float(os.getenv("SEMANTIC_CACHE_EMBED_TIMEOUT", 2.0))
+# Cosine similarity above which a stored answer is reused; depends on the
+# embedder, and the default keeps to close paraphrases
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95))
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", 3600))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 10000))
+# Nearest neighbours checked per scope, so an expired or evicted nearest
+# entry does not hide a fresh match behind it
+SEMANTIC_CACHE_SEARCH_K = int(os.getenv("SEMANTIC_CACHE_SEARCH_K", 4))
+# Fraction of the normal price charged for a semantic cache hit; exact
+# matches are priced by RESPONSE_CACHE_PRICE_FACTOR (response_cache.py)
+SEMANTIC_CACHE_PRICE_FACTOR = float(os.getenv("SEMANTIC_CACHE_PRICE_FACTOR", 0.1))
+
+# Local, stateless CPU embedder for SEMANTIC_CACHE_EMBEDDER=hashing: hashed
+# word unigrams and bigrams (digits included, so "account 123" and "account
+# 124" stay apart), L2-normalized so inner product is cosine similarity.
+_hashing = HashingVectorizer(
+    analyzer="word", ngram_range=(1, 2), token_pattern=r"(?u)\b\w+\b",
+    n_features=SEMANTIC_CACHE_DIM, alternate_sign=False, norm="l2"
+)
+
+
+async def embed(text: str):
+    """
+    The (1, SEMANTIC_CACHE_DIM) unit-length embedding of text, or None when
+    the embedder fails, in which case the query skips the cache.
+    """
+    if SEMANTIC_CACHE_EMBEDDER == "hashing":
+        return _hashing.transform([text]).toarray().astype(np.float32)
+    try:
+        # Imported here so the OpenAI SDK, like every provider SDK, loads on first use
+        from app.llm.openai_query import client as openai_client
+
+        response = await openai_client.embeddings.create(
+            model=SEMANTIC_CACHE_EMBEDDER.partition(":")[2],
+            input=text,
+            dimensions=SEMANTIC_CACHE_DIM,
+            timeout=SEMANTIC_CACHE_EMBED_TIMEOUT,
+        )
+    except Exception as e:
+        print(f"Semantic cache embedding failed: {e}")
+        return None
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)[None, :]
+    return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+
+class SemanticCache:
+    """
+    Stored model answers looked up by embedding similarity.
+
+    One faiss inner-product index per scope (provider, model, temperature,
+    top_p, user), so an answer is only reused for the same user, model and
+    sampling settings.
+    Entries expire after the TTL and the oldest are evicted once the cache
+    holds max_entries across all scopes.
+    """
+
+    def __init__(self, threshold: float, ttl: float, max_entries: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.indexes = {}          # scope -> faiss index
+        self.entries = OrderedDict()  # (scope, id) -> entry, oldest first
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, scopes: list, vector: np.ndarray):
+        """
+        Search the scopes in order; return (scope position, entry) for the
+        most similar fresh match above the threshold in the first scope
+        that has one, or None. Up to SEMANTIC_CACHE_SEARCH_K neighbours are
+        checked per scope; expired ones are dropped on the way.
+        """
+        with self.lock:
+            for position, scope in enumerate(scopes):
+                index = self.indexes.get(scope)
+                if index is None or not index.ntotal:
+                    continue
+                scores, ids = index.search(vector, min(SEMANTIC_CACHE_SEARCH_K, index.ntotal))
+                # Neighbours come most similar first
+                for score, entry_id in zip(scores[0], ids[0]):
+                    if entry_id < 0 or score < self.threshold:
+                        break
+                    key = (scope, int(entry_id))
+                    entry = self.entries.get(key)
+                    if entry is None:
+                        continue
+                    if time.monotonic() - entry["stored_at"] > self.ttl:
+                        self._remove(key)
+                        continue
+                    self.hits += 1
+                    return position, entry
+            self.misses += 1
+            return None
+
+    def store(self, scope: tuple, vector: np.ndarray, entry: dict):
+        with self.lock:
+            index = self.indexes.get(scope)
+            if index is None:
+                index = self.indexes[scope] = faiss.IndexIDMap2(faiss.IndexFlatIP(SEMANTIC_CACHE_DIM))
+            entry_id = self.next_id
+            self.next_id += 1
+            index.add_with_ids(vector, np.array([entry_id], dtype=np.int64))
+            self.entries[(scope, entry_id)] = dict(entry, stored_at=time.monotonic())
+            self._evict()
+
+    def _evict(self):
+        now = time.monotonic()
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if len(self.entries) <= self.max_entries and now - entry["stored_at"] <= self.ttl:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def _remove(self, key: tuple):
+        scope, entry_id = key
+        self.entries.pop(key, None)
+        self.indexes[scope].remove_ids(np.array([entry_id], dtype=np.int64))
+
+    def purge_model(self, model_name: str) -> int:
+        with self.lock:
+            stale = [key for key in self.entries if key[0][1] == model_name]
+            for key in stale:
+                self._remove(key)
+            return len(stale)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": True,
+                "embedder": SEMANTIC_CACHE_EMBEDDER,
+                "entries": len(self.entries),
+                "scopes": len(self.indexes),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+_cache = (
+    SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL_SECONDS, SEMANTIC_CACHE_MAX_ENTRIES)
+    if SEMANTIC_CACHE_ENABLED and faiss is not None else None
+)
+
+
+def _scope(candidate: dict, temperature, user_id, top_p=None) -> tuple:
+    return (candidate.get("license"), candidate.get("model_name"), temperature, top_p, user_id)
+
+
+def semantic_cacheable(temperature, user_id) -> bool:
+    """
+    Whether a request may use the semantic cache: answers are never shared
+    between users, and sampled answers are not worth reusing at all.
+    """
+    return _cache is not None and user_id is not None and is_deterministic({"temperature": temperature})
+
+
+def semantic_lookup(vector: np.ndarray, candidates: list, temperature=None, user_id=None, top_p=None):
+    """
+    Return (candidate, entry) for the best-ranked candidate with a cached
+    answer to a sufficiently similar query from the same user, or None.
+    vector is the query's embed() result.
+    """
+    if not semantic_cacheable(temperature, user_id):
+        return None
+    hit = _cache.lookup([_scope(c, temperature, user_id, top_p) for c in candidates], vector)
+    if hit is None:
+        return None
+    position, entry = hit
+    return candidates[position], entry
+
+
+def semantic_store(vector: np.ndarray, candidate: dict, result: dict, temperature=None, user_id=None, top_p=None):
+    """
+    Remember a provider answer for the same user's later similar queries,
+    under the query's embed() vector.
+    """
+    if not semantic_cacheable(temperature, user_id):
+        return
+    _cache.store(_scope(candidate, temperature, user_id, top_p), vector, {
+        "query_output": result.query_output,
+        "completion_tokens": result.completion_tokens,
+        "total_tokens": result.total_tokens,
+    })
+
+
+def purge_semantic_cache(model_name: str) -> int:
+    """
+    Drop every cached answer for a model; returns how many were removed.
+    """
+    return _cache.purge_model(model_name) if _cache is not None else 0
+
+
+def semantic_cache_stats() -> dict:
+    if _cache is None:
+        return {"enabled": False}
+    return _cache.stats()
@@ -0,0 +1,95 @@
+# app/machine_learning/singleflight.py
+
+import asyncio
+import os
+
+from app.machine_learning.response_cache import RESPONSE_CACHE_PRICE_FACTOR
+
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() == "true"
+# How a request that joined another request's provider call is billed:
+#   full   - the normal price, as if it had made the call itself
+#   cached - like an exact-match cache hit (RESPONSE_CACHE_PRICE_FACTOR)
+#   free   - not at all; only the request that made the call pays
+SINGLEFLIGHT_BILLING = os.getenv("SINGLEFLIGHT_BILLING", "full").lower()
+
+_PRICE_FACTORS = {"full": 1.0, "cached": RESPONSE_CACHE_PRICE_FACTOR, "free": 0.0}
+
+
+class _Flight:
+    __slots__ = ("task", "waiters", "abandoned")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+        self.abandoned = False
+
+
+_flights = {}
+_stats = {"calls": 0, "coalesced": 0, "abandoned": 0}
+
+
+def coalesced_price_factor() -> float:
+    """
+    Multiplier on the price of a request that joined an in-flight call.
+    """
+    return _PRICE_FACTORS.get(SINGLEFLIGHT_BILLING, 1.0)
+
+
+def in_flight(key) -> bool:
+    """
+    Whether a singleflight call would join an existing call for key.
+    """
+    flight = _flights.get(key)
+    return flight is not None and not flight.abandoned
+
+
+async def singleflight(key, fn, *args, **kwargs):
+    """
+    Run fn(*args, **kwargs) once per key at a time. Callers arriving while a
+    call for the same key is in flight await its result (or exception)
+    instead of making their own; check in_flight(key) first to know which
+    case applies.
+
+    The call runs in its own task and each caller awaits it through
+    asyncio.shield, so a caller being cancelled never cancels the call for
+    the others; it is cancelled only when every caller has gone away.
+    """
+    flight = _flights.get(key)
+    if not in_flight(key):
+        flight = _Flight(asyncio.create_task(fn(*args, **kwargs)))
+        _flights[key] = flight
+        flight.task.add_done_callback(lambda _, key=key, flight=flight: _forget(key, flight))
+        _stats["calls"] += 1
+    else:
+        _stats["coalesced"] += 1
+
+    flight.waiters += 1
+    try:
+        result = await asyncio.shield(flight.task)
+    except asyncio.CancelledError:
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # Nobody is left to use the answer
+            flight.abandoned = True
+            flight.task.cancel()
+            _stats["abandoned"] += 1
+        raise
+    except BaseException:
+        flight.waiters -= 1
+        raise
+    flight.waiters -= 1
+    return result
+
+
+def _forget(key, flight: _Flight):
+    if _flights.get(key) is flight:
+        del _flights[key]
+
+
+def singleflight_stats() -> dict:
+    return {
+        "enabled": SINGLEFLIGHT_ENABLED,
+        "billing": SINGLEFLIGHT_BILLING,
+        "in_flight": len(_flights),
+        **_stats,
+    }
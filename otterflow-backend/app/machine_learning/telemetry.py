@@ -0,0 +1,145 @@
+# app/machine_learning/telemetry.py
+
+import os
+import threading
+from collections import deque
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.db.models import ModelMetadata, QueryLog
+from app.machine_learning.catalog import refresh_catalog
+
+# Weight of the newest sample in the moving average
+LATENCY_EWMA_ALPHA = float(os.getenv("LATENCY_EWMA_ALPHA", 0.2))
+# Number of recent samples kept per model for percentiles
+LATENCY_WINDOW = int(os.getenv("LATENCY_WINDOW", 256))
+# Models with fewer samples than this have no observed latency yet
+LATENCY_MIN_SAMPLES = int(os.getenv("LATENCY_MIN_SAMPLES", 5))
+
+
+class LatencyTracker:
+    """
+    Rolling latency statistics for one model: an exponentially weighted
+    moving average plus a fixed-size window of recent samples from which
+    percentiles are read.
+    """
+
+    def __init__(self, alpha: float = LATENCY_EWMA_ALPHA, window: int = LATENCY_WINDOW):
+        self.alpha = alpha
+        self.samples = deque(maxlen=window)
+        self.ewma = None
+        self.count = 0
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+        if self.ewma is None:
+            self.ewma = seconds
+        else:
+            self.ewma = self.alpha * seconds + (1 - self.alpha) * self.ewma
+
+    def percentile(self, q: float):
+        if not self.samples:
+            return None
+        return float(np.percentile(np.fromiter(self.samples, dtype=np.float64), q))
+
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def record_latency(model_name: str, seconds: float):
+    """
+    Record the latency of one completed provider call.
+    """
+    with _trackers_lock:
+        tracker = _trackers.get(model_name)
+        if tracker is None:
+            tracker = _trackers[model_name] = LatencyTracker()
+        tracker.record(seconds)
+
+
+def latency_percentile(model_name: str, q: float):
+    """
+    The q-th percentile of the model's recent latencies, or None without data.
+    """
+    with _trackers_lock:
+        tracker = _trackers.get(model_name)
+        return tracker.percentile(q) if tracker else None
+
+
+def completion_latency(candidate: dict, q: float = 50, persisted: bool = True):
+    """
+    The q-th percentile of the candidate's full-completion latency: live
+    samples once there are LATENCY_MIN_SAMPLES of them, else (with
+    persisted) the persisted observed_latency (an EWMA, whatever q), else
+    None. Never the catalog latency, which measures time to first chunk.
+    """
+    with _trackers_lock:
+        tracker = _trackers.get(candidate["model_name"])
+        if tracker is not None and tracker.count >= LATENCY_MIN_SAMPLES:
+            return tracker.percentile(q)
+    return candidate.get("observed_latency") if persisted else None
+
+
+def latency_snapshot() -> dict:
+    """
+    Current EWMA, p50/p95 and sample count for every tracked model.
+    """
+    with _trackers_lock:
+        return {
+            name: {
+                "ewma": tracker.ewma,
+                "p50": tracker.percentile(50),
+                "p95": tracker.percentile(95),
+                "samples": tracker.count,
+            }
+            for name, tracker in _trackers.items()
+        }
+
+
+def seed_latency_from_logs(db: Session, limit: int = 2000):
+    """
+    Warm the trackers from the most recent QueryLog rows so a restart does
+    not lose the observed latencies. Only clean samples are used: the
+    answering provider call's own time (provider_latency, NULL for cache
+    hits and coalesced answers) on queries that needed no retries, so
+    backoff waits and time spent on failed candidates are left out.
+    """
+    rows = (
+        db.query(QueryLog.model_name, QueryLog.provider_latency)
+        .filter(
+            QueryLog.provider_latency > 0,
+            (QueryLog.retry_count.is_(None)) | (QueryLog.retry_count == 0),
+        )
+        .order_by(QueryLog.id.desc())
+        .limit(limit)
+        .all()
+    )
+    for model_name, latency in reversed(rows):
+        record_latency(model_name, float(latency))
+    print(f"Seeded latency telemetry from {len(rows)} recent query logs.")
+
+
+def persist_latency(db: Session):
+    """
+    Write each sufficiently sampled model's EWMA latency into
+    ModelMetadata.observed_latency and republish the routing catalog. The
+    CSV latency (time to first chunk) is left alone: scoring and lat_max
+    compare every model on it, sampled or not.
+    """
+    with _trackers_lock:
+        observed = {
+            name: tracker.ewma
+            for name, tracker in _trackers.items()
+            if tracker.count >= LATENCY_MIN_SAMPLES
+        }
+    if not observed:
+        return
+
+    models = db.query(ModelMetadata).filter(ModelMetadata.model_name.in_(list(observed))).all()
+    for model in models:
+        model.observed_latency = observed[model.model_name]
+    db.commit()
+    refresh_catalog(db)
@@ -0,0 +1,319 @@
+# app/machine_learning/tokenizer_registry.py
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+try:
+    from huggingface_hub import hf_hub_download
+except ImportError:
+    hf_hub_download = None
+
+from app.db.models import ModelMetadata
+from app.utility.executors import get_executor, run_blocking
+
+# Tokenizer for models without a better match, and for any model whose own
+# tokenizer fails to load. Specs are "tiktoken:<encoding>", "hf:<repo id>"
+# or a path to a tokenizer.json file. Only paths load on the request path;
+# tiktoken and hf: specs download in the background on the "tokenizer_load"
+# executor (hf: through huggingface_hub, so HF_TOKEN, HF_HUB_OFFLINE and
+# HF_HUB_DOWNLOAD_TIMEOUT apply), and counts use the fallback until then.
+TOKENIZER_FALLBACK = os.getenv(
+    "TOKENIZER_FALLBACK", "tiktoken:gpt2" if tiktoken is not None else "hf:openai-community/gpt2"
+)
+# Encoding for OpenAI models tiktoken does not know yet
+TOKENIZER_OPENAI_DEFAULT = os.getenv("TOKENIZER_OPENAI_DEFAULT", "o200k_base")
+# Per-model or per-license overrides as JSON, e.g.
+# {"Opensource": "hf:Qwen/Qwen2.5-7B-Instruct", "my-model": "/models/my-model/tokenizer.json"}
+TOKENIZER_OVERRIDES = json.loads(os.getenv("TOKENIZER_OVERRIDES", "{}"))
+
+# Hugging Face fast tokenizers for open model families, from each family's
+# official repo, matched on the model name in order (Llama 2 before the
+# Llama 3 vocabulary that 3.1-3.3 share). The meta-llama repos are gated
+# and need HF_TOKEN; without it those models count with the fallback.
+FAMILY_TOKENIZERS = (
+    ("llama-2", "hf:meta-llama/Llama-2-7b-hf"),
+    ("llama2", "hf:meta-llama/Llama-2-7b-hf"),
+    ("llama", "hf:meta-llama/Llama-3.1-8B-Instruct"),
+    ("qwen", "hf:Qwen/Qwen2.5-7B-Instruct"),
+    ("deepseek-llm", "hf:deepseek-ai/deepseek-llm-67b-chat"),
+    ("deepseek", "hf:deepseek-ai/DeepSeek-V3"),
+)
+# Spec of the byte-length estimate used while no tokenizer is loaded
+APPROXIMATE_SPEC = "approximate"
+
+# Strings up to this many characters are counted on the event loop; longer
+# ones go to the "tokenizer" executor (EXECUTOR_WORKERS_TOKENIZER workers)
+TOKEN_COUNT_INLINE_CHARS = int(os.getenv("TOKEN_COUNT_INLINE_CHARS", 2000))
+# Counts remembered per (tokenizer, content hash), so repeated prompts are
+# not tokenized again
+TOKEN_COUNT_MEMO_SIZE = int(os.getenv("TOKEN_COUNT_MEMO_SIZE", 8192))
+
+_counters = {}   # spec -> token counting function
+_failed = set()  # specs that could not be loaded
+_loading = set() # specs downloading in the background
+_models = {}     # model name -> spec
+_lock = threading.Lock()
+
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+_stats = {"inline": 0, "offloaded": 0, "memo_hits": 0, "chars": 0, "seconds": 0.0, "max_seconds": 0.0}
+
+
+def tokenizer_spec(model_name: str, license_type: str) -> str:
+    """
+    Which tokenizer counts tokens for a model: an override, tiktoken for
+    OpenAI models, a model-family tokenizer, or TOKENIZER_FALLBACK.
+    """
+    override = TOKENIZER_OVERRIDES.get(model_name) or TOKENIZER_OVERRIDES.get(license_type)
+    if override:
+        return override
+    if license_type == "OpenAI" and tiktoken is not None:
+        try:
+            return "tiktoken:" + tiktoken.encoding_name_for_model(model_name)
+        except KeyError:
+            return "tiktoken:" + TOKENIZER_OPENAI_DEFAULT
+    lowered = (model_name or "").lower()
+    for family, spec in FAMILY_TOKENIZERS:
+        if family in lowered:
+            return spec
+    return TOKENIZER_FALLBACK
+
+
+def _load(spec: str):
+    """
+    A function returning the number of tokens in a string for one spec.
+    """
+    if spec.startswith("tiktoken:"):
+        if tiktoken is None:
+            raise RuntimeError("tiktoken is not installed")
+        encoding = tiktoken.get_encoding(spec[len("tiktoken:"):])
+        return lambda text: len(encoding.encode_ordinary(text))
+
+    if Tokenizer is None:
+        raise RuntimeError("tokenizers is not installed")
+    if spec.startswith("hf:"):
+        repo_id = spec[len("hf:"):]
+        if hf_hub_download is not None:
+            tokenizer = Tokenizer.from_file(hf_hub_download(repo_id, "tokenizer.json"))
+        else:
+            tokenizer = Tokenizer.from_pretrained(repo_id, token=os.getenv("HF_TOKEN"))
+    else:
+        tokenizer = Tokenizer.from_file(spec)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def _approximate(text: str) -> int:
+    # Last resort when not even the fallback tokenizer is loaded
+    return (len(text.encode("utf-8")) + 3) // 4
+
+
+_counters[APPROXIMATE_SPEC] = _approximate
+
+
+def _is_remote(spec: str) -> bool:
+    return spec.startswith(("tiktoken:", "hf:"))
+
+
+def _load_spec(spec: str):
+    """
+    Load spec into _counters, recording it in _failed when it cannot be
+    loaded. Loading is done outside _lock, so a slow download never holds
+    up counts on tokenizers that are already loaded.
+    """
+    try:
+        counter = _load(spec)
+    except Exception as e:
+        print(f"Loading tokenizer {spec} failed: {e}")
+        counter = None
+    with _lock:
+        _loading.discard(spec)
+        if counter is None:
+            _failed.add(spec)
+        else:
+            _counters[spec] = counter
+            print(f"Loaded tokenizer {spec}")
+
+
+def _start_load(spec: str):
+    """
+    Begin loading spec unless it is loaded, failed or already loading.
+    Downloads go to the tokenizer_load executor; paths load in the caller.
+    """
+    with _lock:
+        if spec in _counters or spec in _failed or spec in _loading:
+            return
+        _loading.add(spec)
+    if _is_remote(spec):
+        get_executor("tokenizer_load").submit(_load_spec, spec)
+    else:
+        _load_spec(spec)
+
+
+def _counting_spec(spec: str) -> str:
+    """
+    The loaded spec that counts in place of spec right now: spec itself,
+    or while it loads (or when it failed) TOKENIZER_FALLBACK, then the
+    byte-length estimate.
+    """
+    if spec in _counters:
+        return spec
+    _start_load(spec)
+    if spec in _counters:
+        return spec
+    if spec == TOKENIZER_FALLBACK:
+        return APPROXIMATE_SPEC
+    return _counting_spec(TOKENIZER_FALLBACK)
+
+
+def get_tokenizer_spec(model_name: str, license_type: str = None) -> str:
+    """
+    The spec of the loaded tokenizer counting tokens for a model. Models
+    added after startup get theirs resolved on first use; until a
+    downloaded tokenizer is ready, the fallback counts for it.
+    """
+    spec = _models.get(model_name)
+    if spec is None:
+        spec = _models.setdefault(model_name, tokenizer_spec(model_name, license_type))
+    return _counting_spec(spec)
+
+
+def get_token_counter(model_name: str, license_type: str = None):
+    """
+    The token counting function for a model.
+    """
+    return _counters[get_tokenizer_spec(model_name, license_type)]
+
+
+def _memo_key(spec: str, text: str):
+    return spec, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def _memo_get(key):
+    with _memo_lock:
+        count = _memo.get(key)
+        if count is not None:
+            _memo.move_to_end(key)
+            _stats["memo_hits"] += 1
+        return count
+
+
+def _count(spec: str, texts: list, offloaded: bool = False) -> list:
+    """
+    Tokenize texts with one tokenizer, remembering the counts and the time
+    spent. Runs inline or on the tokenizer executor.
+    """
+    counter = _counters[spec]
+    start_time = time.perf_counter()
+    counts = [counter(text) for text in texts]
+    elapsed = time.perf_counter() - start_time
+    with _memo_lock:
+        for text, count in zip(texts, counts):
+            _memo[_memo_key(spec, text)] = count
+        while len(_memo) > TOKEN_COUNT_MEMO_SIZE:
+            _memo.popitem(last=False)
+        _stats["offloaded" if offloaded else "inline"] += len(texts)
+        _stats["chars"] += sum(len(text) for text in texts)
+        _stats["seconds"] += elapsed
+        _stats["max_seconds"] = max(_stats["max_seconds"], elapsed)
+    return counts
+
+
+def count_tokens(model: dict, text: str) -> int:
+    """
+    Number of tokens in text under the tokenizer of model, a candidate dict
+    with "model_name" and "license". Blocks the caller; async code should
+    use count_tokens_batch.
+    """
+    if not text:
+        return 0
+    spec = get_tokenizer_spec(model.get("model_name"), model.get("license"))
+    count = _memo_get(_memo_key(spec, text))
+    if count is None:
+        count = _count(spec, [text])[0]
+    return count
+
+
+async def count_tokens_batch(items: list) -> list:
+    """
+    Token counts for a list of (model, text) pairs, in order, without
+    blocking the event loop on long strings.
+
+    Remembered counts are reused; strings up to TOKEN_COUNT_INLINE_CHARS
+    are counted inline, since a pool round trip costs more than they do.
+    The rest are counted together, one executor job per tokenizer.
+    """
+    counts = [0] * len(items)
+    offload = {}  # spec -> [(position, text)]
+    for position, (model, text) in enumerate(items):
+        if not text:
+            continue
+        spec = get_tokenizer_spec(model.get("model_name"), model.get("license"))
+        count = _memo_get(_memo_key(spec, text))
+        if count is not None:
+            counts[position] = count
+        elif len(text) <= TOKEN_COUNT_INLINE_CHARS:
+            counts[position] = _count(spec, [text])[0]
+        else:
+            offload.setdefault(spec, []).append((position, text))
+
+    for spec, jobs in offload.items():
+        results = await run_blocking("tokenizer", _count, spec, [text for _, text in jobs], True)
+        for (position, _), count in zip(jobs, results):
+            counts[position] = count
+    return counts
+
+
+async def count_query_tokens(model: dict, user_query: str, query_output: str = None):
+    """
+    (input tokens, output tokens) for one query under the model's
+    tokenizer, counted together by count_tokens_batch.
+    """
+    input_tokens, output_tokens = await count_tokens_batch([(model, user_query), (model, query_output)])
+    return input_tokens, output_tokens
+
+
+def token_count_stats() -> dict:
+    """
+    Token counting work for the health endpoint: strings counted inline and
+    on the executor, memo hits, the time spent tokenizing, and the
+    tokenizers still loading or that failed to load.
+    """
+    with _lock:
+        loading, failed = sorted(_loading), sorted(_failed)
+    with _memo_lock:
+        counted = _stats["inline"] + _stats["offloaded"]
+        return {
+            **_stats,
+            "memo_size": len(_memo),
+            "avg_seconds": _stats["seconds"] / counted if counted else 0.0,
+            "tokenizers": {model_name: spec for model_name, spec in _models.items()},
+            "tokenizers_loading": loading,
+            "tokenizers_failed": failed,
+        }
+
+
+def load_tokenizers(db) -> int:
+    """
+    Resolve the tokenizer of every model in ModelMetadata and start loading
+    them, so requests rarely pay for a load. Called once at startup; it
+    does not wait for downloads, and each distinct tokenizer is loaded once
+    and shared. Returns the number of models.
+    """
+    rows = db.query(ModelMetadata.model_name, ModelMetadata.license).all()
+    _start_load(TOKENIZER_FALLBACK)
+    for model_name, license_type in rows:
+        get_tokenizer_spec(model_name, license_type)
+    print(f"Loading {len(set(_models.values()))} tokenizers for {len(rows)} models in the background.")
+    return len(rows)
@@ -1,10 +1,13 @@
 # app/main.py
 
 from fastapi import FastAPI, Request, HTTPException
+from contextlib import asynccontextmanager
 from fastapi.responses import RedirectResponse
 from dotenv import load_dotenv
 import os
 import sys
+import asyncio
+from datetime import datetime
 sys.path.append("../")
 
 from starlette.middleware.base import BaseHTTPMiddleware
@@ -17,6 +20,7 @@ from app.routes.auth import router as auth_router
 from app.routes.wallet import router as wallet_router
 from app.routes.api_keys import router as api_keys_router
 from app.routes.queries import router as queries_router
+from app.routes.jobs import router as jobs_router, start_job_worker
 from app.routes.model_remote import router as models_router 
 from app.routes.user_metrics import router as dashboard_router
 from app.routes.admin_auth import router as admin_router
@@ -25,17 +29,45 @@ from app.routes.admin_query_logs import router as admin_query_logs
 from app.routes.admin_models import router as admin_models
 from app.routes.admin_emails import router as admin_emails
 from app.routes.admin_users import router as admin_users
+from app.routes.admin_providers import router as admin_providers
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from apscheduler.schedulers.background import BackgroundScheduler
 from app.machine_learning.feedback import recompute_model_io_ratio
+from app.machine_learning.telemetry import persist_latency, seed_latency_from_logs
+from app.machine_learning.classifier import load_domain_classifier
+from app.machine_learning.tokenizer_registry import load_tokenizers
+from app.machine_learning.length_model import LENGTH_MODEL_RETRAIN_SECONDS, train_length_model
+from app.llm.aimlapi_query import open_aiml_client, close_aiml_client
+from app.utility.executors import shutdown_executors
+from app.metrics.stage_timing import STAGE_TIMING, StageTimingMiddleware
 # 1) Import your ingestion function
 from app.machine_learning.ingestion import ingest_csv_to_db
 # The directory for uploaded files
 upload_dir = "uploaded_avatars"
 os.makedirs(upload_dir, exist_ok=True)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Startup work runs before the first request; shared provider clients are
+    closed again on shutdown, after the deferred job worker stops.
+    """
+    scheduler = startup_event()
+    open_aiml_client()
+    job_worker = start_job_worker()
+    try:
+        yield
+    finally:
+        if job_worker is not None:
+            job_worker.cancel()
+            await asyncio.gather(job_worker, return_exceptions=True)
+        await close_aiml_client()
+        shutdown_executors()
+        if scheduler is not None:
+            scheduler.shutdown(wait=False)
+
+app = FastAPI(lifespan=lifespan)
 
 # Mount the uploaded_avatars directory
 app.mount("/uploaded_avatars", StaticFiles(directory=upload_dir), name="uploaded_avatars")
@@ -70,14 +102,45 @@ class NoCacheMiddleware(BaseHTTPMiddleware):
 # Add the NoCacheMiddleware to the application
 app.add_middleware(NoCacheMiddleware)
 
+# Outermost, so the Server-Timing total covers the whole stack
+if STAGE_TIMING:
+    app.add_middleware(StageTimingMiddleware)
+
+# How often observed latencies are written to ModelMetadata.observed_latency
+LATENCY_PERSIST_SECONDS = int(os.getenv("LATENCY_PERSIST_SECONDS", 60))
+
+def persist_live_latency():
+    db = SessionLocal()
+    try:
+        persist_latency(db)
+    except Exception as e:
+        print(f"Persisting live latency failed: {e}")
+    finally:
+        db.close()
+
+def retrain_length_model():
+    db = SessionLocal()
+    try:
+        train_length_model(db)
+    except Exception as e:
+        print(f"Training the output-length model failed: {e}")
+    finally:
+        db.close()
+
 def start_scheduler():
     scheduler = BackgroundScheduler()
     # Schedule the io_ratio recomputation every hour
     scheduler.add_job(lambda: recompute_model_io_ratio(SessionLocal()), 'interval', hours=0.01)
+    # Feed observed latency back into routing
+    scheduler.add_job(persist_live_latency, 'interval', seconds=LATENCY_PERSIST_SECONDS)
+    # Refit the output-length model that prices queries, starting right away
+    scheduler.add_job(
+        retrain_length_model, 'interval', seconds=LENGTH_MODEL_RETRAIN_SECONDS, next_run_time=datetime.now()
+    )
     scheduler.start()
+    return scheduler
 
-# 3) Ingest CSV on startup
-@app.on_event("startup")
+# 3) Ingest CSV on startup (called from the lifespan)
 def startup_event():
     """
     This function is called once when FastAPI starts.
@@ -87,15 +150,25 @@ def startup_event():
     db = SessionLocal()
     try:
         ingest_csv_to_db(csv_path, db)
+        # Restore the latencies observed before the restart
+        seed_latency_from_logs(db)
+        persist_latency(db)
+        # Start loading every model's tokenizer in the background; startup
+        # does not wait on downloads
+        load_tokenizers(db)
     finally:
         db.close()
-    
+
+    # Load the local query classifier once so routing never pays for it
+    load_domain_classifier()
+
     try:
         print("Starting scheduler for recomputing the model io ratio")
-        start_scheduler()
+        return start_scheduler()
     except Exception as e:
         print("Exception occured scheduling recompute io ratio for model data")
         print(f"Exception: {e}")
+        return None
 
 
 # Initialize session store in application state
@@ -106,6 +179,7 @@ app.include_router(auth_router)
 app.include_router(wallet_router)
 app.include_router(api_keys_router)
 app.include_router(queries_router)
+app.include_router(jobs_router)
 app.include_router(models_router)
 app.include_router(dashboard_router)
 app.include_router(admin_router)
@@ -114,6 +188,7 @@ app.include_router(admin_query_logs)
 app.include_router(admin_models)
 app.include_router(admin_emails)
 app.include_router(admin_users)
+app.include_router(admin_providers)
 # Root route
 @app.get("/")
 async def root():
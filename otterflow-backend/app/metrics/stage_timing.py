@@ -0,0 +1,66 @@
+# app/metrics/stage_timing.py
+
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Report per-stage request timings in a Server-Timing response header
+STAGE_TIMING = os.getenv("STAGE_TIMING", "false").lower() == "true"
+
+# Stage name -> seconds for the request being handled, or None outside one
+_stages = ContextVar("request_stages", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a block of request handling under `name`. A no-op unless the
+    request is being timed; repeated stages accumulate.
+    """
+    stages = _stages.get()
+    if stages is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.0) + time.perf_counter() - start_time
+
+
+def server_timing(stages: dict) -> str:
+    return ", ".join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in stages.items())
+
+
+class StageTimingMiddleware:
+    """
+    Pure ASGI middleware that gives each HTTP request a fresh stage dict
+    and returns it, plus the total, as a Server-Timing header. Streaming
+    responses only report the stages finished before the first byte.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stages = {}
+        token = _stages.set(stages)
+        start_time = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                stages["total"] = time.perf_counter() - start_time
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(stages).encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _stages.reset(token)
@@ -7,6 +7,7 @@ from app.db.database import get_db
 from app.db.models import ModelMetadata, QueryLog  # Adjust if usage stats come from QueryLog
 from app.schemas.model_schemas import ModelCreate, ModelUpdate, ModelInDB
 from app.routes.admin_auth import get_current_admin
+from app.machine_learning.catalog import refresh_catalog
 from sqlalchemy import func
 from fastapi.responses import JSONResponse
 
@@ -62,11 +63,15 @@ def create_model(
         output_cost_raw=model_data.output_cost_raw,
         top_p=model_data.top_p,
         temperature=model_data.temperature,
-        io_ratio=model_data.io_ratio
+        io_ratio=model_data.io_ratio,
+        max_concurrency=model_data.max_concurrency,
+        rpm_limit=model_data.rpm_limit,
+        tpm_limit=model_data.tpm_limit
     )
     db.add(new_model)
     db.commit()
     db.refresh(new_model)
+    refresh_catalog(db)
     return new_model
 
 @router.put("/update/{model_id}", response_model=ModelInDB)
@@ -117,8 +122,16 @@ def update_model(
     if update_data.io_ratio is not None:
         model.io_ratio = update_data.io_ratio
 
+    if update_data.max_concurrency is not None:
+        model.max_concurrency = update_data.max_concurrency
+    if update_data.rpm_limit is not None:
+        model.rpm_limit = update_data.rpm_limit
+    if update_data.tpm_limit is not None:
+        model.tpm_limit = update_data.tpm_limit
+
     db.commit()
     db.refresh(model)
+    refresh_catalog(db)
     return model
 
 @router.delete("/delete/{model_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -131,6 +144,7 @@ def delete_model(model_id: int, db: Session = Depends(get_db), admin: bool = Dep
         raise HTTPException(status_code=404, detail="Model not found.")
     db.delete(model)
     db.commit()
+    refresh_catalog(db)
     return
 
 @router.get("/usage-stats")
@@ -0,0 +1,48 @@
+# app/routes/admin_providers.py
+
+from fastapi import APIRouter, Depends
+from app.routes.admin_auth import get_current_admin
+from app.routes.admin_models import no_cache_response
+from app.machine_learning.health import health_snapshot
+from app.machine_learning.telemetry import latency_snapshot
+from app.machine_learning.semantic_cache import semantic_cache_stats, purge_semantic_cache
+from app.machine_learning.response_cache import response_cache_stats, purge_response_cache
+from app.utility.executors import executor_snapshot
+from app.machine_learning.limits import limits_snapshot
+from app.machine_learning.singleflight import singleflight_stats
+from app.machine_learning.tokenizer_registry import token_count_stats
+from app.machine_learning.length_model import length_model_stats
+
+router = APIRouter(
+    prefix="/admin/providers",
+    tags=["AdminProviders"]
+)
+
+@router.get("/health")
+def get_provider_health(admin: bool = Depends(get_current_admin)):
+    """
+    Circuit-breaker state per provider (license) and per model, plus the
+    live latency telemetry, response/semantic cache hit/miss counters, rate
+    limiter queues, the queue depth of each blocking-work executor, the
+    time spent counting tokens and the output-length model's fit, so admins
+    can see which providers are being shed.
+    """
+    health = health_snapshot()
+    health["latency"] = latency_snapshot()
+    health["response_cache"] = response_cache_stats()
+    health["semantic_cache"] = semantic_cache_stats()
+    health["executors"] = executor_snapshot()
+    health["rate_limits"] = limits_snapshot()
+    health["singleflight"] = singleflight_stats()
+    health["token_counting"] = token_count_stats()
+    health["length_model"] = length_model_stats()
+    return no_cache_response(health)
+
+@router.delete("/cache/{model_name}")
+def purge_model_cache(model_name: str, admin: bool = Depends(get_current_admin)):
+    """
+    Drop every cached answer for a model, e.g. after the provider updates it.
+    """
+    removed = purge_response_cache(model_name)
+    removed["semantic"] = purge_semantic_cache(model_name)
+    return no_cache_response({"model_name": model_name, "removed": removed})
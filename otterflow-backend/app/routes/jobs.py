@@ -0,0 +1,569 @@
+# app/routes/jobs.py
+
+import asyncio
+import json
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.responses import JSONResponse
+from sqlalchemy import func, update
+from sqlalchemy.orm import Session
+
+from app.db.database import get_db, SessionLocal
+from app.db.models import BatchJob, BatchJobItem, QueryLog
+from app.db.wallets import debit_wallet
+from app.routes.queries import (
+    get_current_user_from_cookie, parse_preferences, compute_query_cost, price_factor,
+    failure_detail, provider_latency, parse_flag, sampling_param, sampling_kwargs
+)
+from app.machine_learning.pipeline import predict_models_batch, route_with_semantic_cache
+from app.machine_learning.catalog import get_catalog
+from app.machine_learning.cost_estimator import estimate_costs, reservation_amount
+from app.llm.registry import BATCH_PRICE_FACTOR, batch_capable, submit_provider_batch, poll_provider_batch
+from app.utility.executors import run_blocking
+
+router = APIRouter(prefix="/query/jobs", tags=["Jobs"])
+
+# Largest job accepted in one submission
+JOB_MAX_ITEMS = int(os.getenv("JOB_MAX_ITEMS", 10000))
+# Queued items are sent to a model once this many are waiting for it (also
+# the most requests put in one provider batch)...
+JOB_BATCH_SIZE = int(os.getenv("JOB_BATCH_SIZE", 1000))
+# ...or once the oldest of them has waited this long
+JOB_MAX_WAIT_SECONDS = float(os.getenv("JOB_MAX_WAIT_SECONDS", 60))
+# How often the worker flushes queues and polls submitted provider batches
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", 30))
+# Items for models without a batch API run through the normal router, this many at a time
+JOB_LOCAL_CONCURRENCY = int(os.getenv("JOB_LOCAL_CONCURRENCY", 4))
+# Run the worker in this process (turn off on processes that only serve requests)
+JOB_WORKER_ENABLED = os.getenv("JOB_WORKER_ENABLED", "true").lower() == "true"
+
+# Item ids are claimed by tagging provider_batch_id before submission, so
+# two workers never send the same item
+CLAIM_PREFIX = "claim-"
+# Claims older than this are returned to the queue, for items whose worker
+# died or failed between claiming and recording the send. Keep it longer
+# than sending one JOB_BATCH_SIZE chunk takes.
+JOB_CLAIM_LEASE_SECONDS = float(os.getenv("JOB_CLAIM_LEASE_SECONDS", 3600))
+
+_wake = asyncio.Event()
+
+
+@router.post("")
+async def submit_job(request: Request, db: Session = Depends(get_db)):
+    """
+    Queue queries for deferred processing.
+
+    Body: {"queries": [{"user_query": "...", "user_input": {...}}, ...]}
+
+    Items are routed at once, preferring models with a provider batch API
+    (billed at BATCH_PRICE_FACTOR of the interactive price), and queued per
+    model. Items whose estimated maximum cost, added to those before them,
+    exceeds the balance fail at once, as in /handle_batch_query. The worker
+    sends each model's queue as one provider batch once it is
+    JOB_BATCH_SIZE long or JOB_MAX_WAIT_SECONDS old; models without a
+    batch API are run through the normal router instead. Results are billed
+    and logged in bulk as batches finish. Poll GET /query/jobs/{job_id}.
+    """
+    try:
+        data = await request.json()
+    except Exception as e:
+        print(f"JSON parsing error: {e}")
+        raise HTTPException(status_code=400, detail="Invalid JSON payload.")
+
+    items = data.get("queries")
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="Missing 'queries' list in request body.")
+    if len(items) > JOB_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"A job may contain at most {JOB_MAX_ITEMS} queries.")
+
+    user = get_current_user_from_cookie(request, db)
+    wallet = user.wallet
+    if not wallet:
+        raise HTTPException(status_code=402, detail="Insufficient balance")
+
+    job = BatchJob(id=uuid.uuid4().hex, user_id=user.id, status="pending", total_items=len(items))
+    rows = [None] * len(items)
+    valid = []  # (index, user_query, user_input, weights)
+    for i, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        user_query = item.get("user_query")
+        user_input = item.get("user_input")
+        if not user_query or not isinstance(user_input, dict):
+            rows[i] = _failed_item(job, i, item, "Each query needs 'user_query' and 'user_input'.")
+            continue
+        try:
+            _, weights = parse_preferences(user_input)
+        except (ValueError, TypeError):
+            rows[i] = _failed_item(job, i, item, "Invalid preference values.")
+            continue
+        valid.append((i, user_query, user_input, weights))
+
+    candidate_lists = predict_models_batch(
+        db,
+        [v[2] for v in valid],
+        [v[3] for v in valid],
+        top_k=3,
+        user_queries=[v[1] for v in valid],
+        prefer_batch=True
+    ) if valid else []
+
+    # Admit items while their estimated maximum costs fit the balance, the
+    # same upper bound /handle_batch_query reserves. Nothing is held: items
+    # are debited one by one as they settle (settle_job_items).
+    routed = [(v, candidates) for v, candidates in zip(valid, candidate_lists) if candidates]
+    estimates = iter(await estimate_costs([(v[1], candidates) for v, candidates in routed]))
+    db.refresh(wallet)
+    admitted = 0.0
+    for (i, user_query, user_input, _), candidates in zip(valid, candidate_lists):
+        item = {"user_query": user_query, "user_input": user_input}
+        if not candidates:
+            rows[i] = _failed_item(job, i, item,
+                                   "No models found for you requirements, please retry by changing parameters!!!")
+            continue
+        amount = reservation_amount(next(estimates))
+        if admitted + amount > wallet.balance:
+            rows[i] = _failed_item(job, i, item, "Insufficient balance to process query")
+            continue
+        admitted += amount
+        rows[i] = BatchJobItem(
+            job_id=job.id,
+            item_index=i,
+            user_query=user_query,
+            user_input=json.dumps(user_input),
+            candidates=json.dumps([c["model_name"] for c in candidates]),
+            model_name=candidates[0]["model_name"],
+            provider_name=candidates[0]["license"],
+            status="queued"
+        )
+
+    job.failed_items = sum(1 for row in rows if row.status == "failed")
+    if job.failed_items == job.total_items:
+        job.status = "completed"
+        job.completed_at = datetime.utcnow()
+    try:
+        db.add(job)
+        db.add_all(rows)
+        db.commit()
+    except Exception as e:
+        print(f"Saving job failed: {e}")
+        db.rollback()
+        raise HTTPException(status_code=500, detail="Failed to queue job")
+
+    _wake.set()
+    queued = job.total_items - job.failed_items
+    print(f"Queued job {job.id} for user {user.id}: {queued} of {job.total_items} queries")
+    return JSONResponse(status_code=202, content={
+        "job_id": job.id,
+        "status": job.status,
+        "total_items": job.total_items,
+        "queued_items": queued,
+        "failed_items": job.failed_items
+    })
+
+
+def _failed_item(job: BatchJob, index: int, item: dict, detail: str) -> BatchJobItem:
+    user_input = item.get("user_input")
+    return BatchJobItem(
+        job_id=job.id,
+        item_index=index,
+        user_query=str(item.get("user_query") or ""),
+        user_input=json.dumps(user_input if isinstance(user_input, dict) else {}),
+        candidates="[]",
+        model_name="",
+        provider_name="",
+        status="failed",
+        error=detail,
+        completed_at=datetime.utcnow()
+    )
+
+
+@router.get("/{job_id}")
+def get_job(job_id: str, request: Request, include_results: bool = True, db: Session = Depends(get_db)):
+    """
+    Progress of a job, plus per-item results (in submission order) for the
+    items that have finished. Queued and submitted items are only counted.
+    """
+    user = get_current_user_from_cookie(request, db)
+    job = db.query(BatchJob).filter(BatchJob.id == job_id, BatchJob.user_id == user.id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    counts = dict(
+        db.query(BatchJobItem.status, func.count(BatchJobItem.id))
+        .filter(BatchJobItem.job_id == job.id)
+        .group_by(BatchJobItem.status)
+        .all()
+    )
+    summary = {
+        "job_id": job.id,
+        "status": job.status,
+        "total_items": job.total_items,
+        "queued_items": counts.get("queued", 0),
+        "submitted_items": counts.get("submitted", 0),
+        "completed_items": job.completed_items,
+        "failed_items": job.failed_items,
+        "total_cost": job.total_cost,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "completed_at": job.completed_at.isoformat() if job.completed_at else None
+    }
+    if include_results:
+        finished = (
+            db.query(BatchJobItem)
+            .filter(BatchJobItem.job_id == job.id, BatchJobItem.status.in_(("completed", "failed")))
+            .order_by(BatchJobItem.item_index)
+            .all()
+        )
+        summary["results"] = [_item_result(item) for item in finished]
+    return summary
+
+
+def _item_result(item: BatchJobItem) -> dict:
+    if item.status == "failed":
+        return {"index": item.item_index, "status": "error", "detail": item.error}
+    return {
+        "index": item.item_index,
+        "status": "ok",
+        "response": item.query_output,
+        "model_used": item.model_name,
+        "provider": item.provider_name,
+        "cost": item.cost
+    }
+
+
+#####################################################
+# Worker                                            #
+#####################################################
+def start_job_worker():
+    """
+    Start the background loop that sends queued items and settles finished
+    provider batches. Returns the task (cancel it on shutdown), or None
+    when JOB_WORKER_ENABLED is off.
+    """
+    if not JOB_WORKER_ENABLED:
+        return None
+    return asyncio.create_task(run_job_worker())
+
+
+async def run_job_worker():
+    while True:
+        try:
+            await flush_queued_items()
+            await poll_submitted_batches()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Job worker cycle failed: {e}")
+        try:
+            await asyncio.wait_for(_wake.wait(), JOB_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+
+
+async def flush_queued_items():
+    """
+    Claim the queue of every model that is due and send it: one provider
+    batch per JOB_BATCH_SIZE items for batch-capable models, the normal
+    router otherwise (and for batches the provider refused).
+    """
+    requeued = await run_blocking("jobs", _requeue_expired_claims)
+    if requeued:
+        print(f"Returned {requeued} job items with expired claims to the queue")
+    for model_name, license_type, items in await run_blocking("jobs", _claim_due_items):
+        for start in range(0, len(items), JOB_BATCH_SIZE):
+            chunk = items[start:start + JOB_BATCH_SIZE]
+            item_ids = [item[0] for item in chunk]
+            if batch_capable(license_type):
+                requests = [(str(item_id), query, sampling_kwargs(user_input))
+                            for item_id, query, user_input, *_ in chunk]
+                try:
+                    batch_id = await submit_provider_batch(license_type, model_name, requests)
+                except Exception as e:
+                    print(f"Batch submission for {model_name} failed, running {len(chunk)} items directly: {e}")
+                else:
+                    try:
+                        await run_blocking("jobs", _mark_submitted, item_ids, batch_id)
+                        print(f"Submitted provider batch {batch_id}: {len(chunk)} items for {model_name}")
+                    except Exception as e:
+                        # The provider has the batch but we lost track of it;
+                        # the claims expire and the items are sent again
+                        print(f"Recording provider batch {batch_id} failed: {e}")
+                    continue
+            try:
+                await run_items_directly(chunk)
+            except Exception as e:
+                print(f"Running {len(chunk)} items for {model_name} failed, returning them to the queue: {e}")
+                await run_blocking("jobs", _release_claims, item_ids)
+
+
+def _claim_due_items() -> list:
+    """
+    [(model_name, license, [(item id, query, user_input, candidate names, user id)])]
+    for every model whose queue is full or has waited long enough. Claimed
+    items move to "submitted" under a claim tag, stamped with claimed_at,
+    until the send finishes.
+    """
+    db = SessionLocal()
+    try:
+        cutoff = datetime.utcnow() - timedelta(seconds=JOB_MAX_WAIT_SECONDS)
+        queues = (
+            db.query(BatchJobItem.model_name, func.count(BatchJobItem.id), func.min(BatchJobItem.created_at))
+            .filter(BatchJobItem.status == "queued")
+            .group_by(BatchJobItem.model_name)
+            .all()
+        )
+        due = []
+        for model_name, count, oldest in queues:
+            if count < JOB_BATCH_SIZE and oldest is not None and oldest.replace(tzinfo=None) > cutoff:
+                continue
+            claim = f"{CLAIM_PREFIX}{uuid.uuid4().hex}"
+            db.execute(
+                update(BatchJobItem)
+                .where(BatchJobItem.model_name == model_name, BatchJobItem.status == "queued")
+                .values(status="submitted", provider_batch_id=claim, claimed_at=datetime.utcnow())
+            )
+            db.commit()
+            claimed = (
+                db.query(BatchJobItem)
+                .filter(BatchJobItem.provider_batch_id == claim)
+                .order_by(BatchJobItem.id)
+                .all()
+            )
+            if not claimed:
+                continue
+            job_ids = {item.job_id for item in claimed}
+            db.query(BatchJob).filter(BatchJob.id.in_(job_ids), BatchJob.status == "pending").update(
+                {"status": "running"}, synchronize_session=False
+            )
+            db.commit()
+            owners = dict(db.query(BatchJob.id, BatchJob.user_id).filter(BatchJob.id.in_(job_ids)).all())
+            due.append((model_name, claimed[0].provider_name, [
+                (item.id, item.user_query, json.loads(item.user_input), json.loads(item.candidates),
+                 owners.get(item.job_id))
+                for item in claimed
+            ]))
+        return due
+    finally:
+        db.close()
+
+
+def _release_claims(item_ids: list, older_than: datetime = None) -> int:
+    """
+    Return claimed, unsent items to the queue: those in item_ids, or every
+    claim taken before older_than. Returns how many were released.
+    """
+    db = SessionLocal()
+    try:
+        query = db.query(BatchJobItem).filter(
+            BatchJobItem.status == "submitted", BatchJobItem.provider_batch_id.startswith(CLAIM_PREFIX)
+        )
+        if item_ids is not None:
+            query = query.filter(BatchJobItem.id.in_(item_ids))
+        if older_than is not None:
+            # Claims stamped before claimed_at existed have none
+            query = query.filter((BatchJobItem.claimed_at < older_than) | BatchJobItem.claimed_at.is_(None))
+        released = query.update(
+            {"status": "queued", "provider_batch_id": None, "claimed_at": None}, synchronize_session=False
+        )
+        db.commit()
+        return released
+    finally:
+        db.close()
+
+
+def _requeue_expired_claims() -> int:
+    return _release_claims(None, datetime.utcnow() - timedelta(seconds=JOB_CLAIM_LEASE_SECONDS))
+
+
+def _mark_submitted(item_ids: list, batch_id: str):
+    db = SessionLocal()
+    try:
+        db.query(BatchJobItem).filter(BatchJobItem.id.in_(item_ids)).update(
+            {"provider_batch_id": batch_id}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+async def run_items_directly(items: list):
+    """
+    Send claimed items through the interactive router (with its caches and
+    fallback over the item's candidates), JOB_LOCAL_CONCURRENCY at a time,
+    and settle them together. Billed at the interactive price.
+    """
+    db = SessionLocal()
+    try:
+        catalog = get_catalog(db)
+    finally:
+        db.close()
+    semaphore = asyncio.Semaphore(JOB_LOCAL_CONCURRENCY)
+
+    async def run(user_query: str, user_input: dict, names: list, user_id: int):
+        candidates = [catalog.candidate(catalog.index_by_name[name], 0.0)
+                      for name in names if name in catalog.index_by_name]
+        if not candidates:
+            raise HTTPException(status_code=500, detail="None of the routed models are available any more.")
+        async with semaphore:
+            return await route_with_semantic_cache(
+                user_query=user_query,
+                candidates=candidates,
+                temperature=sampling_param(user_input, "temperature"),
+                top_p=sampling_param(user_input, "top_p"),
+                use_cache=parse_flag(user_input, "cache", True),
+                user_id=user_id
+            )
+
+    outcomes = await asyncio.gather(
+        *(run(query, user_input, names, user_id) for _, query, user_input, names, user_id in items),
+        return_exceptions=True
+    )
+    settled = []
+    for (item_id, *_), outcome in zip(items, outcomes):
+        if isinstance(outcome, BaseException):
+            print(f"Job item {item_id} failed: {outcome}")
+            settled.append((item_id, failure_detail(outcome), 1.0, None))
+        else:
+            settled.append((item_id, outcome, price_factor(outcome), outcome.latency))
+    await run_blocking("jobs", settle_job_items, settled)
+
+
+async def poll_submitted_batches():
+    """
+    Check every provider batch with items outstanding and settle the ones
+    that have finished.
+    """
+    for batch_id, model_name, license_type in await run_blocking("jobs", _submitted_batches):
+        try:
+            results = await poll_provider_batch(license_type, model_name, batch_id)
+        except Exception as e:
+            print(f"Polling provider batch {batch_id} failed: {e}")
+            continue
+        if results is None:
+            continue
+        item_ids = await run_blocking("jobs", _batch_item_ids, batch_id)
+        settled = [
+            (item_id, results.get(str(item_id), "Not processed by the provider batch"), BATCH_PRICE_FACTOR, None)
+            for item_id in item_ids
+        ]
+        await run_blocking("jobs", settle_job_items, settled)
+        print(f"Provider batch {batch_id} finished: {len(settled)} items settled")
+
+
+def _submitted_batches() -> list:
+    db = SessionLocal()
+    try:
+        return (
+            db.query(BatchJobItem.provider_batch_id, BatchJobItem.model_name, BatchJobItem.provider_name)
+            .filter(BatchJobItem.status == "submitted", ~BatchJobItem.provider_batch_id.startswith(CLAIM_PREFIX))
+            .distinct()
+            .all()
+        )
+    finally:
+        db.close()
+
+
+def _batch_item_ids(batch_id: str) -> list:
+    db = SessionLocal()
+    try:
+        rows = db.query(BatchJobItem.id).filter(
+            BatchJobItem.provider_batch_id == batch_id, BatchJobItem.status == "submitted"
+        ).all()
+        return [item_id for (item_id,) in rows]
+    finally:
+        db.close()
+
+
+def settle_job_items(settled: list):
+    """
+    Bill and log finished items in one transaction. `settled` holds
+    (item id, ProviderResult or error detail, price factor, latency) tuples.
+
+    Each item is debited with one conditional UPDATE (debit_wallet); items
+    the balance no longer covers fail unbilled, as in /handle_batch_query.
+    QueryLog rows are inserted together, and the owning jobs' counters are
+    updated (and the jobs closed when nothing is left outstanding).
+    """
+    if not settled:
+        return
+    db = SessionLocal()
+    try:
+        items = {item.id: item for item in db.query(BatchJobItem).filter(
+            BatchJobItem.id.in_([s[0] for s in settled]), BatchJobItem.status == "submitted"
+        ).all()}
+        jobs = {job.id: job for job in db.query(BatchJob).filter(
+            BatchJob.id.in_({item.job_id for item in items.values()})
+        ).all()}
+        catalog = get_catalog(db)
+        now = datetime.utcnow()
+        logs = []
+
+        for item_id, outcome, factor, latency in settled:
+            item = items.get(item_id)
+            if item is None:
+                continue  # Already settled elsewhere
+            job = jobs[item.job_id]
+            item.completed_at = now
+            index = catalog.index_by_name.get(getattr(outcome, "model_name", None))
+            if isinstance(outcome, str) or not outcome.query_output or index is None:
+                item.status = "failed"
+                item.error = outcome if isinstance(outcome, str) else "Received empty response from model."
+                job.failed_items += 1
+                continue
+
+            cost = compute_query_cost(
+                catalog.candidate(index, 0.0), item.user_query, outcome.query_output,
+                outcome.input_tokens, outcome.output_tokens
+            ) * factor
+            if debit_wallet(db, job.user_id, cost) is None:
+                item.status = "failed"
+                item.error = "Insufficient balance to process query"
+                job.failed_items += 1
+                continue
+
+            item.status = "completed"
+            item.model_name = outcome.model_name
+            item.provider_name = outcome.license_type
+            item.query_output = outcome.query_output
+            item.completion_tokens = outcome.completion_tokens
+            item.total_tokens = outcome.total_tokens
+            item.cost = cost
+            job.completed_items += 1
+            job.total_cost += cost
+
+            priorities, _ = parse_preferences(json.loads(item.user_input))
+            cost_priority, accuracy_priority, latency_priority = priorities
+            logs.append(QueryLog(
+                user_id=job.user_id,
+                chat_topic="job",
+                query_input=item.user_query,
+                query_output=outcome.query_output,
+                model_name=outcome.model_name,
+                provider_name=outcome.license_type,
+                completion_tokens=outcome.completion_tokens,
+                total_tokens=outcome.total_tokens,
+                latency=latency,
+                provider_latency=provider_latency(outcome) if latency is not None else None,
+                retry_count=outcome.retries,
+                retry_wait=outcome.retry_wait,
+                cost=cost,
+                cost_preference=int(cost_priority),
+                latency_preference=int(latency_priority),
+                performance_preference=int(accuracy_priority)
+            ))
+
+        for job in jobs.values():
+            if job.completed_items + job.failed_items >= job.total_items:
+                job.status = "completed"
+                job.completed_at = now
+        db.add_all(logs)
+        db.commit()
+    except Exception as e:
+        print(f"Settling job items failed: {e}")
+        db.rollback()
+        raise
+    finally:
+        db.close()
@@ -1,18 +1,31 @@
 from fastapi import APIRouter, HTTPException, Depends, Request, BackgroundTasks
+from fastapi.responses import StreamingResponse
 from itsdangerous import URLSafeSerializer, BadSignature
 from sqlalchemy.orm import Session
 import os
 import math
 
-from transformers import GPT2Tokenizer
 from app.db.models import User
 from app.db.database import get_db
 from app.db.models import User, Wallet, QueryLog # Make sure you have a ModelUsage table if you want usage logging
-from app.utility.utility import cost_per_query
-from app.machine_learning.pipeline import predict_model_from_db, route_with_fallback
+from app.db.wallets import debit_wallet
+from app.machine_learning.pipeline import (
+    predict_model_from_db, predict_models_batch, route_with_semantic_cache, route_stream_with_fallback
+)
+from app.machine_learning.semantic_cache import SEMANTIC_CACHE_PRICE_FACTOR
+from app.machine_learning.response_cache import RESPONSE_CACHE_PRICE_FACTOR
+from app.machine_learning.singleflight import coalesced_price_factor
+from app.machine_learning.retry import DeadlineExceeded, RequestRejected
+from app.machine_learning.catalog import get_catalog
+from app.machine_learning.tokenizer_registry import count_query_tokens, count_tokens
+from app.machine_learning.cost_estimator import estimate_costs, query_cost, reservation_amount
+from app.metrics.stage_timing import stage
+from app.utility.executors import run_blocking
 from app.db.database import SessionLocal 
 import json
 import time
+import asyncio
+import anyio
 
 router = APIRouter(prefix="/query", tags=["Queries"])
 
@@ -24,6 +37,12 @@ serializer = URLSafeSerializer(SESSION_SECRET_KEY, salt="session")
 # Session cookie settings
 SESSION_COOKIE_NAME = "session_id"
 
+# Batch endpoint limits
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 500))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 8))
+# Most queries one dry-run cost estimate may cover
+ESTIMATE_MAX_ITEMS = int(os.getenv("ESTIMATE_MAX_ITEMS", 10000))
+
 def get_current_user_from_cookie(request: Request, db: Session):
     session_token = request.cookies.get(SESSION_COOKIE_NAME)
     if not session_token:
@@ -39,13 +58,189 @@ def get_current_user_from_cookie(request: Request, db: Session):
         raise HTTPException(status_code=401, detail="User not found")
     return user
 
-@router.post("/handle_user_query")
-async def handle_user_query(
-    user_query: str,
-    request: Request,
-    background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
-):
+def request_deadline(user_input: dict):
+    """
+    Seconds the query may take end to end, across retries and fallbacks:
+    the request's "deadline", or None for REQUEST_DEADLINE_SECONDS.
+    lat_max is not a deadline; it filters models on their catalog time to
+    first chunk. Raises ValueError unless the deadline is a positive,
+    finite number.
+    """
+    deadline = user_input.get("deadline")
+    if deadline is None:
+        return None
+    deadline = float(deadline)
+    if not 0 < deadline < math.inf:
+        raise ValueError("deadline must be a positive number of seconds")
+    return deadline
+
+def parse_flag(user_input: dict, key: str, default=None):
+    """
+    A boolean option from user_input: JSON true/false, or the strings
+    "true"/"false", "1"/"0", "yes"/"no". default when absent; ValueError
+    for anything else (a non-empty string such as "false" is not truthy
+    here).
+    """
+    value = user_input.get(key)
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in ("true", "1", "yes"):
+            return True
+        if lowered in ("false", "0", "no"):
+            return False
+    raise ValueError(f"{key} must be true or false")
+
+def sampling_param(user_input: dict, key: str):
+    """
+    A sampling option from user_input ("temperature" or "top_p") as a
+    float, or None when absent. Raises ValueError unless it is a finite,
+    non-negative number (top_p at most 1), so a bad value is a 400 here
+    instead of a provider error on every candidate.
+    """
+    value = user_input.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"{key} must be a number")
+    value = float(value)
+    if not 0 <= value < math.inf or (key == "top_p" and value > 1):
+        raise ValueError(f"{key} is out of range")
+    return value
+
+def sampling_kwargs(user_input: dict) -> dict:
+    """
+    The request's validated sampling options, as adapter keyword arguments.
+    """
+    params = {k: sampling_param(user_input, k) for k in ("temperature", "top_p")}
+    return {k: v for k, v in params.items() if v is not None}
+
+def parse_preferences(user_input: dict):
+    """
+    Return the raw (cost, accuracy, latency) priorities and the normalized
+    (alpha, beta, gamma) weights. Raises ValueError/TypeError on bad values,
+    including the request's other options, so every endpoint rejects them
+    up front.
+    """
+    request_deadline(user_input)
+    parse_flag(user_input, "cache")
+    parse_flag(user_input, "hedge")
+    sampling_param(user_input, "temperature")
+    sampling_param(user_input, "top_p")
+    cost_priority = float(user_input.get("cost_priority", 1))
+    accuracy_priority = float(user_input.get("accuracy_priority", 1))
+    latency_priority = float(user_input.get("latency_priority", 1))
+
+    total_priority = cost_priority + accuracy_priority + latency_priority or 1.0
+    alpha = cost_priority / total_priority
+    beta = accuracy_priority / total_priority
+    gamma = latency_priority / total_priority
+    return (cost_priority, accuracy_priority, latency_priority), (alpha, beta, gamma)
+
+def compute_query_cost(chosen_model: dict, user_query: str, query_output: str,
+                       input_tokens: int = None, output_tokens: int = None) -> float:
+    """
+    Cost of one query, including the margin. Uses the token counts the
+    provider reported when given, and counts with the model's own tokenizer
+    (see tokenizer_registry.py) only when they are missing.
+    """
+    num_input_tokens = count_tokens(chosen_model, user_query) if input_tokens is None else input_tokens
+    num_output_tokens = count_tokens(chosen_model, query_output) if output_tokens is None else output_tokens
+    return query_cost(chosen_model, num_input_tokens, num_output_tokens)
+
+def reserve_funds(db: Session, user_id: int, amount: float):
+    """
+    Hold a query's pre-flight cost estimate on the wallet before any
+    provider is called. settle_funds swaps the hold for the actual cost
+    afterwards; release_funds gives it back when nothing is billed.
+    """
+    if debit_wallet(db, user_id, amount) is None:
+        db.rollback()
+        raise HTTPException(status_code=402, detail="Insufficient balance to process query")
+    db.commit()
+
+def settle_funds(db: Session, user_id: int, reserved: float, cost: float) -> float:
+    """
+    Replace a reservation with the actual cost. The caller commits, so the
+    debit can share a transaction with the QueryLog rows. Answers already
+    delivered are billed in full, even past the reservation. Returns the
+    new balance.
+    """
+    return debit_wallet(db, user_id, cost - reserved, allow_overdraft=True)
+
+def hold_funds(user_id: int, amount: float):
+    """
+    reserve_funds in a session of its own, for holds taken after the
+    request's session is gone (inside a streaming response).
+    """
+    hold_db = SessionLocal()
+    try:
+        reserve_funds(hold_db, user_id, amount)
+    finally:
+        hold_db.close()
+
+def release_funds(user_id: int, reserved: float):
+    """
+    Give back a reservation for a query that produced nothing to bill.
+    """
+    if not reserved:
+        return
+    release_db = SessionLocal()
+    try:
+        settle_funds(release_db, user_id, reserved, 0.0)
+        release_db.commit()
+    except Exception as e:
+        print(f"Releasing reserved funds failed for user {user_id}: {e}")
+        release_db.rollback()
+    finally:
+        release_db.close()
+
+def price_factor(result) -> float:
+    """
+    Discount applied to answers that did not need their own provider call:
+    semantic and exact-match cache hits, each at its own factor, and
+    requests coalesced onto an identical in-flight call (per
+    SINGLEFLIGHT_BILLING).
+    """
+    if result.cached:
+        return SEMANTIC_CACHE_PRICE_FACTOR if result.semantic else RESPONSE_CACHE_PRICE_FACTOR
+    if result.coalesced:
+        return coalesced_price_factor()
+    return 1.0
+
+def provider_latency(result):
+    """
+    The answering provider call's own time for QueryLog.provider_latency,
+    or None when the answer came from a cache or a coalesced call.
+    """
+    if result.cached or result.coalesced:
+        return None
+    return result.latency
+
+def failure_detail(error: BaseException) -> str:
+    """
+    What to tell the client about a query that got no answer: the reason
+    when the request was rejected or ran out of time, a generic message
+    otherwise.
+    """
+    if isinstance(error, (RequestRejected, DeadlineExceeded)):
+        return error.detail
+    return "Failed to obtain model response"
+
+async def prepare_user_query(user_query: str, request: Request, db: Session, hold: bool = True):
+    """
+    Shared front half of the single-query endpoints: parse the body,
+    authenticate, pick the top candidate models and reserve the most
+    expensive candidate's estimated maximum cost on the wallet. Returns
+    (user, user_input, priorities, top_candidates, reserved); the caller
+    must settle or release the reservation. Without hold, the balance is
+    only checked against the amount and the caller takes the hold itself.
+    """
     # Parse JSON body to extract user_input
     print(f"user_query: {user_query}")
     try:
@@ -59,98 +254,120 @@ async def handle_user_query(
         raise HTTPException(status_code=400, detail="Missing 'user_input' in request body.")
 
     # Validate user session and wallet synchronously
-    try:
-        user = get_current_user_from_cookie(request, db)
-    except Exception as e:
-        print(f"User authentication failed: {e}")
-        raise
+    with stage("auth"):
+        try:
+            user = get_current_user_from_cookie(request, db)
+        except Exception as e:
+            print(f"User authentication failed: {e}")
+            raise
 
-    wallet = user.wallet
-    if not wallet or wallet.balance <= 10:
-        raise HTTPException(status_code=402, detail="Insufficient balance")
+        if not user.wallet:
+            raise HTTPException(status_code=402, detail="Insufficient balance")
 
     # Calculate weights based on user preferences
     try:
-        cost_priority = float(user_input.get("cost_priority", 1))
-        accuracy_priority = float(user_input.get("accuracy_priority", 1))
-        latency_priority = float(user_input.get("latency_priority", 1))
+        priorities, (alpha, beta, gamma) = parse_preferences(user_input)
     except (ValueError, TypeError) as e:
         print(f"Preference parsing error: {e}")
         raise HTTPException(status_code=400, detail="Invalid preference values.")
 
-    total_priority = cost_priority + accuracy_priority + latency_priority or 1.0
-    alpha = cost_priority / total_priority
-    beta = accuracy_priority / total_priority
-    gamma = latency_priority / total_priority
-
     # Query DB-based pipeline to get top candidate models
-    top_candidates = predict_model_from_db(
-        db=db,
-        user_input=user_input,
-        user_query=user_query,
-        alpha=alpha,
-        beta=beta,
-        gamma=gamma,
-        top_k=3
-    )
+    with stage("routing"):
+        top_candidates = predict_model_from_db(
+            db=db,
+            user_input=user_input,
+            user_query=user_query,
+            alpha=alpha,
+            beta=beta,
+            gamma=gamma,
+            top_k=3
+        )
     print(f"top_candidates : {top_candidates}")
     if not top_candidates or top_candidates == []:
         raise HTTPException(status_code=400, detail="No models found for you requirements, please retry by changing parameters!!!")
 
-    # Route with fallback and measure latency
-    start_time = time.perf_counter()
-    try:
-        fallback_result = await route_with_fallback(
-            user_query=user_query,
-            candidates=top_candidates
-        )
-    except Exception as e:
-        print(f"Fallback routing failed: {e}")
-        raise HTTPException(status_code=500, detail="Failed to obtain model response")
-
-    latency_measured = time.perf_counter() - start_time
-
-    # Validate fallback result
-    if not fallback_result:
-        raise HTTPException(status_code=500, detail="Model routing failed to return a result")
-
-    # Extract information from fallback_result
-    model_name = fallback_result.get("model_name")
-    license_type = fallback_result.get("license_type")
-    query_output = fallback_result.get("query_output")
-    completion_tokens = fallback_result.get("completion_tokens", 0)
-    total_tokens = fallback_result.get("total_tokens", 0)
-    raw_response = fallback_result.get("raw_response", {})
-
-    # Check if query_output is empty and raise an exception if so
-    if not query_output:
-        raise HTTPException(status_code=500, detail="Received empty response from model.")
-
-    # Retrieve chosen model details from top_candidates
-    chosen_model = next((m for m in top_candidates if m["model_name"] == model_name), None)
-    if not chosen_model:
-        raise HTTPException(status_code=500, detail="Chosen model data not found.")
-
-    input_cost_raw = chosen_model.get("input_cost_raw", 0.0)
-    output_cost_raw = chosen_model.get("output_cost_raw", 0.0)
+    with stage("estimate"):
+        estimates = (await estimate_costs([(user_query, top_candidates)]))[0]
+    reserved = reservation_amount(estimates)
+    with stage("wallet"):
+        if hold:
+            reserve_funds(db, user.id, reserved)
+        elif user.wallet.balance < reserved:
+            raise HTTPException(status_code=402, detail="Insufficient balance to process query")
 
-    # Cost Calculation using GPT2 tokenizer
-    tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
-    num_input_tokens = len(tokenizer.encode(user_query))
-    num_output_tokens = len(tokenizer.encode(query_output))
+    return user, user_input, priorities, top_candidates, reserved
 
-    base_cost = cost_per_query(input_cost_raw, output_cost_raw, num_input_tokens, num_output_tokens)
-    total_cost = base_cost * 1.15  # Add 15% margin
-
-    if wallet.balance < total_cost:
-        raise HTTPException(status_code=402, detail="Insufficient balance to process query")
+@router.post("/handle_user_query")
+async def handle_user_query(
+    user_query: str,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db)
+):
+    user, user_input, priorities, top_candidates, reserved = await prepare_user_query(user_query, request, db)
+    cost_priority, accuracy_priority, latency_priority = priorities
 
-    # Deduct cost synchronously
-    wallet.balance = wallet.balance - total_cost
-    db.add(wallet)             # Explicitly add/update wallet in session
-    db.commit()
-    db.refresh(wallet)         # Refresh to get updated state
-    print(f"Balance after deduction: {wallet.balance}")
+    # The reservation is handed back unless the query gets billed
+    settled = False
+    try:
+        # Route with fallback and measure latency
+        start_time = time.perf_counter()
+        try:
+            with stage("provider"):
+                fallback_result = await route_with_semantic_cache(
+                    user_query=user_query,
+                    candidates=top_candidates,
+                    temperature=sampling_param(user_input, "temperature"),
+                    top_p=sampling_param(user_input, "top_p"),
+                    use_cache=parse_flag(user_input, "cache", True),
+                    user_id=user.id,
+                    hedge=parse_flag(user_input, "hedge"),
+                    latency_budget=request_deadline(user_input)
+                )
+        except (RequestRejected, DeadlineExceeded):
+            raise
+        except Exception as e:
+            print(f"Fallback routing failed: {e}")
+            raise HTTPException(status_code=500, detail="Failed to obtain model response")
+
+        latency_measured = time.perf_counter() - start_time
+
+        # Validate fallback result
+        if not fallback_result:
+            raise HTTPException(status_code=500, detail="Model routing failed to return a result")
+
+        # Extract information from fallback_result
+        model_name = fallback_result.model_name
+        license_type = fallback_result.license_type
+        query_output = fallback_result.query_output
+        completion_tokens = fallback_result.completion_tokens
+        total_tokens = fallback_result.total_tokens
+
+        # Check if query_output is empty and raise an exception if so
+        if not query_output:
+            raise HTTPException(status_code=500, detail="Received empty response from model.")
+
+        # Retrieve chosen model details from top_candidates
+        chosen_model = next((m for m in top_candidates if m["model_name"] == model_name), None)
+        if not chosen_model:
+            raise HTTPException(status_code=500, detail="Chosen model data not found.")
+
+        with stage("tokenization"):
+            total_cost = compute_query_cost(
+                chosen_model, user_query, query_output, fallback_result.input_tokens, fallback_result.output_tokens
+            )
+        cached = fallback_result.cached
+        total_cost *= price_factor(fallback_result)
+
+        # Swap the reservation for the actual cost
+        with stage("wallet"):
+            balance = settle_funds(db, user.id, reserved, total_cost)
+            db.commit()
+            settled = True
+    finally:
+        if not settled:
+            release_funds(user.id, reserved)
+    print(f"Balance after deduction: {balance}")
     print("Attempting synchronous logging...")
     try:
         # Directly call log_query instead of scheduling a background task
@@ -168,6 +385,9 @@ async def handle_user_query(
                     completion_tokens=completion_tokens,
                     total_tokens=total_tokens,
                     latency=latency_measured,
+                    provider_latency=provider_latency(fallback_result),
+                    retry_count=fallback_result.retries,
+                    retry_wait=fallback_result.retry_wait,
                     cost=total_cost,
                     cost_preference=int(cost_priority),
                     latency_preference=int(latency_priority),
@@ -183,7 +403,8 @@ async def handle_user_query(
             finally:
                 background_db.close()
 
-        log_query()
+        with stage("logging"):
+            log_query()
     except Exception as e:
         print(f"Synchronous logging encountered an exception: {e}")
 
@@ -192,10 +413,425 @@ async def handle_user_query(
         "model_used": model_name,
         "provider": license_type,
         "cost": total_cost,
-        "latency": latency_measured
+        "latency": latency_measured,
+        "cached": cached,
+        "coalesced": fallback_result.coalesced
+    }
+
+
+
+@router.post("/handle_user_query_stream")
+async def handle_user_query_stream(
+    user_query: str,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """
+    Streaming variant of /handle_user_query that relays tokens as
+    server-sent events:
+
+      event: start  -> {"model_used", "provider"}
+      (message)     -> {"delta": "..."} for each chunk of output
+      event: done   -> {"model_used", "provider", "cost", "latency", "time_to_first_token"}
+      event: error  -> {"detail"} (also when the charge could not be recorded)
+
+    Billing and the QueryLog row are written when the stream finishes. If
+    the client disconnects mid-stream, the output relayed so far is billed.
+    The balance is checked up front, but the pre-flight reservation is only
+    taken once the body starts streaming, so a client that drops before
+    then leaves nothing held. It is settled when the stream ends, or
+    released when the stream produced nothing.
+    """
+    user, user_input, priorities, top_candidates, reserved = await prepare_user_query(
+        user_query, request, db, hold=False
+    )
+    user_id = user.id
+
+    async def event_stream():
+        start_time = time.perf_counter()
+        state = {"candidate": None, "ttft": None, "usage": None, "parts": [], "settled": False, "held": 0.0}
+
+        async def settle():
+            """
+            Bill what was relayed and log it, off the event loop. Returns the
+            done summary, or None when nothing was billed (no output, or the
+            charge could not be recorded; the reservation is released).
+            """
+            state["settled"] = True
+            if state["candidate"] is None or not state["parts"]:
+                await run_blocking("billing", release_funds, user_id, state["held"])
+                return None
+            query_output = "".join(state["parts"])
+            usage = state["usage"]
+            if usage is None:
+                # No usage report from the provider; count without blocking the loop
+                input_tokens, output_tokens = await count_query_tokens(state["candidate"], user_query, query_output)
+                usage = {"completion_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+            return await run_blocking(
+                "billing", settle_streamed_query,
+                user_id, user_query, state["candidate"], query_output, usage,
+                time.perf_counter() - start_time, state["ttft"], priorities, state["held"]
+            )
+
+        events = route_stream_with_fallback(
+            user_query, top_candidates, latency_budget=request_deadline(user_input),
+            **sampling_kwargs(user_input)
+        )
+        try:
+            # Shielded so a hold committed on the executor is always recorded
+            with anyio.CancelScope(shield=True):
+                await run_blocking("billing", hold_funds, user_id, reserved)
+                state["held"] = reserved
+            async for candidate, event in events:
+                if state["candidate"] is None:
+                    state["candidate"] = candidate
+                    yield _sse({"model_used": candidate["model_name"], "provider": candidate["license"]}, "start")
+                if "usage" in event:
+                    state["usage"] = event["usage"]
+                if event.get("delta"):
+                    if state["ttft"] is None:
+                        state["ttft"] = time.perf_counter() - start_time
+                    state["parts"].append(event["delta"])
+                    yield _sse({"delta": event["delta"]})
+
+            summary = await settle()
+            if summary is not None:
+                yield _sse(summary, "done")
+            elif state["parts"]:
+                yield _sse({"detail": "Failed to record the charge for this response."}, "error")
+            else:
+                yield _sse({"detail": "Received empty response from model."}, "error")
+        except HTTPException as e:
+            yield _sse({"detail": e.detail}, "error")
+        except Exception as e:
+            print(f"Streaming failed: {e}")
+            yield _sse({"detail": "Failed to obtain model response"}, "error")
+        finally:
+            # Client disconnects and mid-stream errors still bill what was sent.
+            # Starlette cancels the response on disconnect, so the settlement
+            # is shielded or its first await would be cancelled too.
+            if not state["settled"]:
+                with anyio.CancelScope(shield=True):
+                    await settle()
+            await events.aclose()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+def _sse(payload: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(payload)}\n\n"
+
+def settle_streamed_query(user_id: int, user_query: str, candidate: dict, query_output: str,
+                          usage: dict, latency: float, ttft: float, priorities: tuple,
+                          reserved: float = 0.0):
+    """
+    Settle the wallet reservation against the actual cost and write the
+    QueryLog row for a finished (or abandoned) stream in one transaction.
+    Token counts come from the provider's usage report when the stream
+    delivered one, and from the model's tokenizer otherwise. Blocking; the
+    stream calls it through run_blocking. Returns the done summary, or None
+    when the transaction failed and the reservation was released instead.
+    """
+    cost_priority, accuracy_priority, latency_priority = priorities
+    if usage:
+        completion_tokens = usage["completion_tokens"]
+        total_tokens = usage["total_tokens"]
+    else:
+        completion_tokens = count_tokens(candidate, query_output)
+        total_tokens = completion_tokens + count_tokens(candidate, user_query)
+    total_cost = compute_query_cost(
+        candidate, user_query, query_output, total_tokens - completion_tokens, completion_tokens
+    )
+
+    stream_db = SessionLocal()
+    try:
+        # The output has already been delivered, so it is billed in full
+        settle_funds(stream_db, user_id, reserved, total_cost)
+        stream_db.add(QueryLog(
+            user_id=user_id,
+            chat_topic="stream",
+            query_input=user_query,
+            query_output=query_output,
+            model_name=candidate["model_name"],
+            provider_name=candidate["license"],
+            completion_tokens=completion_tokens,
+            total_tokens=total_tokens,
+            latency=latency,
+            time_to_first_token=ttft,
+            cost=total_cost,
+            cost_preference=int(cost_priority),
+            latency_preference=int(latency_priority),
+            performance_preference=int(accuracy_priority)
+        ))
+        stream_db.commit()
+        print(f"Settled streamed query for user {user_id}, model {candidate['model_name']}, cost {total_cost}")
+    except Exception as e:
+        print(f"Settling streamed query failed: {e}")
+        stream_db.rollback()
+        release_funds(user_id, reserved)
+        return None
+    finally:
+        stream_db.close()
+
+    return {
+        "model_used": candidate["model_name"],
+        "provider": candidate["license"],
+        "cost": total_cost,
+        "latency": latency,
+        "time_to_first_token": ttft
+    }
+
+
+@router.post("/handle_batch_query")
+async def handle_batch_query(request: Request, db: Session = Depends(get_db)):
+    """
+    Route many queries in one call.
+
+    Body: {"queries": [{"user_query": "...", "user_input": {...}}, ...]}
+
+    Authentication and the catalog lookup happen once. All
+    items are scored together in one matrix operation, and each item's
+    estimated maximum cost is reserved on the wallet up front; items the
+    balance cannot cover are not dispatched. The rest go through the
+    semantic cache and route_with_fallback with at most
+    BATCH_MAX_CONCURRENCY in flight, and are
+    billed with a single wallet settlement and QueryLog insert transaction.
+    Returns one result per item, in order; failed items carry an error
+    detail instead of a response and are not billed.
+    """
+    try:
+        data = await request.json()
+    except Exception as e:
+        print(f"JSON parsing error: {e}")
+        raise HTTPException(status_code=400, detail="Invalid JSON payload.")
+
+    items = data.get("queries")
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="Missing 'queries' list in request body.")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"A batch may contain at most {BATCH_MAX_ITEMS} queries.")
+
+    user = get_current_user_from_cookie(request, db)
+    wallet = user.wallet
+    if not wallet:
+        raise HTTPException(status_code=402, detail="Insufficient balance")
+
+    results, valid, candidate_lists = route_query_items(items, db)
+
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+    async def dispatch(user_query: str, user_input: dict, candidates: list):
+        async with semaphore:
+            start_time = time.perf_counter()
+            fallback_result = await route_with_semantic_cache(
+                user_query=user_query,
+                candidates=candidates,
+                temperature=sampling_param(user_input, "temperature"),
+                top_p=sampling_param(user_input, "top_p"),
+                use_cache=parse_flag(user_input, "cache", True),
+                user_id=user.id,
+                latency_budget=request_deadline(user_input)
+            )
+            return fallback_result, time.perf_counter() - start_time
+
+    pending = []
+    for (i, user_query, user_input, *_), candidates in zip(valid, candidate_lists):
+        if not candidates:
+            results[i] = {"index": i, "status": "error", "detail": "No models found for you requirements, please retry by changing parameters!!!"}
+            continue
+        pending.append((i, user_query, user_input, candidates))
+
+    # Reserve every item's estimated maximum before anything is dispatched
+    estimates = await estimate_costs([(user_query, candidates) for _, user_query, _, candidates in pending])
+    db.refresh(wallet)
+    reserved = 0.0
+    affordable = []
+    for entry, item_estimates in zip(pending, estimates):
+        amount = reservation_amount(item_estimates)
+        if reserved + amount > wallet.balance:
+            results[entry[0]] = {"index": entry[0], "status": "error", "detail": "Insufficient balance to process query"}
+            continue
+        reserved += amount
+        affordable.append(entry)
+    pending = affordable
+
+    # The reservation is handed back unless the batch gets billed; held
+    # stays 0 if reserve_funds itself fails, since nothing was debited
+    held = 0.0
+    settled = False
+    try:
+        reserve_funds(db, user.id, reserved)
+        held = reserved
+        outcomes = await asyncio.gather(
+            *(dispatch(user_query, user_input, candidates) for _, user_query, user_input, candidates in pending),
+            return_exceptions=True
+        )
+        balance, total_charged = bill_batch_items(db, user.id, pending, outcomes, valid, results, reserved)
+        settled = True
+    finally:
+        if not settled:
+            release_funds(user.id, held)
+
+    print(f"Batch of {len(items)} queries for user {user.id} charged {total_charged}")
+    return {
+        "results": results,
+        "total_cost": total_charged,
+        "wallet_balance": balance
     }
 
 
+def route_query_items(items: list, db: Session):
+    """
+    Validate a list of {"user_query", "user_input"} items and score the
+    valid ones against the catalog at once. Returns (results, valid,
+    candidate_lists): results holds an error entry for each invalid item
+    and None elsewhere, valid is (index, user_query, user_input,
+    priorities, weights) per valid item, and candidate_lists its top
+    candidates.
+    """
+    results = [None] * len(items)
+    valid = []  # (index, user_query, user_input, priorities, weights)
+    for i, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        user_query = item.get("user_query")
+        user_input = item.get("user_input")
+        if not user_query or not isinstance(user_input, dict):
+            results[i] = {"index": i, "status": "error", "detail": "Each query needs 'user_query' and 'user_input'."}
+            continue
+        try:
+            priorities, weights = parse_preferences(user_input)
+        except (ValueError, TypeError):
+            results[i] = {"index": i, "status": "error", "detail": "Invalid preference values."}
+            continue
+        valid.append((i, user_query, user_input, priorities, weights))
+
+    # Score every valid item against the catalog at once
+    candidate_lists = predict_models_batch(
+        db,
+        [v[2] for v in valid],
+        [v[4] for v in valid],
+        top_k=3,
+        user_queries=[v[1] for v in valid]
+    ) if valid else []
+    return results, valid, candidate_lists
+
+
+def bill_batch_items(db: Session, user_id: int, pending: list, outcomes: list, valid: list,
+                     results: list, reserved: float):
+    """
+    Settle a batch's reservation against the cost of its answered items
+    and log them, in one transaction. Fills in results; returns (balance,
+    total charged).
+    """
+    priorities_by_index = {v[0]: v[3] for v in valid}
+    total_charged = 0.0
+    try:
+        for (i, user_query, _, candidates), outcome in zip(pending, outcomes):
+            if isinstance(outcome, BaseException):
+                print(f"Batch item {i} failed: {outcome}")
+                results[i] = {"index": i, "status": "error", "detail": failure_detail(outcome)}
+                continue
+
+            fallback_result, latency_measured = outcome
+            model_name = fallback_result.model_name
+            query_output = fallback_result.query_output
+            chosen_model = next((m for m in candidates if m["model_name"] == model_name), None)
+            if not query_output or not chosen_model:
+                results[i] = {"index": i, "status": "error", "detail": "Received empty response from model."}
+                continue
+
+            total_cost = compute_query_cost(
+                chosen_model, user_query, query_output, fallback_result.input_tokens, fallback_result.output_tokens
+            )
+            total_cost *= price_factor(fallback_result)
+            total_charged += total_cost
+
+            cost_priority, accuracy_priority, latency_priority = priorities_by_index[i]
+            db.add(QueryLog(
+                user_id=user_id,
+                chat_topic="batch",
+                query_input=user_query,
+                query_output=query_output,
+                model_name=model_name,
+                provider_name=fallback_result.license_type,
+                completion_tokens=fallback_result.completion_tokens,
+                total_tokens=fallback_result.total_tokens,
+                latency=latency_measured,
+                provider_latency=provider_latency(fallback_result),
+                retry_count=fallback_result.retries,
+                retry_wait=fallback_result.retry_wait,
+                cost=total_cost,
+                cost_preference=int(cost_priority),
+                latency_preference=int(latency_priority),
+                performance_preference=int(accuracy_priority)
+            ))
+            results[i] = {
+                "index": i,
+                "status": "ok",
+                "response": query_output,
+                "model_used": model_name,
+                "provider": fallback_result.license_type,
+                "cost": total_cost,
+                "latency": latency_measured,
+                "cached": fallback_result.cached,
+                "coalesced": fallback_result.coalesced
+            }
+
+        balance = settle_funds(db, user_id, reserved, total_charged)
+        db.commit()
+    except Exception as e:
+        print(f"Batch billing failed: {e}")
+        db.rollback()
+        raise HTTPException(status_code=500, detail="Failed to record batch results")
+    return balance, total_charged
+
+
+@router.post("/estimate")
+async def estimate_query_cost(request: Request, db: Session = Depends(get_db)):
+    """
+    Dry run: the pre-flight cost estimate for each query, without calling
+    any model or touching the wallet, so clients can budget large batches
+    up front.
+
+    Body: {"queries": [{"user_query": "...", "user_input": {...}}, ...]}, as
+    for /handle_batch_query.
+
+    Each item lists its top candidates with input tokens, predicted output
+    tokens and estimated cost, plus max_cost: what a query would reserve on
+    the wallet before dispatch. total_max_cost sums max_cost over the
+    items.
+    """
+    try:
+        data = await request.json()
+    except Exception as e:
+        print(f"JSON parsing error: {e}")
+        raise HTTPException(status_code=400, detail="Invalid JSON payload.")
+
+    items = data.get("queries")
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="Missing 'queries' list in request body.")
+    if len(items) > ESTIMATE_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"An estimate may cover at most {ESTIMATE_MAX_ITEMS} queries.")
+
+    user = get_current_user_from_cookie(request, db)
+    results, valid, candidate_lists = route_query_items(items, db)
+
+    estimates = await estimate_costs([(v[1], candidates) for v, candidates in zip(valid, candidate_lists)])
+    total_max_cost = 0.0
+    for (i, *_), candidates, item_estimates in zip(valid, candidate_lists, estimates):
+        if not candidates:
+            results[i] = {"index": i, "status": "error", "detail": "No models found for you requirements, please retry by changing parameters!!!"}
+            continue
+        max_cost = reservation_amount(item_estimates)
+        total_max_cost += max_cost
+        results[i] = {"index": i, "status": "ok", "candidates": item_estimates, "max_cost": max_cost}
+
+    return {
+        "results": results,
+        "total_max_cost": total_max_cost,
+        "wallet_balance": user.wallet.balance if user.wallet else 0
+    }
+
 
 @router.get("/get_ranges")
 async def get_ranges(db: Session = Depends(get_db)):
@@ -203,23 +839,16 @@ async def get_ranges(db: Session = Depends(get_db)):
     Provide the dynamic range for cost, performance, and latency.
     These can be used in the UI to set slider min/max.
     """
-    from app.db.models import ModelMetadata
-
-    # Query min/max
-    cost_min_record = db.query(ModelMetadata).order_by(ModelMetadata.cost.asc()).first()
-    cost_max_record = db.query(ModelMetadata).order_by(ModelMetadata.cost.desc()).first()
-    cost_min = cost_min_record.cost if cost_min_record else 0.0
-    cost_max = cost_max_record.cost if cost_max_record else 100.0
-
-    perf_min_record = db.query(ModelMetadata).order_by(ModelMetadata.performance.asc()).first()
-    perf_max_record = db.query(ModelMetadata).order_by(ModelMetadata.performance.desc()).first()
-    perf_min = perf_min_record.performance if perf_min_record else 0.0
-    perf_max = perf_max_record.performance if perf_max_record else 100.0
-
-    lat_min_record = db.query(ModelMetadata).order_by(ModelMetadata.latency.asc()).first()
-    lat_max_record = db.query(ModelMetadata).order_by(ModelMetadata.latency.desc()).first()
-    lat_min = lat_min_record.latency if lat_min_record else 0.0
-    lat_max = lat_max_record.latency if lat_max_record else 30
+    # Min/max come straight from the catalog's sorted per-axis arrays
+    catalog = get_catalog(db)
+    if len(catalog):
+        cost_min, cost_max = catalog.cost[catalog.cost_order[[0, -1]]]
+        perf_min, perf_max = catalog.performance[catalog.perf_order[[0, -1]]]
+        lat_min, lat_max = catalog.latency[catalog.lat_order[[0, -1]]]
+    else:
+        cost_min, cost_max = 0.0, 100.0
+        perf_min, perf_max = 0.0, 100.0
+        lat_min, lat_max = 0.0, 30
 
      # Round values for user-friendly boundaries
     # For minimums, use floor; for maximums, use ceil.
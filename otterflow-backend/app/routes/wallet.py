@@ -4,6 +4,7 @@ from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.orm import Session
 from app.db.models import User, Wallet
 from app.db.database import get_db
+from app.db.wallets import credit_wallet
 from app.routes.auth import get_current_user, no_cache_response
 import stripe
 import os
@@ -48,12 +49,12 @@ async def recharge_wallet(
         )
 
         # Update wallet balance after successful payment
-        wallet.balance += amount * 100
+        balance = credit_wallet(db, user.id, amount * 100)
         db.commit()
 
         return no_cache_response({
             "message": "Wallet recharge successful",
-            "wallet_balance": wallet.balance
+            "wallet_balance": balance
         })
 
     except stripe.error.StripeError as e:
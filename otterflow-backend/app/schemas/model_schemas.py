@@ -21,6 +21,10 @@ class ModelBase(BaseModel):
     temperature: float
     io_ratio: float
 
+    max_concurrency: Optional[int] = None
+    rpm_limit: Optional[int] = None
+    tpm_limit: Optional[int] = None
+
 class ModelCreate(ModelBase):
     """
     All fields required to create a new ModelMetadata.
@@ -49,6 +53,10 @@ class ModelUpdate(BaseModel):
     temperature: Optional[float] = None
     io_ratio: Optional[float] = None
 
+    max_concurrency: Optional[int] = None
+    rpm_limit: Optional[int] = None
+    tpm_limit: Optional[int] = None
+
 class ModelInDB(ModelBase):
     """
     Schema for reading a ModelMetadata from the DB.
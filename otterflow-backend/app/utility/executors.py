@@ -0,0 +1,121 @@
+# app/utility/executors.py
+
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Default worker count for a named executor; override one pool with
+# EXECUTOR_WORKERS_<NAME>, e.g. EXECUTOR_WORKERS_RESPONSE_CACHE=4
+EXECUTOR_DEFAULT_WORKERS = int(os.getenv("EXECUTOR_DEFAULT_WORKERS", 8))
+
+
+class SizedExecutor:
+    """
+    A named, fixed-size thread pool for blocking work called from async code.
+
+    Each kind of blocking work gets its own pool so a slow synchronous SDK
+    or database call queues behind its own workers instead of starving the
+    event loop's default executor. Queue depth, active workers and time
+    spent waiting for a worker are tracked for the health endpoint.
+    """
+
+    def __init__(self, name: str, max_workers: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-worker")
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.max_queued = 0
+        self.total_wait = 0.0
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Submit fn to the pool and return the concurrent future.
+        """
+        submitted_at = time.perf_counter()
+
+        def call():
+            with self.lock:
+                self.queued -= 1
+                self.active += 1
+                self.total_wait += time.perf_counter() - submitted_at
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        def on_done(future):
+            if future.cancelled():
+                # Never started, so call() did not take it off the queue
+                with self.lock:
+                    self.queued -= 1
+
+        with self.lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        future = self.pool.submit(call)
+        future.add_done_callback(on_done)
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run fn on the pool and await its result.
+        """
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "workers": self.max_workers,
+                "active": self.active,
+                "queued": self.queued,
+                "max_queued": self.max_queued,
+                "completed": self.completed,
+                "avg_wait": self.total_wait / self.completed if self.completed else 0.0,
+            }
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name: str, max_workers: int = None) -> SizedExecutor:
+    """
+    The shared executor for one kind of blocking work, created on first use.
+    """
+    with _executors_lock:
+        executor = _executors.get(name)
+        if executor is None:
+            workers = max_workers or int(
+                os.getenv(f"EXECUTOR_WORKERS_{name.upper()}", EXECUTOR_DEFAULT_WORKERS)
+            )
+            executor = _executors[name] = SizedExecutor(name, workers)
+        return executor
+
+
+async def run_blocking(name: str, fn, *args, **kwargs):
+    """
+    Run a blocking call on the named executor from async code.
+    """
+    return await get_executor(name).run(fn, *args, **kwargs)
+
+
+def executor_snapshot() -> dict:
+    with _executors_lock:
+        return {name: executor.snapshot() for name, executor in _executors.items()}
+
+
+def shutdown_executors():
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown()
+        _executors.clear()
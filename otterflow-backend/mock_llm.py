@@ -0,0 +1,397 @@
+# mock_llm.py
+#
+# Local stand-in for the LLM providers, for load tests and offline
+# development. Point the app at it with LLM_MOCK_BASE_URL:
+#
+#   uvicorn mock_llm:app --port 9000
+#   LLM_MOCK_BASE_URL=http://localhost:9000 uvicorn app.main:app
+#
+# Serves the response shapes the adapters in app/llm expect:
+#   OpenAI      POST /v1/chat/completions
+#   Groq        POST /openai/v1/chat/completions
+#   AIML        POST /chat/completions
+#   Google      POST /v1beta/models/{model}:generateContent / :streamGenerateContent
+#   Cohere      POST /v2/chat
+#   OpenAI Batch API: POST /v1/files, POST /v1/batches, GET /v1/batches/{id},
+#                     GET /v1/files/{id}/content
+#   OpenAI embeddings (semantic cache): POST /v1/embeddings
+# Chat completions and Cohere support "stream": true (server-sent events).
+
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+# Latency before the first byte is lognormal around the median
+MOCK_LATENCY_MEDIAN = float(os.getenv("MOCK_LATENCY_MEDIAN", 0.5))
+MOCK_LATENCY_SIGMA = float(os.getenv("MOCK_LATENCY_SIGMA", 0.4))
+# Fraction of calls failing with a 500, and with a 429 + Retry-After
+MOCK_ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", 0.0))
+MOCK_RATE_LIMIT_RATE = float(os.getenv("MOCK_RATE_LIMIT_RATE", 0.0))
+MOCK_RETRY_AFTER = float(os.getenv("MOCK_RETRY_AFTER", 1.0))
+# Output length is drawn uniformly from [min, max] tokens
+MOCK_OUTPUT_TOKENS_MIN = int(os.getenv("MOCK_OUTPUT_TOKENS_MIN", 50))
+MOCK_OUTPUT_TOKENS_MAX = int(os.getenv("MOCK_OUTPUT_TOKENS_MAX", 400))
+# Streaming pace after the first token
+MOCK_TOKENS_PER_SECOND = float(os.getenv("MOCK_TOKENS_PER_SECOND", 200))
+# Seconds before a submitted batch reports completed
+MOCK_BATCH_SECONDS = float(os.getenv("MOCK_BATCH_SECONDS", 5.0))
+# Per-model overrides of any of the above, e.g.
+# MOCK_MODEL_PROFILES='{"gpt-4o": {"latency_median": 1.2, "error_rate": 0.05}}'
+MOCK_MODEL_PROFILES = json.loads(os.getenv("MOCK_MODEL_PROFILES", "{}"))
+
+_WORDS = (
+    "the model considered the question carefully and produced a plausible answer "
+    "with enough detail to exercise tokenization billing and logging paths"
+).split()
+
+app = FastAPI(title="Mock LLM providers")
+
+# Batch API state: uploaded and generated files, and submitted batches
+_files = {}
+_batches = {}
+
+
+def _profile(model: str) -> dict:
+    profile = {
+        "latency_median": MOCK_LATENCY_MEDIAN,
+        "latency_sigma": MOCK_LATENCY_SIGMA,
+        "error_rate": MOCK_ERROR_RATE,
+        "rate_limit_rate": MOCK_RATE_LIMIT_RATE,
+        "output_tokens_min": MOCK_OUTPUT_TOKENS_MIN,
+        "output_tokens_max": MOCK_OUTPUT_TOKENS_MAX,
+        "tokens_per_second": MOCK_TOKENS_PER_SECOND,
+    }
+    profile.update(MOCK_MODEL_PROFILES.get(model, {}))
+    return profile
+
+
+def _count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _completion(model: str, prompt: str):
+    """
+    Draw one simulated completion: (profile, output tokens as words, input tokens).
+    """
+    profile = _profile(model)
+    n = random.randint(profile["output_tokens_min"], profile["output_tokens_max"])
+    words = [_WORDS[i % len(_WORDS)] for i in range(n)]
+    return profile, words, _count_tokens(prompt)
+
+
+async def _injected_failure(profile: dict):
+    """
+    Sleep for the sampled latency, then maybe return an injected error.
+    """
+    await asyncio.sleep(random.lognormvariate(0, profile["latency_sigma"]) * profile["latency_median"])
+    roll = random.random()
+    if roll < profile["rate_limit_rate"]:
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}},
+            status_code=429,
+            headers={"Retry-After": str(MOCK_RETRY_AFTER)},
+        )
+    if roll < profile["rate_limit_rate"] + profile["error_rate"]:
+        return JSONResponse({"error": {"message": "Internal error (mock)", "type": "server_error"}}, status_code=500)
+    return None
+
+
+async def _paced(words: list, profile: dict):
+    delay = 1.0 / profile["tokens_per_second"] if profile["tokens_per_second"] > 0 else 0.0
+    for word in words:
+        if delay:
+            await asyncio.sleep(delay)
+        yield word + " "
+
+
+def _sse(payload: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(payload)}\n\n"
+
+
+def _prompt_text(messages: list) -> str:
+    parts = []
+    for message in messages:
+        content = message.get("content", "")
+        if isinstance(content, list):
+            content = " ".join(c.get("text", "") for c in content if isinstance(c, dict))
+        parts.append(str(content))
+    return "\n".join(parts)
+
+
+#####################################################
+# OpenAI-compatible chat completions (OpenAI, Groq, AIML)
+#####################################################
+@app.post("/v1/chat/completions")
+@app.post("/openai/v1/chat/completions")
+@app.post("/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "mock")
+    profile, words, input_tokens = _completion(model, _prompt_text(body.get("messages", [])))
+    if body.get("max_tokens"):
+        words = words[: int(body["max_tokens"])]
+    failure = await _injected_failure(profile)
+    if failure is not None:
+        return failure
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+    usage = {
+        "prompt_tokens": input_tokens,
+        "completion_tokens": len(words),
+        "total_tokens": input_tokens + len(words),
+    }
+
+    if not body.get("stream"):
+        return _chat_completion(completion_id, created, model, words, usage)
+
+    include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+    groq = request.url.path.startswith("/openai/")
+
+    async def events():
+        base = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model}
+        async for text in _paced(words, profile):
+            yield _sse(dict(base, choices=[{"index": 0, "delta": {"content": text}, "finish_reason": None}]))
+        final = dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if groq:
+            final["x_groq"] = {"id": completion_id, "usage": usage}
+        yield _sse(final)
+        if include_usage:
+            yield _sse(dict(base, choices=[], usage=usage))
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def _chat_completion(completion_id: str, created: int, model: str, words: list, usage: dict) -> dict:
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": " ".join(words)},
+            "finish_reason": "stop",
+        }],
+        "usage": usage,
+    }
+
+
+#####################################################
+# OpenAI embeddings
+#####################################################
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    """
+    Unit vectors built from hashed words, so identical texts embed
+    identically and texts sharing words land close together.
+    """
+    body = await request.json()
+    texts = body.get("input", [])
+    texts = [texts] if isinstance(texts, str) else texts
+    dimensions = int(body.get("dimensions") or 1536)
+    data = []
+    for i, text in enumerate(texts):
+        vector = [0.0] * dimensions
+        for word in text.lower().split():
+            vector[int(uuid.uuid5(uuid.NAMESPACE_OID, word).int % dimensions)] += 1.0
+        norm = sum(v * v for v in vector) ** 0.5 or 1.0
+        data.append({"object": "embedding", "index": i, "embedding": [v / norm for v in vector]})
+    tokens = sum(_count_tokens(text) for text in texts)
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "mock"),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+#####################################################
+# OpenAI Batch API
+#####################################################
+def _file_object(file_id: str, filename: str, purpose: str) -> dict:
+    return {
+        "id": file_id,
+        "object": "file",
+        "bytes": len(_files[file_id]),
+        "created_at": int(time.time()),
+        "filename": filename,
+        "purpose": purpose,
+        "status": "processed",
+    }
+
+
+@app.post("/v1/files")
+async def upload_file(request: Request):
+    form = await request.form()
+    upload = form["file"]
+    file_id = f"file-{uuid.uuid4().hex[:12]}"
+    _files[file_id] = await upload.read()
+    return _file_object(file_id, upload.filename or "upload.jsonl", form.get("purpose", "batch"))
+
+
+@app.get("/v1/files/{file_id}/content")
+async def file_content(file_id: str):
+    if file_id not in _files:
+        return JSONResponse({"error": {"message": "No such file (mock)"}}, status_code=404)
+    return PlainTextResponse(_files[file_id].decode("utf-8"))
+
+
+@app.post("/v1/batches")
+async def create_batch(request: Request):
+    body = await request.json()
+    if body.get("input_file_id") not in _files:
+        return JSONResponse({"error": {"message": "No such input file (mock)"}}, status_code=400)
+    batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+    _batches[batch_id] = {
+        "id": batch_id,
+        "object": "batch",
+        "endpoint": body.get("endpoint", "/v1/chat/completions"),
+        "input_file_id": body["input_file_id"],
+        "completion_window": body.get("completion_window", "24h"),
+        "status": "in_progress",
+        "output_file_id": None,
+        "error_file_id": None,
+        "created_at": int(time.time()),
+        "completed_at": None,
+        "request_counts": {"total": 0, "completed": 0, "failed": 0},
+    }
+    return _batches[batch_id]
+
+
+@app.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str):
+    batch = _batches.get(batch_id)
+    if batch is None:
+        return JSONResponse({"error": {"message": "No such batch (mock)"}}, status_code=404)
+    if batch["status"] == "in_progress" and time.time() - batch["created_at"] >= MOCK_BATCH_SECONDS:
+        _run_batch(batch)
+    return batch
+
+
+def _run_batch(batch: dict):
+    """
+    Answer every request in the batch's input file at once, failing each
+    with the model's error rate, and write the output and error files.
+    """
+    outputs, errors = [], []
+    for line in _files[batch["input_file_id"]].decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        body = request.get("body", {})
+        model = body.get("model", "mock")
+        profile, words, input_tokens = _completion(model, _prompt_text(body.get("messages", [])))
+        record = {"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": request.get("custom_id")}
+        if random.random() < profile["error_rate"]:
+            errors.append(dict(record, response=None, error={"code": "server_error", "message": "Internal error (mock)"}))
+            continue
+        usage = {
+            "prompt_tokens": input_tokens,
+            "completion_tokens": len(words),
+            "total_tokens": input_tokens + len(words),
+        }
+        completion = _chat_completion(f"chatcmpl-{uuid.uuid4().hex[:12]}", int(time.time()), model, words, usage)
+        outputs.append(dict(record, response={"status_code": 200, "body": completion}, error=None))
+
+    for records, field in ((outputs, "output_file_id"), (errors, "error_file_id")):
+        if records:
+            file_id = f"file-{uuid.uuid4().hex[:12]}"
+            _files[file_id] = "\n".join(json.dumps(r) for r in records).encode("utf-8")
+            batch[field] = file_id
+    batch["status"] = "completed"
+    batch["completed_at"] = int(time.time())
+    batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)}
+
+
+#####################################################
+# Google Gemini (REST transport)
+#####################################################
+@app.post("/v1beta/models/{model_action:path}")
+async def gemini(model_action: str, request: Request):
+    model, _, action = model_action.partition(":")
+    body = await request.json()
+    prompt = " ".join(
+        part.get("text", "")
+        for content in body.get("contents", [])
+        for part in content.get("parts", [])
+    )
+    profile, words, input_tokens = _completion(model, prompt)
+    failure = await _injected_failure(profile)
+    if failure is not None:
+        return failure
+
+    def payload(text: str, output_tokens: int, finish_reason=None) -> dict:
+        candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+        if finish_reason:
+            candidate["finishReason"] = finish_reason
+        return {
+            "candidates": [candidate],
+            "usageMetadata": {
+                "promptTokenCount": input_tokens,
+                "candidatesTokenCount": output_tokens,
+                "totalTokenCount": input_tokens + output_tokens,
+            },
+        }
+
+    if action != "streamGenerateContent":
+        return payload(" ".join(words), len(words), "STOP")
+
+    async def events():
+        emitted = 0
+        async for text in _paced(words, profile):
+            emitted += 1
+            yield _sse(payload(text, emitted, "STOP" if emitted == len(words) else None))
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+#####################################################
+# Cohere v2 chat
+#####################################################
+@app.post("/v2/chat")
+async def cohere_chat(request: Request):
+    body = await request.json()
+    model = body.get("model", "mock")
+    profile, words, input_tokens = _completion(model, _prompt_text(body.get("messages", [])))
+    failure = await _injected_failure(profile)
+    if failure is not None:
+        return failure
+
+    message_id = uuid.uuid4().hex
+    usage = {
+        "billed_units": {"input_tokens": input_tokens, "output_tokens": len(words)},
+        "tokens": {"input_tokens": input_tokens, "output_tokens": len(words)},
+    }
+
+    if not body.get("stream"):
+        return {
+            "id": message_id,
+            "finish_reason": "COMPLETE",
+            "message": {"role": "assistant", "content": [{"type": "text", "text": " ".join(words)}]},
+            "usage": usage,
+        }
+
+    async def events():
+        yield _sse({"type": "message-start", "id": message_id,
+                    "delta": {"message": {"role": "assistant"}}}, "message-start")
+        async for text in _paced(words, profile):
+            yield _sse({"type": "content-delta", "index": 0,
+                        "delta": {"message": {"content": {"text": text}}}}, "content-delta")
+        yield _sse({"type": "message-end",
+                    "delta": {"finish_reason": "COMPLETE", "usage": usage}}, "message-end")
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("MOCK_LLM_PORT", 9000)))
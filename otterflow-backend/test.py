@@ -1,14 +1,37 @@
+# test.py
+#
+# Provider smoke test and load benchmark.
+#
+#   python test.py providers
+#       Send one query to each enabled provider adapter.
+#
+#   python test.py bench --base-url http://localhost:8000 --concurrency 32 --requests 2000
+#       Seed benchmark users and wallets, then drive /query/handle_user_query
+#       and the dashboard endpoint at the given concurrency. Start the app
+#       with STAGE_TIMING=true (per-stage breakdown from Server-Timing) and
+#       LLM_MOCK_BASE_URL pointing at mock_llm.py so provider spend is zero.
+#       Throughput and p50/p95/p99 per endpoint and per stage are printed
+#       and saved as JSON.
+#
+#   python test.py wallet --mode atomic --threads 64 --debits 5000
+#       Hammer one benchmark user's wallet with concurrent debits straight
+#       against DATABASE_URL. --mode atomic uses debit_wallet (one
+#       conditional UPDATE ... RETURNING); orm is the old read, subtract,
+#       commit; for-update is the same behind SELECT ... FOR UPDATE. Checks
+#       the final balance against the debits that succeeded (lost updates,
+#       overdrafts) and prints how long each debit held the wallet row,
+#       from the first statement that locks it to commit. Row locks only
+#       mean something on Postgres; SQLite locks the whole database.
+
+import argparse
 import asyncio
 import os
 import json
+import random
+import time
 import collections.abc
+from datetime import datetime, timedelta, timezone
 from fastapi import HTTPException
-from app.llm.openai_query import handle_openai_query_async
-from app.llm.groq_query import handle_groq_query_async
-from app.llm.google_query import handle_google_query_async
-from app.llm.aimlapi_query import handle_aiml_query_async
-from app.llm.cohere_query import handle_cohere_query_async
-from google.protobuf.message import Message as ProtobufMessage
 
 # Function to serialize non-serializable response objects
 def serialize_response(response):
@@ -20,7 +43,7 @@ def serialize_response(response):
         return {k: serialize_response(v) for k, v in response.items()}
     elif isinstance(response, list):  # If the response is a list, recursively serialize each item
         return [serialize_response(item) for item in response]
-    elif isinstance(response, ProtobufMessage):  # If the response is a protobuf message
+    elif type(response).__module__.startswith("google.protobuf"):  # If the response is a protobuf message
         return serialize_response(vars(response))  # Convert to dictionary
     elif hasattr(response, '__dict__'):  # Handle custom objects with __dict__ attribute (like ChatCompletion)
         return serialize_response(vars(response))  # Convert to dictionary
@@ -29,6 +52,12 @@ def serialize_response(response):
 
 # Function to run a specific query
 async def run_query(api_name: str, user_query: str, model_name: str, **kwargs):
+    # Imported here so the benchmark does not need every provider SDK
+    from app.llm.openai_query import handle_openai_query_async
+    from app.llm.groq_query import handle_groq_query_async
+    from app.llm.google_query import handle_google_query_async
+    from app.llm.aimlapi_query import handle_aiml_query_async
+    from app.llm.cohere_query import handle_cohere_query_async
     try:
         if api_name == "OpenAI":
             result = await handle_openai_query_async(user_query, model_name, **kwargs)
@@ -67,9 +96,312 @@ async def run_queries(user_query: str, **kwargs):
 
     await asyncio.gather(*tasks)
 
+#####################################################
+# Benchmark harness                                 #
+#####################################################
+BENCH_QUERIES = [
+    "What is the derivative of x^3 + 2x?",
+    "Write a Python function that reverses a linked list.",
+    "Who wrote the novel One Hundred Years of Solitude?",
+    "Explain the difference between TCP and UDP.",
+    "Summarize the causes of the French Revolution in three sentences.",
+    "How do I center a div with CSS grid?",
+    "What is the capital of Australia?",
+    "Solve for x: 3x + 7 = 22.",
+]
+BENCH_BALANCE = 1_000_000_000  # cents; large enough that no run drains a wallet
+
+
+def seed_bench_users(count: int) -> list:
+    """
+    Create (or top up) verified benchmark users with funded wallets and
+    return their ids.
+    """
+    from app.db.database import SessionLocal
+    from app.db.models import User, Wallet
+
+    db = SessionLocal()
+    try:
+        user_ids = []
+        for i in range(count):
+            email = f"bench-user-{i}@example.com"
+            user = db.query(User).filter(User.email == email).first()
+            if user is None:
+                user = User(email=email, name=f"Bench User {i}", is_email_verified=True, auth_method="email")
+                db.add(user)
+                db.flush()
+            if user.wallet is None:
+                db.add(Wallet(user_id=user.id, balance=BENCH_BALANCE))
+            else:
+                user.wallet.balance = BENCH_BALANCE
+            user_ids.append(user.id)
+        db.commit()
+        return user_ids
+    finally:
+        db.close()
+
+
+def session_cookie(user_id: int) -> str:
+    """
+    A session token signed like /auth/login's, so the benchmark skips the
+    login round-trip (its cookie is Secure and bound to localhost).
+    """
+    from app.routes.auth import serializer
+    return serializer.dumps({
+        "user_id": user_id,
+        "exp": (datetime.now(timezone.utc) + timedelta(hours=12)).timestamp(),
+    })
+
+
+def parse_server_timing(header: str) -> dict:
+    stages = {}
+    for part in filter(None, (p.strip() for p in (header or "").split(","))):
+        name, _, rest = part.partition(";")
+        if rest.startswith("dur="):
+            stages[name] = float(rest[len("dur="):]) / 1000.0
+    return stages
+
+
+def summarize(samples: list) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pct(q):
+        return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "p50_ms": pct(50),
+        "p95_ms": pct(95),
+        "p99_ms": pct(99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+async def run_benchmark(args) -> dict:
+    import httpx
+
+    user_ids = seed_bench_users(args.users)
+    cookies = [session_cookie(user_id) for user_id in user_ids]
+    results = collections.defaultdict(lambda: {"latencies": [], "statuses": collections.Counter(), "stages": collections.defaultdict(list)})
+    user_input = {
+        "cost_priority": 1, "accuracy_priority": 1, "latency_priority": 1,
+        "cache": args.cache,
+    }
+    if args.temperature is not None:
+        user_input["temperature"] = args.temperature
+    remaining = args.requests
+    request_number = 0
+
+    async def one_request(client, worker: int):
+        nonlocal request_number
+        request_number += 1
+        cookie = cookies[(request_number if args.spread_users else worker) % len(cookies)]
+        headers = {"Cookie": f"session_id={cookie}"}
+        if random.random() < args.dashboard_ratio:
+            endpoint = "dashboard_metrics"
+            request = client.get("/dashboard/metrics", headers=headers)
+        else:
+            endpoint = "handle_user_query"
+            query = random.choice(BENCH_QUERIES)
+            if not args.cache:
+                query = f"{query} (#{request_number})"
+            request = client.post(
+                "/query/handle_user_query", params={"user_query": query},
+                json={"user_input": user_input}, headers=headers,
+            )
+        start_time = time.perf_counter()
+        try:
+            response = await request
+            status = response.status_code
+            timings = parse_server_timing(response.headers.get("server-timing"))
+        except httpx.HTTPError as e:
+            status, timings = type(e).__name__, {}
+        entry = results[endpoint]
+        entry["latencies"].append(time.perf_counter() - start_time)
+        entry["statuses"][str(status)] += 1
+        for name, seconds in timings.items():
+            entry["stages"][name].append(seconds)
+
+    async def worker(client, index: int):
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            await one_request(client, index)
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        # Warm the server (catalog, classifier, tokenizer) outside the measurement
+        for index in range(args.warmup):
+            await one_request(client, index)
+        results.clear()
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*(worker(client, i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start_time
+
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key != "command"},
+        "elapsed_s": elapsed,
+        "throughput_rps": sum(len(r["latencies"]) for r in results.values()) / elapsed,
+        "endpoints": {},
+    }
+    for endpoint, entry in results.items():
+        ok = sum(n for status, n in entry["statuses"].items() if status.startswith("2"))
+        report["endpoints"][endpoint] = {
+            "throughput_rps": len(entry["latencies"]) / elapsed,
+            "ok": ok,
+            "statuses": dict(entry["statuses"]),
+            "latency": summarize(entry["latencies"]),
+            "stages": {name: summarize(samples) for name, samples in entry["stages"].items()},
+        }
+    return report
+
+
+def print_report(report: dict):
+    print(f"\n{report['throughput_rps']:.1f} req/s over {report['elapsed_s']:.1f}s")
+    for endpoint, entry in report["endpoints"].items():
+        latency = entry["latency"]
+        print(f"\n{endpoint}: {entry['throughput_rps']:.1f} req/s, statuses {entry['statuses']}")
+        print(f"  latency  p50 {latency['p50_ms']:8.1f}  p95 {latency['p95_ms']:8.1f}  p99 {latency['p99_ms']:8.1f} ms")
+        for name, stats in sorted(entry["stages"].items(), key=lambda kv: -kv[1]["mean_ms"]):
+            print(f"  {name:<13}p50 {stats['p50_ms']:8.1f}  p95 {stats['p95_ms']:8.1f}  p99 {stats['p99_ms']:8.1f} ms")
+
+
+def run_wallet_benchmark(args) -> dict:
+    from concurrent.futures import ThreadPoolExecutor
+    from app.db.database import SessionLocal
+    from app.db.models import Wallet
+    from app.db.wallets import debit_wallet
+
+    user_id = seed_bench_users(1)[0]
+    db = SessionLocal()
+    # By default the wallet covers half of the debits, so the balance check
+    # is exercised too
+    start_balance = args.balance if args.balance is not None else args.cost * args.debits / 2
+    db.query(Wallet).filter(Wallet.user_id == user_id).update({"balance": start_balance})
+    db.commit()
+    db.close()
+
+    def debit(_):
+        db = SessionLocal()
+        try:
+            # Lock hold runs from the moment the first statement that takes
+            # the row lock returns (the lock is granted) to the end of commit,
+            # so waiting for the lock counts as latency, not as hold
+            start_time = time.perf_counter()
+            if args.mode == "atomic":
+                ok = debit_wallet(db, user_id, args.cost) is not None
+                locked_at = time.perf_counter()
+            else:
+                query = db.query(Wallet).filter(Wallet.user_id == user_id)
+                if args.mode == "for-update":
+                    query = query.with_for_update()
+                wallet = query.first()
+                locked_at = time.perf_counter()
+                # Stand-in for the work done between reading and writing
+                time.sleep(args.work_ms / 1000)
+                ok = wallet.balance >= args.cost
+                if ok:
+                    wallet.balance = wallet.balance - args.cost
+                    if args.mode == "orm":
+                        # A plain SELECT takes no row lock; the UPDATE
+                        # flushed here is the first statement that does
+                        db.flush()
+                        locked_at = time.perf_counter()
+            if ok:
+                db.commit()
+            else:
+                db.rollback()
+            end_time = time.perf_counter()
+            return ("ok" if ok else "rejected"), end_time - locked_at, end_time - start_time
+        except Exception as e:
+            db.rollback()
+            return type(e).__name__, 0.0, time.perf_counter() - start_time
+        finally:
+            db.close()
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        outcomes = list(pool.map(debit, range(args.debits)))
+    elapsed = time.perf_counter() - start_time
+
+    db = SessionLocal()
+    final_balance = db.query(Wallet.balance).filter(Wallet.user_id == user_id).scalar()
+    db.close()
+    statuses = collections.Counter(status for status, _, _ in outcomes)
+    expected_balance = start_balance - statuses["ok"] * args.cost
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "command"},
+        "elapsed_s": elapsed,
+        "throughput_dps": len(outcomes) / elapsed,
+        "statuses": dict(statuses),
+        "start_balance": start_balance,
+        "final_balance": final_balance,
+        "expected_balance": expected_balance,
+        "lost_updates": round((final_balance - expected_balance) / args.cost),
+        "overdrawn": final_balance < 0,
+        "lock_hold": summarize([hold for status, hold, _ in outcomes if status == "ok"]),
+        "latency": summarize([latency for _, _, latency in outcomes]),
+    }
+
+
+def print_wallet_report(report: dict):
+    lock_hold, latency = report["lock_hold"], report["latency"]
+    print(f"\n{report['config']['mode']}: {report['throughput_dps']:.1f} debits/s over {report['elapsed_s']:.1f}s, statuses {report['statuses']}")
+    print(f"  balance  {report['start_balance']:.2f} -> {report['final_balance']:.2f} (expected {report['expected_balance']:.2f})")
+    print(f"  lost updates {report['lost_updates']}, overdrawn {report['overdrawn']}")
+    if lock_hold["count"]:
+        print(f"  lock hold  p50 {lock_hold['p50_ms']:8.2f}  p95 {lock_hold['p95_ms']:8.2f}  p99 {lock_hold['p99_ms']:8.2f} ms")
+    print(f"  latency    p50 {latency['p50_ms']:8.2f}  p95 {latency['p95_ms']:8.2f}  p99 {latency['p99_ms']:8.2f} ms")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Provider smoke test and load benchmark")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("providers", help="send one query to each enabled provider")
+    bench = sub.add_parser("bench", help="load test the query and dashboard endpoints")
+    bench.add_argument("--base-url", default=os.getenv("BENCH_BASE_URL", "http://localhost:8000"))
+    bench.add_argument("--users", type=int, default=20, help="benchmark users to seed")
+    bench.add_argument("--concurrency", type=int, default=16)
+    bench.add_argument("--requests", type=int, default=1000)
+    bench.add_argument("--warmup", type=int, default=4)
+    bench.add_argument("--dashboard-ratio", type=float, default=0.1, help="share of requests hitting /dashboard/metrics")
+    bench.add_argument("--spread-users", action="store_true", help="rotate users per request instead of per worker")
+    bench.add_argument("--cache", action="store_true", help="allow response caches (queries repeat verbatim)")
+    bench.add_argument("--temperature", type=float, default=None)
+    bench.add_argument("--timeout", type=float, default=120.0)
+    bench.add_argument("--output", default=f"bench-{datetime.now():%Y%m%d-%H%M%S}.json")
+    wallet = sub.add_parser("wallet", help="concurrent debits against one user's wallet")
+    wallet.add_argument("--mode", choices=("atomic", "orm", "for-update"), default="atomic")
+    wallet.add_argument("--threads", type=int, default=64)
+    wallet.add_argument("--debits", type=int, default=5000)
+    wallet.add_argument("--cost", type=float, default=1.0, help="cents per debit")
+    wallet.add_argument("--balance", type=float, default=None, help="starting balance (default: half the debits)")
+    wallet.add_argument("--work-ms", type=float, default=1.0, help="delay between read and write in orm/for-update")
+    wallet.add_argument("--output", default=f"bench-wallet-{datetime.now():%Y%m%d-%H%M%S}.json")
+    return parser.parse_args()
+
+
 # Main function to start the program
 if __name__ == "__main__":
-    user_query = "Hi!"  # Example user query
+    args = parse_args()
+    if args.command == "bench":
+        report = asyncio.run(run_benchmark(args))
+        print_report(report)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved {args.output}")
+    elif args.command == "wallet":
+        report = run_wallet_benchmark(args)
+        print_wallet_report(report)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved {args.output}")
+    else:
+        user_query = "Hi!"  # Example user query
 
-    # Run the queries concurrently
-    asyncio.run(run_queries(user_query))
+        # Run the queries concurrently
+        asyncio.run(run_queries(user_query))